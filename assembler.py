@@ -1,6 +1,19 @@
-from struct import pack
+from struct import Struct
+from concurrent.futures import ProcessPoolExecutor
+from array import array
+from operator import itemgetter
 import argparse
+import json
+import mmap
+import os
+import re
+import threading
 import time
+import tracemalloc
+from warnings import warn
+
+from lasm_cache import liquidcpu_cache
+from liqfile import SEGMENT_DATA, SEGMENT_BSS, image_segments, pack_liqfile
 
 INST_FLAG_SRC_MEM_OP = (1<<0)
 INST_FLAG_DST_MEM_OP = (1<<1)
@@ -9,9 +22,24 @@ INST_FLAG_DST_CONST  = (1<<3)
 INST_FLAG_SRC_REG    = (1<<4)
 INST_FLAG_DST_REG    = (1<<5)
 
+# Bump whenever the encoded output changes, so cached results are not reused
+ASSEMBLER_VERSION = 2
+
+# Size of the CPU's memory, MEMORY_SIZE in src/cpu.h. No single line can
+# put more bytes than this in the output.
+MEMORY_SIZE = 0x4000
+
 # Input stuff
 verbose_level = 0
 
+# A liquidcpu_assembler call has its own verbosity and collects its own
+# warnings instead of printing them, kept here for the thread it runs on.
+# Everything else uses verbose_level and prints.
+call_settings = threading.local()
+
+def current_verbose_level():
+    return getattr(call_settings, "verbose_level", verbose_level)
+
 class liquidcpu_instruction:
     def __init__(self, opcode, instruction_flags, operand_sizes, data1, data2):
         self.instruction = opcode
@@ -20,697 +48,2121 @@ class liquidcpu_instruction:
         self.data1 = data1
         self.data2 = data2
 
-def assembler_error(msg, line, filename):
-    print("\nlasm: error!")
-    print(msg)
-    print("in file " + filename + ", on line " + str(line) + ".")
-    quit()
+class liquidcpu_assembler_warning(UserWarning):
+    # Warnings of liquidcpu_assembler calls that weren't given a list for them
+    pass
 
-def assembler_warn(msg, line, filename):
-    print("Warning: " + str(msg))
-    print("in file " + filename + ", on line " + str(line) + ".")
+class liquidcpu_assembler_error(Exception):
+    # Raised for any error in the source, main() prints it and exits
+    def __init__(self, msg, line, filename):
+        super().__init__(msg, line, filename)
+        self.msg = msg
+        self.line = line
+        self.filename = filename
 
-def assembler_log(msg):
-    if verbose_level >= 1:
-        print("[Info] " + str(msg))
+    def __str__(self):
+        return self.msg + " (in file " + self.filename + ", on line " + str(self.line) + ")"
 
-def assembler_dbg(msg):
-    if verbose_level >= 2:
-        print("[Debug] " + str(msg))
-
-def write_instruction(i, fp):
-    assembler_dbg("Data " + str(i.instruction) + " " + str(i.instruction_flags) + " " + str(i.operand_sizes) + " " + str(i.data1) + " " + str(i.data2))
-    fp.write(pack("<BBBQQ", i.instruction, i.instruction_flags, i.operand_sizes, i.data1, i.data2))
+def assembler_error(msg, line, filename):
+    raise liquidcpu_assembler_error(msg, line, filename)
 
-def write_data(i, fp):
-    assembler_dbg("Data " + str(i[0]))
+def print_assembler_error(error):
+    print("\nlasm: error!")
+    print(error.msg)
+    print("in file " + error.filename + ", on line " + str(error.line) + ".")
 
-    if i[1] == 8:
-        fp.write(pack("<Q", i[0]))
+def assembler_warning(msg):
+    warnings = getattr(call_settings, "warnings", None)
+    if warnings is None:
+        print("Warning: " + msg)
+    else:
+        warnings.append(msg)
 
-def tokenize(data, filename):
-    tokens = []
-    string_storage = ""
-    num_storage = ""
-    last_was_num = False
+def assembler_warn(msg, line, filename):
+    assembler_warning(str(msg) + "\nin file " + filename + ", on line " + str(line) + ".")
+
+# Messages are passed in pieces and only joined when they are printed, so
+# logging costs nothing but the call when it is off. Hot loops check
+# the verbose level themselves to skip even that.
+def assembler_log(*parts):
+    if current_verbose_level() >= 1:
+        print("[Info] " + "".join([str(part) for part in parts]))
+
+def assembler_dbg(*parts):
+    if current_verbose_level() >= 2:
+        print("[Debug] " + "".join([str(part) for part in parts]))
+
+# tracemalloc is shared by the whole process, so only one liquidcpu_stats
+# can measure peak memory at a time, from the start of its first open phase
+# to the end of its last. Another one that wants to meanwhile leaves the
+# peak out of its records rather than reset the peak under the first.
+memory_tracer_lock = threading.Lock()
+memory_tracer = None # [stats, open phases]
+
+class liquidcpu_stats:
+    # Wall time, peak traced memory and counts for each phase of a build.
+    # Every finished phase is a dict in records, and is passed to each hook
+    # as soon as it is done.
+    def __init__(self, trace_memory=True):
+        self.records = []
+        self.hooks = []
+        self.trace_memory = trace_memory
+
+    def add_hook(self, hook):
+        self.hooks.append(hook)
+
+    def start(self, phase, filename=None):
+        traced = self.trace_memory and self.claim_tracer()
+        return {"phase": phase, "file": filename, "start": time.perf_counter(), "traced": traced}
+
+    def finish(self, record, **counts):
+        record["seconds"] = time.perf_counter() - record.pop("start")
+        if record.pop("traced"):
+            record["peak_memory"] = tracemalloc.get_traced_memory()[1]
+            self.release_tracer()
+        record.update(counts)
+        self.add_record(record)
+
+    def claim_tracer(self):
+        global memory_tracer
+        with memory_tracer_lock:
+            if memory_tracer is None:
+                memory_tracer = [self, 0]
+            elif memory_tracer[0] is not self:
+                return False
+            memory_tracer[1] += 1
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+            tracemalloc.reset_peak()
+            return True
+
+    def release_tracer(self):
+        global memory_tracer
+        with memory_tracer_lock:
+            memory_tracer[1] -= 1
+            if memory_tracer[1] == 0:
+                memory_tracer = None
+
+    def add_record(self, record):
+        self.records.append(record)
+        for hook in self.hooks:
+            hook(record)
+
+    def merge(self, records):
+        # Records collected somewhere else, like in a -j worker
+        for record in records:
+            self.add_record(record)
+
+    def totals(self):
+        totals = {}
+        for record in self.records:
+            total = totals.setdefault(record["phase"], {"phase": record["phase"], "seconds": 0.0})
+            for key, value in record.items():
+                if key == "peak_memory":
+                    total[key] = max(total.get(key, 0), value)
+                elif key not in ("phase", "file"):
+                    total[key] = total.get(key, 0) + value
+        return list(totals.values())
+
+stat_columns = ["tokens", "labels", "instructions", "saved", "dq_bytes", "bytes"]
+
+def format_stats(stats):
+    def format_record(record, filename):
+        peak = record.get("peak_memory")
+        line = "{:<14} {:<24} {:>10.4f} {:>12}".format(record["phase"], filename, record["seconds"], "-" if peak is None else str(peak // 1024))
+        return line + "".join(["{:>14}".format(record.get(column, "")) for column in stat_columns])
+
+    lines = ["{:<14} {:<24} {:>10} {:>12}".format("phase", "file", "seconds", "peak KiB") + "".join(["{:>14}".format(column) for column in stat_columns])]
+    for record in stats.records:
+        lines.append(format_record(record, record["file"] or ""))
+
+    # Totals are only worth a second table when some phase ran more than once
+    totals = stats.totals()
+    if len(totals) < len(stats.records):
+        lines.append("")
+        for record in totals:
+            lines.append(format_record(record, "(all files)"))
+    return "\n".join(lines)
+
+# Precompiled record layouts, matching instruction_t in src/microcode/microcode.h
+instruction_struct = Struct("<BBBQQ")
+data_struct        = Struct("<Q")
+
+def image_size(instruction_data_list):
+    return sum([item[2] for item in instruction_data_list])
+
+def emit_buffer(instruction_data_list, size=None, runs=None):
+    # runs, if given, gets a (segment kind, offset, size) for every data
+    # item, for --sectioned
+    if size is None:
+        size = image_size(instruction_data_list)
+
+    # The image is sized once and every record is packed straight into it
+    image = bytearray(size)
+    pack_instruction = instruction_struct.pack_into
+    pack_data = data_struct.pack_into
+    debug = current_verbose_level() >= 2
+
+    offset = 0
+    for item in instruction_data_list:
+        if item[0] == "instruction":
+            i = item[1]
+            if debug:
+                assembler_dbg("Data ", i.instruction, " ", i.instruction_flags, " ", i.operand_sizes, " ", i.data1, " ", i.data2)
+            pack_instruction(image, offset, i.instruction, i.instruction_flags, i.operand_sizes, i.data1, i.data2)
+        elif item[0] == "data":
+            if debug:
+                assembler_dbg("Data ", item[1])
+            if type(item[1]) is int:
+                pack_data(image, offset, item[1])
+            elif item[1] is not None:
+                # A whole run of dq values, the image is already zero for resq
+                image[offset:offset + item[2]] = item[1]
+            if runs is not None:
+                kind = SEGMENT_BSS if item[1] is None else SEGMENT_DATA
+                if runs and runs[-1][0] == kind and runs[-1][1] + runs[-1][2] == offset:
+                    runs[-1][2] += item[2]
+                else:
+                    runs.append([kind, offset, item[2]])
+        offset += item[2]
+
+    return image
+
+def emit_image(instruction_data_list, size=None):
+    return memoryview(emit_buffer(instruction_data_list, size))
+
+# Token kinds, stored as one byte each. Spaces and tabs only separate words,
+# so they are dropped by the scanner and never become tokens.
+TOKEN_IDENTIFIER    = 0
+TOKEN_NUMBER        = 1
+TOKEN_PARAM_SEP     = 2
+TOKEN_LABEL_END     = 3
+TOKEN_BRACKET_OPEN  = 4
+TOKEN_BRACKET_CLOSE = 5
+TOKEN_NEWLINE       = 6
+token_kind_names = ["identifier", "number", "param_sep", "label_end", "bracket_open", "bracket_close", "newline"]
+
+# The scanner splits the source into words and runs of separator characters.
+# Each distinct word or run is turned into its tokens once and cached, since
+# generated sources repeat the same few of them (indentation, ", ", mnemonics,
+# registers, label names) over and over.
+token_separators = " ,:\t[]\n"
+token_split_regex = re.compile(r"([ ,:\t\[\]\n]+)")
+number_prefix_regex = re.compile(r"\d*")
+
+char_tokens = {
+    " ":  None,
+    ",":  (TOKEN_PARAM_SEP, None),
+    ":":  (TOKEN_LABEL_END, None),
+    "\t": None,
+    "[":  (TOKEN_BRACKET_OPEN, None),
+    "]":  (TOKEN_BRACKET_CLOSE, None),
+    "\n": (TOKEN_NEWLINE, None),
+}
+
+def scan_text(text):
+    # (kind, value) of every token in a word or a run of separators
+    if text == "":
+        return ()
+    if text[0] in token_separators:
+        return tuple([char_tokens[char] for char in text if char_tokens[char] is not None])
+
+    # Numbers only start when no identifier is being built, so "r0" is an
+    # identifier while "12abc" is a number followed by an identifier
+    digits = number_prefix_regex.match(text).group()
+    if digits == "":
+        return ((TOKEN_IDENTIFIER, text),)
+    elif digits == text:
+        return ((TOKEN_NUMBER, int(text)),)
+    return ((TOKEN_NUMBER, int(digits)), (TOKEN_IDENTIFIER, text[len(digits):]))
+
+def check_line_brackets(line, line_num, filename):
     bracket_open = False
+    for char in line:
+        if char == "[":
+            if bracket_open:
+                assembler_error("Opening an already open bracket!", line_num, filename)
+            bracket_open = True
+        elif char == "]":
+            if not bracket_open:
+                assembler_error("Closing an already closed bracket!", line_num, filename)
+            bracket_open = False
+
+    if bracket_open:
+        assembler_error("Bracket left opened!", line_num, filename)
+
+# Lines where every bracket is closed before the next one opens
+balanced_line_regex = re.compile(r"[^\[\]]*(?:\[[^\[\]]*\][^\[\]]*)*")
+
+def decode_text(data, filename, line_num=1):
+    # Source bytes as text. data starts on line line_num, so a bad byte can
+    # be reported with its line.
+    try:
+        return data.decode()
+    except UnicodeDecodeError as error:
+        assembler_error("Source is not valid UTF-8, byte " + hex(data[error.start]) + " can't be decoded!", line_num + decode_source(bytes(data[:error.start])).count("\n"), filename)
+
+def check_brackets(data, filename, line_num=1):
+    # data starts on line line_num. Only lines that fail the regex are looked
+    # at closely, to find the right error.
+    if not isinstance(data, str):
+        # Checking text is a lot faster, and decoding is cheap next to it
+        data = decode_text(data, filename, line_num)
+
+    balanced = balanced_line_regex.fullmatch
+    for line in data.split("\n"):
+        if ("[" in line or "]" in line) and balanced(line) is None:
+            check_line_brackets(line, line_num, filename)
+        line_num += 1
 
+# Packed forms of a single kind and value id, for building the token arrays
+kind_bytes = [bytes([kind]) for kind in range(len(token_kind_names))]
+value_id_struct = Struct("I")
+no_value_id = value_id_struct.pack(0)
+
+class liquidcpu_tokens:
+    # A tokenized file as two parallel arrays: the kind of every token, and
+    # an index into values, which holds every distinct identifier and number
+    # once. Tokens without a value use index 0.
+    def __init__(self, kinds, value_ids, values):
+        self.kinds = kinds
+        self.value_ids = value_ids
+        self.values = values
+
+    def __len__(self):
+        return len(self.kinds)
+
+    def __iter__(self):
+        # (kind, value) of every token
+        return zip(self.kinds, map(self.values.__getitem__, self.value_ids))
+
+    def __str__(self):
+        return str([(token_kind_names[kind], value) for kind, value in self])
+
+tokenize_chunk_size = 16384
+tokenize_window_size = 1024 * 1024
+token_split_bytes_regex = re.compile(rb"([ ,:\t\[\]\n]+)")
+
+def tokenize(data, filename, first_line=1):
+    # data is text, or bytes of any kind (like an mmap of the file). Bytes are
+    # only decoded a word at a time, as each new word is found. first_line is
+    # the line data starts on, for errors, when it is part of a bigger file.
+    if isinstance(data, str):
+        split, newline, bracket_open, bracket_close = token_split_regex.split, "\n", "[", "]"
+    elif data.find(b"\r") != -1:
+        # Rare enough that fixing the newlines up front is fine
+        return tokenize(decode_source(decode_text(bytes(data), filename, first_line)), filename, first_line)
+    else:
+        split, newline, bracket_open, bracket_close = token_split_bytes_regex.split, b"\n", b"[", b"]"
+
+    # Word or separator run -> its token kinds and value ids, already packed
+    # the way the arrays store them so that joining them is all that's left.
+    # Every distinct word is scanned once, so its values are stored once.
+    text_tokens = {}
+    values = [None]
+
+    def scan_new_text(key):
+        if isinstance(key, str):
+            text = key
+        else:
+            try:
+                text = key.decode()
+            except UnicodeDecodeError:
+                # Words are scanned in order, so the first bad byte of the
+                # window is in this one, and decoding the window finds its line
+                decode_text(window, filename, window_line)
+        scanned = scan_text(text)
+        if len(scanned) == 1 and scanned[0][1] is not None:
+            # A plain identifier or number, by far the most common word
+            tokens = (kind_bytes[scanned[0][0]], value_id_struct.pack(len(values)))
+            values.append(scanned[0][1])
+        elif text == "" or text[0] in token_separators:
+            tokens = (bytes([kind for kind, value in scanned]), no_value_id * len(scanned))
+        else:
+            ids = array("I", range(len(values), len(values) + len(scanned)))
+            values.extend([value for kind, value in scanned])
+            tokens = (bytes([kind for kind, value in scanned]), ids.tobytes())
+
+        text_tokens[key] = tokens
+        return tokens
+
+    get_tokens = text_tokens.get
+    kinds = array("B")
+    ids = array("I")
+
+    # The source is split a window of whole lines at a time, and the words
+    # a chunk at a time, so only a window of the source and a chunk of
+    # packed pieces exist at once on top of the token arrays
+    line_num = first_line
+    start = 0
+    while start < len(data):
+        end = data.find(newline, start + tokenize_window_size)
+        end = len(data) if end == -1 else end + 1
+        window = data[start:end]
+        window_line = line_num
+        start = end
+
+        if bracket_open in window or bracket_close in window:
+            check_brackets(window, filename, line_num)
+        line_num += window.count(newline)
+
+        texts = split(window)
+        for chunk_start in range(0, len(texts), tokenize_chunk_size):
+            pieces = [get_tokens(text) or scan_new_text(text) for text in texts[chunk_start:chunk_start + tokenize_chunk_size]]
+            kinds.frombytes(b"".join(map(itemgetter(0), pieces)))
+            ids.frombytes(b"".join(map(itemgetter(1), pieces)))
+
+    # The last line doesn't end in a newline in the source
+    kinds.append(TOKEN_NEWLINE)
+    ids.append(0)
+    return liquidcpu_tokens(kinds, ids, values)
+
+# Most distinct words a streamed source keeps cached at once
+stream_cache_limit = 65536
+
+def tokenize_lines(lines, filename):
+    # Same (kind, value) tokens as tokenize, one line at a time. Lines may or
+    # may not end in a newline, every line gets one.
+    text_tokens = {}
+    newline = char_tokens["\n"]
     line_num = 1
 
-    for line in data.split("\n"):
-        for char in line:
-            if char.isnumeric() and string_storage == "":
-                # Number
-                if last_was_num:
-                    num_storage += char
-                else:
-                    num_storage = ""
-                    num_storage += char
-                last_was_num = True
-            else:
-                if last_was_num:
-                    last_was_num = False
-                    tokens.append(("number", int(num_storage)))
-                # It is just a regular character
-                if char == " ":
-                    if string_storage != "":
-                        tokens.append(("identifier", string_storage))
-
-                    tokens.append(("space", char))
-                    string_storage = ""
-                elif char == ",":
-                    if string_storage != "":
-                        tokens.append(("identifier", string_storage))
-
-                    tokens.append(("param_sep", char))
-                    string_storage = ""
-                elif char == ":":
-                    if string_storage != "":
-                        tokens.append(("identifier", string_storage))
-
-                    tokens.append(("label_end", char))
-                    string_storage = ""
-                elif char == "\t":
-                    if string_storage != "":
-                        tokens.append(("identifier", string_storage))
-
-                    tokens.append(("tab", char))
-                    string_storage = ""
-                elif char == "[":
-                    if string_storage != "":
-                        tokens.append(("identifier", string_storage))
-
-                    tokens.append(("bracket_open", char))
-                    string_storage = ""
-
-                    if bracket_open:
-                        assembler_error("Opening an already open bracket!", line_num, filename)
-
-                    bracket_open = True
-                elif char == "]":
-                    if string_storage != "":
-                        tokens.append(("identifier", string_storage))
-
-                    tokens.append(("bracket_close", char))
-                    string_storage = ""
-
-                    if not bracket_open:
-                        assembler_error("Closing an already closed bracket!", line_num, filename)
-
-                    bracket_open = False
-                else:
-                    string_storage += char
-        if last_was_num:
-            tokens.append(("number", int(num_storage)))
-            last_was_num = False
-            num_storage = ""
-        if string_storage != "":
-            tokens.append(("identifier", string_storage))
-            string_storage = ""
-        
-        # Add a newline
-        tokens.append(("newline", "\n"))
-        if bracket_open:
-            assembler_error("Bracket left opened!", line_num, filename)
-        line_num += 1
-    
-    return tokens
+    for line in lines:
+        if isinstance(line, bytes):
+            line = decode_text(line, filename, line_num)
+        line = line.rstrip("\r\n")
+        if "\r" in line:
+            # A lone \r ends a line, like when reading the file in text mode
+            sublines = line.replace("\r\n", "\n").replace("\r", "\n").split("\n")
+        else:
+            sublines = (line,)
+
+        for line in sublines:
+            if "[" in line or "]" in line:
+                check_line_brackets(line, line_num, filename)
+
+            for text in token_split_regex.split(line):
+                tokens = text_tokens.get(text)
+                if tokens is None:
+                    # Numbers and labels keep coming, so don't let the cache grow forever
+                    if len(text_tokens) >= stream_cache_limit:
+                        text_tokens.clear()
+                    tokens = scan_text(text)
+                    text_tokens[text] = tokens
+                yield from tokens
+
+            yield newline
+            line_num += 1
 
 
 # List of instructions for the assembler to parse
 instruction_names = ["nop", "mov", "hlt", "jmp", "inc", "dec", "push", "pop", "call", "ret"]
-assembler_macros  = ["dq"]
+assembler_macros  = ["dq", "resq", "times"]
 gprs              = ["r0", "r1", "r2", "r3", "r4", "r5", "r6", "r7"]
 visible_regs      = ["r0", "r1", "r2", "r3", "r4", "r5", "r6", "r7", "ip", "sp"]
 
 instruction_ops   = [0, 1, 2, 3, 4, 5, 6, 7, 8, 9]
 reg_indexes       = [0, 1, 2, 3, 4, 5, 6, 7, 8, 9]
 
+# Hashed lookups for the tables above, so checking a token is O(1)
+instruction_name_set = frozenset(instruction_names)
+assembler_macro_set  = frozenset(assembler_macros)
+instruction_opcodes  = dict(zip(instruction_names, instruction_ops))
+gpr_indexes          = dict(zip(gprs, reg_indexes))
+
 def get_opcode(name):
-    return instruction_ops[instruction_names.index(name)]
+    return instruction_opcodes[name]
 
 def get_register_index(name):
-    return reg_indexes[gprs.index(name)]
-
-def parse_file(filename):
-    global instruction_names
-
-    ret_instructions = []
-
-    with open(filename) as fp:
-        data = fp.read()
-    
-    tokens = tokenize(data, filename)
-    assembler_dbg(tokens)
-    
+    return gpr_indexes[name]
+
+# Names an operand can't use that are still clearly meant as registers, like
+# r8 or sp. Unless a label has that name, they are reported instead of being
+# taken for a label from another file.
+register_like_regex = re.compile(r"r[0-9]+$")
+
+def is_register_like(name):
+    return name in visible_regs or register_like_regex.match(name) is not None
+
+class liquidcpu_symbol_table:
+    def __init__(self):
+        self.addresses = {}
+        self.lines = {}
+
+    def define(self, name, address, line, filename):
+        if name in self.addresses:
+            assembler_error("Duplicate label " + name + ", first defined on line " + str(self.lines[name]) + "!", line, filename)
+
+        self.addresses[name] = address
+        self.lines[name] = line
+
+    def resolve(self, name):
+        return self.addresses[name]
+
+    def __contains__(self, name):
+        return name in self.addresses
+
+    def __len__(self):
+        return len(self.addresses)
+
+# Operand forms, by how the operand is written in the source
+operand_forms     = ["reg", "[reg]", "const", "[const]"]
+writable_forms    = ["reg", "[reg]", "[const]"]
+
+# Flag bits for each form of the destination (1st) and source (2nd) operand
+dst_form_flags = {
+    "reg":     INST_FLAG_DST_REG,
+    "[reg]":   INST_FLAG_DST_REG | INST_FLAG_DST_MEM_OP,
+    "const":   INST_FLAG_DST_CONST,
+    "[const]": INST_FLAG_DST_MEM_OP,
+}
+src_form_flags = {
+    "reg":     INST_FLAG_SRC_REG,
+    "[reg]":   INST_FLAG_SRC_REG | INST_FLAG_SRC_MEM_OP,
+    "const":   INST_FLAG_SRC_CONST,
+    "[const]": INST_FLAG_SRC_MEM_OP,
+}
+
+def allowed_forms(form_flags, forms):
+    return {form: form_flags[form] for form in forms}
+
+# mnemonic -> allowed forms of each operand (dst first, then src) -> flag bits
+instruction_forms = {
+    "nop":  (),
+    "mov":  (allowed_forms(dst_form_flags, writable_forms), allowed_forms(src_form_flags, operand_forms)),
+    "hlt":  (),
+    "jmp":  (allowed_forms(dst_form_flags, operand_forms),),
+    "inc":  (allowed_forms(dst_form_flags, writable_forms),),
+    "dec":  (allowed_forms(dst_form_flags, writable_forms),),
+    "push": (allowed_forms(dst_form_flags, operand_forms),),
+    "pop":  (allowed_forms(dst_form_flags, writable_forms),),
+    "call": (allowed_forms(dst_form_flags, operand_forms),),
+    "ret":  (),
+}
+operand_names = ["destination", "source"]
+
+def find_labels(tokens, filename):
     current_address = 0 # LiquidCPU code exec starts at 0
-    labels = []
-    last_identifier = ()
+    labels = liquidcpu_symbol_table()
+    last_identifier = None
 
     line = 1
 
-    token_index = 0
-    skip_count = 0
+    # Macro of the current line, and how many times the line is repeated.
+    # Sizes are only counted here, encode_stream checks the operands.
+    macro = None
+    repeat = 1
 
-    # Find all labels
-    for token in tokens:
-        if token[0] == "identifier":
-            last_identifier = token
-            if token[1] in instruction_names:
+    for kind, value in tokens:
+        if kind == TOKEN_IDENTIFIER:
+            last_identifier = value
+            if value in instruction_name_set:
                 # Increment by instruction size
-                current_address += 19
-            elif token[1] in assembler_macros:
-                if token[1] == "dq":
-                    current_address += 8
-        elif token[0] == "label_end":
-            labels.append((last_identifier[1], current_address))
-        elif token[0] == "newline":
+                current_address += 19 * repeat
+            elif value in assembler_macro_set:
+                macro = value
+        elif kind == TOKEN_NUMBER and macro is not None:
+            if macro == "dq":
+                current_address += 8 * repeat
+            elif macro == "resq":
+                current_address += 8 * value * repeat
+            else:
+                repeat = value
+                macro = None
+        elif kind == TOKEN_LABEL_END:
+            if last_identifier is None:
+                assembler_error("Expected label name before colon!", line, filename)
+            labels.define(last_identifier, current_address, line, filename)
+        elif kind == TOKEN_NEWLINE:
             line += 1
-
-    line = 1
+            macro = None
+            repeat = 1
+
+    return labels
+
+# Offsets of data1 and data2 inside an encoded instruction, for relocations
+operand_offsets = [3, 11]
+
+def encode_tokens(tokens, labels, filename, relocations):
+    return list(encode_stream(tokens, labels, filename, relocations))
+
+def repeated_items(mnemonic_name, instruction, values, repeat):
+    # Items for a line with more than one dq value, resq, or a times prefix.
+    # Repeated instructions are separate objects, as -O changes them one by
+    # one. Data is a single item, dq values are packed here so that they are
+    # copied in one go when emitted and resq zeros are never packed at all.
+    if instruction is not None:
+        for copy in range(repeat):
+            if copy > 0:
+                instruction = liquidcpu_instruction(instruction.instruction, instruction.instruction_flags, instruction.operand_sizes, instruction.data1, instruction.data2)
+            yield ("instruction", instruction, 19)
+    elif repeat == 0:
+        return
+    elif mnemonic_name == "dq":
+        yield ("data", Struct("<" + str(len(values)) + "Q").pack(*values) * repeat, 8 * len(values) * repeat)
+    elif values[0] > 0:
+        yield ("data", None, 8 * values[0] * repeat)
+
+# Yields ("instruction", obj, 19) and ("data", value, size) items as the
+# lines are encoded. The value of a data item is a number for a single dq,
+# the packed bytes for longer runs, or None for zeros (resq). With
+# define_labels, labels are defined here as they are found instead of by
+# find_labels, so only labels above the current line are known and every
+# other label use is written as 0 and left to relocations. Without
+# relocate_defined, uses of labels that are already known are not added to
+# the relocations. first_line is the line the tokens start on.
+def encode_stream(tokens, labels, filename, relocations, define_labels=False, relocate_defined=True, first_line=1):
+    logging = current_verbose_level() >= 1
     current_address = 0
+    line = first_line
+
+    # State of the line being encoded, mnemonic_name is None between lines
+    mnemonic_name = None
+    new_instruction = None
+    forms = ()
+    operand_count = 0
+    comma_count = 0
+    in_bracket = False
+    bracket_operands = 0
+    pending_label = None
+
+    # Operands of dq/resq, label uses of the line, and the count of a
+    # "times N" prefix (None without one)
+    macro_values = []
+    line_relocations = []
+    repeat = None
+
+    for kind, token_value in tokens:
+
+        if mnemonic_name is None:
+            # Looking for a mnemonic or a label
+            if pending_label is not None:
+                if kind != TOKEN_LABEL_END:
+                    assembler_error("Invalid instruction mnemonic " + pending_label, line, filename)
+                if repeat is not None:
+                    assembler_error("Can't repeat label " + pending_label + " with times!", line, filename)
+                if logging:
+                    assembler_log("Found label ", pending_label)
+                if define_labels:
+                    labels.define(pending_label, current_address, line, filename)
+                pending_label = None
+            elif kind == TOKEN_IDENTIFIER:
+                if token_value in instruction_forms:
+                    if logging:
+                        assembler_log("Found instruction ", token_value)
+                    mnemonic_name = token_value
+                    new_instruction = liquidcpu_instruction(get_opcode(mnemonic_name), 0, 0, 0, 0)
+                    forms = instruction_forms[mnemonic_name]
+                elif token_value in assembler_macro_set:
+                    if token_value == "times" and repeat is not None:
+                        assembler_error("times can't be repeated!", line, filename)
+                    mnemonic_name = token_value
+                    forms = ()
+                else:
+                    pending_label = token_value
+            elif kind == TOKEN_NEWLINE:
+                if repeat is not None:
+                    assembler_error("Expected a line to repeat after times!", line, filename)
+                line += 1
+            elif kind == TOKEN_LABEL_END:
+                assembler_error("Expected label name before colon!", line, filename)
+            elif repeat is not None:
+                assembler_error("Expected a line to repeat after times, got " + token_kind_names[kind] + "!", line, filename)
+            continue
 
-    # Find all instructions and assemble them
-    for token in tokens:
-        assembler_dbg("Token: " + str(token))
-        if skip_count > 0:
-            skip_count -= 1
-            token_index += 1
+        if kind == TOKEN_NEWLINE:
+            # End of the line, check the operands and add it
+            if comma_count > 0 and comma_count == operand_count:
+                assembler_error("Expected operand after comma in " + mnemonic_name + "!", line, filename)
+
+            if operand_count == 0 and new_instruction is None:
+                assembler_error("Expected number after " + mnemonic_name + "!", line, filename)
+            if new_instruction is not None and operand_count != len(forms):
+                assembler_error(mnemonic_name + " expects " + str(len(forms)) + " operand(s), got " + str(operand_count) + "!", line, filename)
+            if repeat is not None or mnemonic_name == "resq":
+                # What the whole line puts in the output has to fit in memory
+                if new_instruction is not None:
+                    line_size = 19
+                elif mnemonic_name == "dq":
+                    line_size = 8 * operand_count
+                else:
+                    line_size = 8 * macro_values[0]
+                if repeat is not None:
+                    line_size *= repeat
+                if line_size > MEMORY_SIZE:
+                    assembler_error("Line of " + str(line_size) + " bytes doesn't fit in memory, which is " + str(MEMORY_SIZE) + " bytes!", line, filename)
+
+            if repeat is None and new_instruction is not None:
+                yield ("instruction", new_instruction, 19)
+                current_address += 19
+            elif repeat is None and operand_count == 1 and mnemonic_name == "dq":
+                yield ("data", macro_values[0], 8)
+                current_address += 8
+            else:
+                for item in repeated_items(mnemonic_name, new_instruction, macro_values, 1 if repeat is None else repeat):
+                    if item[0] == "instruction":
+                        for offset, name, relocation_line in line_relocations:
+                            relocations.append((current_address + offset, name, relocation_line))
+                    yield item
+                    current_address += item[2]
+                line_relocations = []
+                repeat = None
+
+            mnemonic_name = None
+            new_instruction = None
+            operand_count = 0
+            comma_count = 0
+            if macro_values:
+                macro_values = []
+            line += 1
             continue
 
-        if token[0] == "identifier":
-            last_identifier = token
-            if token[1] in instruction_names:
-                # Found an instruction
-                assembler_log("Found instruction " + token[1])
-                instruction_name = token[1]
-
-                # Get all the instruction tokens for this instruction
-                instruction_tokens = []
-                local_token_index = token_index + 1
-                new_instruction = liquidcpu_instruction(0, 0, 0, 0, 0)
-                while True:
-                    if tokens[local_token_index][0] == "newline":
-                        break
-                    instruction_tokens.append(tokens[local_token_index])
-                    local_token_index += 1
-                skip_count = len(instruction_tokens)
-
-                # Now that we have the instruction name and all it's tokens, do stuff
-                if instruction_name == "jmp" or instruction_name == "call":
-                    # Jump and call, because they share a similar signature
-                    new_instruction.instruction = get_opcode(instruction_name)
-                    handled_op = False
-                    in_bracket = False
-
-                    # Look for the correct formatting with the jmp instruction
-                    for instruction_token in instruction_tokens:
-                        if instruction_token[0] != "space":
-                            if instruction_token[0] == "identifier":
-                                # Check that we haven't already handled the identifier for this instruction
-                                if handled_op:
-                                    assembler_error("Stray " + instruction_token[0] + " after " + instruction_name, line, filename)
-
-                                # Got the identifier
-                                if any(instruction_token[1] in i for i in labels):
-                                    # It is a label
-                                    label = list(filter(lambda x:instruction_token[1] in x, labels))
-                                    if not in_bracket:
-                                        assembler_log(instruction_name + " using label " + instruction_token[1])
-                                        new_instruction.data1 = label[0][1]
-                                        new_instruction.instruction_flags |= INST_FLAG_DST_CONST
-                                    else:
-                                        assembler_log(instruction_name + " using label mem " + instruction_token[1])
-                                        new_instruction.data1 = label[0][1]
-                                        new_instruction.instruction_flags |= INST_FLAG_DST_MEM_OP
-
-                                    handled_op = True
-                                elif instruction_token[1] in gprs:
-                                    if not in_bracket:
-                                        # It is a GPR
-                                        assembler_log(instruction_name + " using gpr " + instruction_token[1])
-                                        new_instruction.data1 = get_register_index(instruction_token[1])
-                                        new_instruction.instruction_flags |= INST_FLAG_DST_REG
-                                    else:
-                                        assembler_log(instruction_name + " using gpr " + instruction_token[1])
-                                        new_instruction.data1 = get_register_index(instruction_token[1])
-                                        
-                                        # Memory op and register in 1
-                                        new_instruction.instruction_flags |= INST_FLAG_DST_REG | INST_FLAG_DST_MEM_OP
-
-                                    handled_op = True
-                                else:
-                                    assembler_error("Unknown " + instruction_name + " operand " + instruction_token[1], line, filename)
-                            elif instruction_token[0] == "number":
-                                if not in_bracket:
-                                    new_instruction.data1 = instruction_token[1]
-                                    new_instruction.instruction_flags |= INST_FLAG_DST_CONST
-                                    assembler_log(instruction_name + " using const " + str(instruction_token[1]))
-                                else:
-                                    new_instruction.data1 = instruction_token[1]
-                                    new_instruction.instruction_flags |= INST_FLAG_DST_MEM_OP
-                                    assembler_log(instruction_name + " using const mem " + str(instruction_token[1]))
-
-                                handled_op = True
-                            elif instruction_token[0] == "bracket_open":
-                                in_bracket = True
-                                if handled_op:
-                                    assembler_error("Stray open bracket!", line, filename)
-                            elif instruction_token[0] == "bracket_close":
-                                in_bracket = False
-                            else:
-                                if not handled_op:
-                                    assembler_error("Expected identifier, number, or bracket after " + instruction_name + ", got " + instruction_token[0], line, filename)
-                                else:
-                                    assembler_error("Stray " + instruction_token[0] + " after " + instruction_name, line, filename)
-
-                elif instruction_name == "push":
-                    # Push
-                    new_instruction.instruction = get_opcode(instruction_name)
-                    handled_op = False
-                    in_bracket = False
-
-                    # Look for the correct formatting with the jmp instruction
-                    for instruction_token in instruction_tokens:
-                        if instruction_token[0] != "space":
-                            if instruction_token[0] == "identifier":
-                                # Check that we haven't already handled the identifier for this instruction
-                                if handled_op:
-                                    assembler_error("Stray " + instruction_token[0] + " after " + instruction_name, line, filename)
-
-                                # Got the identifier
-                                if any(instruction_token[1] in i for i in labels):
-                                    # It is a label
-                                    label = list(filter(lambda x:instruction_token[1] in x, labels))
-                                    if not in_bracket:
-                                        assembler_log(instruction_name + " using label " + instruction_token[1])
-                                        new_instruction.data1 = label[0][1]
-                                        new_instruction.instruction_flags |= INST_FLAG_DST_CONST
-                                    else:
-                                        assembler_log(instruction_name + " using label mem " + instruction_token[1])
-                                        new_instruction.data1 = label[0][1]
-                                        new_instruction.instruction_flags |= INST_FLAG_DST_MEM_OP
-                                elif instruction_token[1] in gprs:
-                                    # It is a GPR
-                                    if not in_bracket:
-                                        # Not memory operand
-                                        assembler_log(instruction_name + " using gpr " + instruction_token[1])
-                                        new_instruction.data1 = get_register_index(instruction_token[1])
-                                        new_instruction.instruction_flags |= INST_FLAG_DST_REG
-                                    else:
-                                        # Memory operand
-                                        assembler_log(instruction_name + " using gpr mem " + instruction_token[1])
-                                        new_instruction.data1 = get_register_index(instruction_token[1])
-                                        new_instruction.instruction_flags |= INST_FLAG_DST_REG | INST_FLAG_DST_MEM_OP
-
-                                    handled_op = True
-                                else:
-                                    assembler_error("Unknown " + instruction_name + " operand " + instruction_token[1], line, filename)
-                            elif instruction_token[0] == "number":
-                                # Not memory operand
-                                if not in_bracket:
-                                    new_instruction.data1 = instruction_token[1]
-                                    new_instruction.instruction_flags |= INST_FLAG_DST_CONST
-                                    assembler_log(instruction_name + " using const " + str(instruction_token[1]))
-                                # Is memory operand
-                                else:
-                                    new_instruction.data1 = instruction_token[1]
-                                    new_instruction.instruction_flags |= INST_FLAG_DST_MEM_OP
-                                    assembler_log(instruction_name + " using const mem " + str(instruction_token[1]))
-
-                                handled_op = True
-                            elif instruction_token[0] == "bracket_open":
-                                in_bracket = True
-                                if handled_op:
-                                    assembler_error("Stray open bracket!", line, filename)
-                            elif instruction_token[0] == "bracket_close":
-                                in_bracket = False
-                            else:
-                                if not handled_op:
-                                    assembler_error("Expected identifier or number after " + instruction_name + ", got " + instruction_token[0], line, filename)
-                                else:
-                                    assembler_error("Stray " + instruction_token[0] + " after " + instruction_name, line, filename)
-
-                elif instruction_name == "pop":
-                    # Pop
-                    new_instruction.instruction = get_opcode(instruction_name)
-                    handled_op = False
-                    in_bracket = False
-
-                    # Look for the correct formatting with the jmp instruction
-                    for instruction_token in instruction_tokens:
-                        if instruction_token[0] != "space":
-                            if instruction_token[0] == "identifier":
-                                # Check that we haven't already handled the identifier for this instruction
-                                if handled_op:
-                                    assembler_error("Stray " + instruction_token[0] + " after " + instruction_name, line, filename)
-
-                                # Got the identifier
-                                if any(instruction_token[1] in i for i in labels):
-                                    # It is a label
-                                    label = list(filter(lambda x:instruction_token[1] in x, labels))
-                                    if not in_bracket:
-                                        assembler_error("Cannot pop into a constant label address!", line, filename)
-                                    else:
-                                        assembler_log(instruction_name + " using label mem " + instruction_token[1])
-                                        new_instruction.data1 = label[0][1]
-                                        new_instruction.instruction_flags |= INST_FLAG_DST_MEM_OP
-                                elif instruction_token[1] in gprs:
-                                    # It is a GPR
-
-                                    # Is memory operand
-                                    if not in_bracket:
-                                        assembler_log(instruction_name + " using gpr " + instruction_token[1])
-                                        new_instruction.data1 = get_register_index(instruction_token[1])
-                                        new_instruction.instruction_flags |= INST_FLAG_DST_REG
-                                    # Is not memory operand
-                                    else:
-                                        assembler_log(instruction_name + " using gpr mem " + instruction_token[1])
-                                        new_instruction.data1 = get_register_index(instruction_token[1])
-                                        new_instruction.instruction_flags |= INST_FLAG_DST_REG | INST_FLAG_DST_MEM_OP
-
-                                    handled_op = True
-                                else:
-                                    assembler_error("Unknown " + instruction_name + " operand " + instruction_token[1], line, filename)
-                            elif instruction_token[0] == "number":
-                                # Cannot pop into constants lol
-                                if not in_bracket:
-                                    assembler_error("Cannot pop into constant!", line, filename)
-                                # Memory addr constant
-                                else:
-                                    assembler_log(instruction_name + " using mem const " + str(instruction_token[1]))
-                                    new_instruction.data1 = get_register_index(instruction_token[1])
-                                    new_instruction.instruction_flags |= INST_FLAG_DST_MEM_OP
-
-                            elif instruction_token[0] == "bracket_open":
-                                in_bracket = True
-                                if handled_op:
-                                    assembler_error("Stray open bracket!", line, filename)
-                            elif instruction_token[0] == "bracket_close":
-                                in_bracket = False
-                            else:
-                                if not handled_op:
-                                    assembler_error("Expected identifier after " + instruction_name + ", got " + instruction_token[0], line, filename)
-                                else:
-                                    assembler_error("Stray " + instruction_token[0] + " after " + instruction_name, line, filename)
-
-                elif instruction_name == "hlt":
-                    # Halt
-                    if len(instruction_tokens) != 0:
-                        assembler_error("Stray " + instruction_tokens[0][0] + " after " + instruction_name, line, filename)
-                    new_instruction.instruction = get_opcode(instruction_name)
-
-                elif instruction_name == "nop":
-                    # Halt
-                    if len(instruction_tokens) != 0:
-                        assembler_error("Stray " + instruction_tokens[0][0] + " after " + instruction_name, line, filename)
-                    new_instruction.instruction = get_opcode(instruction_name)
-
-                elif instruction_name == "ret":
-                    # Return
-                    if len(instruction_tokens) != 0:
-                        assembler_error("Stray " + instruction_tokens[0][0] + " after " + instruction_name, line, filename)
-                    new_instruction.instruction = get_opcode(instruction_name)
-
-                elif instruction_name == "inc" or instruction_name == "dec":
-                    # Increment
-                    new_instruction.instruction = get_opcode(instruction_name)
-                    handled_op = False
-                    in_bracket = False
-
-                    # Look for the correct formatting with the jmp instruction
-                    for instruction_token in instruction_tokens:
-                        if instruction_token[0] != "space":
-                            if instruction_token[0] != "identifier":
-                                if not handled_op:
-                                    assembler_error("Expected identifier after " + instruction_name + ", got " + instruction_token[0], line, filename)
-                                else:
-                                    assembler_error("Stray " + instruction_token[0] + " after " + instruction_name, line, filename)
-                            if handled_op:
-                                assembler_error("Stray " + instruction_token[0] + " after " + instruction_name, line, filename)
-
-                            # Got the identifier
-
-                            if any(instruction_token[1] in i for i in labels):
-                                    # It is a label
-                                    label = list(filter(lambda x:instruction_token[1] in x, labels))
-                                    if not in_bracket:
-                                        assembler_error("Cannot " + instruction_name + " into a constant label address!", line, filename)
-                                    else:
-                                        assembler_log(instruction_name + " using label mem " + instruction_token[1])
-                                        new_instruction.data1 = label[0][1]
-                                        new_instruction.instruction_flags |= INST_FLAG_DST_MEM_OP
-                            elif instruction_token[1] in gprs:
-                                # Found GPR
-                                if not in_bracket:
-                                    new_instruction.data1 = get_register_index(instruction_token[1])
-                                    new_instruction.instruction_flags |= INST_FLAG_DST_REG
-                                else:
-                                    new_instruction.data1 = get_register_index(instruction_token[1])
-                                    new_instruction.instruction_flags |= INST_FLAG_DST_REG | INST_FLAG_DST_MEM_OP
-
-                                handled_op = True
-                            elif instruction_token[0] == "number":
-                                if not in_bracket:
-                                    assembler_error("Cannot use " + instruction_name + " on a constant!", line, filename)
-                                else:
-                                    assembler_log(instruction_name + " using mem const " + str(instruction_token[1]))
-                                    new_instruction.data1 = get_register_index(instruction_token[1])
-                                    new_instruction.instruction_flags |= INST_FLAG_DST_MEM_OP
-
-                            elif instruction_token[0] == "bracket_open":
-                                in_bracket = True
-                                if handled_op:
-                                    assembler_error("Stray open bracket!", line, filename)
-                            elif instruction_token[0] == "bracket_close":
-                                in_bracket = False
-                            else:
-                                assembler_error("Unknown " + instruction_name + " operand " + instruction_token[1], line, filename)
-
-                elif instruction_name == "mov":
-                    # Jump and call, because they share a similar signature
-                    new_instruction.instruction = get_opcode(instruction_name)
-                    handled_operands = 0
-                    handled_comma = False
-                    in_bracket = False
-
-                    # Look for the correct formatting with the jmp instruction
-                    for instruction_token in instruction_tokens:
-                        if instruction_token[0] != "space":
-                            if instruction_token[0] == "identifier":
-                                # Check that we haven't already handled the identifiers for this instruction
-                                if handled_operands == 2:
-                                    assembler_error("Stray " + instruction_token[0] + " after " + instruction_name, line, filename)
-
-                                # Got the identifier
-                                if any(instruction_token[1] in i for i in labels):
-                                    # It is a label
-                                    label = list(filter(lambda x:instruction_token[1] in x, labels))
-                                    if not in_bracket:
-                                        if handled_operands == 0:
-                                            assembler_error("Cannot " + instruction_name + " into a constant label address!", line, filename)
-
-                                        elif handled_operands == 1:
-                                            if not handled_comma:
-                                                assembler_error("Missing comma for operand 2 of " + instruction_name + "!", line, filename)
-                                            assembler_log(instruction_name + " using label mem " + instruction_token[1])
-                                            new_instruction.data2 = label[0][1]
-                                            new_instruction.instruction_flags |= INST_FLAG_SRC_CONST
-                                    else:
-                                        if handled_operands == 0:
-                                            assembler_log(instruction_name + " using label mem " + instruction_token[1])
-                                            new_instruction.data1 = label[0][1]
-                                            new_instruction.instruction_flags |= INST_FLAG_DST_MEM_OP
-
-                                        elif handled_operands == 1:
-                                            if not handled_comma:
-                                                assembler_error("Missing comma for operand 2 of " + instruction_name + "!", line, filename)
-
-                                            assembler_log(instruction_name + " using label mem " + instruction_token[1])
-                                            new_instruction.data2 = label[0][1]
-                                            new_instruction.instruction_flags |= INST_FLAG_SRC_MEM_OP
-                                elif instruction_token[1] in gprs:
-                                    # It is a GPR
-
-                                    if not in_bracket:
-                                        if handled_operands == 0:
-                                            assembler_log(instruction_name + " using gpr " + instruction_token[1])
-                                            new_instruction.data1 = get_register_index(instruction_token[1])
-                                            new_instruction.instruction_flags |= INST_FLAG_DST_REG
-                                        elif handled_operands == 1:
-                                            if not handled_comma:
-                                                assembler_error("Missing comma for operand 2 of " + instruction_name + "!", line, filename)
-
-                                            assembler_log(instruction_name + " using gpr " + instruction_token[1])
-                                            new_instruction.data2 = get_register_index(instruction_token[1])
-                                            new_instruction.instruction_flags |= INST_FLAG_SRC_REG
-                                    else:
-                                        if handled_operands == 0:
-                                            assembler_log(instruction_name + " using gpr " + instruction_token[1])
-                                            new_instruction.data1 = get_register_index(instruction_token[1])
-                                            new_instruction.instruction_flags |= INST_FLAG_DST_REG | INST_FLAG_DST_MEM_OP
-                                        elif handled_operands == 1:
-                                            if not handled_comma:
-                                                assembler_error("Missing comma for operand 2 of " + instruction_name + "!", line, filename)
-
-                                            assembler_log(instruction_name + " using gpr " + instruction_token[1])
-                                            new_instruction.data2 = get_register_index(instruction_token[1])
-                                            new_instruction.instruction_flags |= INST_FLAG_SRC_REG | INST_FLAG_DST_MEM_OP
-
-                                    handled_operands += 1
-                                else:
-                                    assembler_error("Unknown " + instruction_name + " operand " + instruction_token[1], line, filename)
-                            elif instruction_token[0] == "number":
-                                if handled_operands >= 2:
-                                    assembler_error("Stray " + instruction_token[0] + " after " + instruction_name + "!", line, filename)
-
-                                if not in_bracket:
-                                    if handled_operands == 0:
-                                        assembler_error(instruction_name + " cannot have constant destination!", line, filename)
-                                    elif handled_operands == 1:
-                                        if not handled_comma:
-                                            assembler_error("Missing comma for operand 2 of " + instruction_name + "!", line, filename)
-
-                                        new_instruction.data2 = instruction_token[1]
-                                        new_instruction.instruction_flags |= INST_FLAG_SRC_CONST
-                                        assembler_log(instruction_name + " using const " + str(instruction_token[1]))
-
-                                        handled_operands += 1
-
-                                else:
-                                    if handled_operands == 0:
-                                        new_instruction.data1 = instruction_token[1]
-                                        new_instruction.instruction_flags |= INST_FLAG_DST_MEM_OP
-                                        assembler_log(instruction_name + " using const mem " + str(instruction_token[1]))
-
-                                        handled_operands += 1
-                                    elif handled_operands == 1:
-                                        if not handled_comma:
-                                            assembler_error("Missing comma for operand 2 of " + instruction_name + "!", line, filename)
-
-                                        new_instruction.data2 = instruction_token[1]
-                                        new_instruction.instruction_flags |= INST_FLAG_SRC_MEM_OP
-                                        assembler_log(instruction_name + " using const mem " + str(instruction_token[1]))
-
-                                        handled_operands += 1
-
-                            elif instruction_token[0] == "param_sep":
-                                # Comma
-                                if handled_comma:
-                                    assembler_error("Stray comma after " + instruction_name + "!", line, filename)
-                                handled_comma = True
-
-                            elif instruction_token[0] == "bracket_open":
-                                # If we dont have a comma yet
-                                if handled_operands == 1 and not handled_comma:
-                                    assembler_error("Missing comma for operand 2 of " + instruction_name + "!", line, filename)
-                                in_bracket = True
-
-                                # If we already handled the operands
-                                if handled_operands == 2:
-                                    assembler_error("Stray open bracket!", line, filename)
-                            elif instruction_token[0] == "bracket_close":
-                                in_bracket = False
-                            else:
-                                if handled_op != 2:
-                                    assembler_error("Expected identifier after " + instruction_name + ", got " + instruction_token[0], line, filename)
-                                else:
-                                    assembler_error("Stray " + instruction_token[0] + " after " + instruction_name, line, filename)
-                    if handled_operands > 2:
-                        assembler_error("Handled operands is > 2!", line, filename)
-                ### Parsed instruction ###
+        if kind == TOKEN_IDENTIFIER or kind == TOKEN_NUMBER:
+            # Operands have to be separated by commas
+            if operand_count > comma_count:
+                if new_instruction is None or operand_count == len(forms):
+                    assembler_error("Stray " + token_kind_names[kind] + " after " + mnemonic_name + "!", line, filename)
+                assembler_error("Missing comma for operand " + str(operand_count + 1) + " of " + mnemonic_name + "!", line, filename)
+
+            if new_instruction is None:
+                # Macros only take numbers
+                if kind != TOKEN_NUMBER:
+                    assembler_error("Expected number, got " + token_kind_names[kind] + "!", line, filename)
+                if mnemonic_name == "times":
+                    # The rest of the line is what gets repeated, its size
+                    # is checked once the line is done
+                    repeat = token_value
+                    mnemonic_name = None
+                    continue
+                if token_value >= (1<<64):
+                    assembler_error("Number " + str(token_value) + " doesn't fit in 64 bits!", line, filename)
+                macro_values.append(token_value)
+                operand_count += 1
+                continue
+
+            if operand_count == len(forms):
+                assembler_error("Stray " + token_kind_names[kind] + " after " + mnemonic_name + "!", line, filename)
+
+            if kind == TOKEN_NUMBER:
+                if token_value >= (1<<64):
+                    assembler_error("Number " + str(token_value) + " doesn't fit in 64 bits!", line, filename)
+                form = "const"
+                value = token_value
+            elif token_value in labels:
+                form = "const"
+                value = labels.resolve(token_value)
+                if relocate_defined:
+                    if repeat is None:
+                        relocations.append((current_address + operand_offsets[operand_count], token_value, line))
+                    else:
+                        line_relocations.append((operand_offsets[operand_count], token_value, line))
+            elif token_value in gpr_indexes:
+                form = "reg"
+                value = get_register_index(token_value)
+            elif is_register_like(token_value):
+                if token_value in visible_regs:
+                    assembler_error("Register " + token_value + " can't be used as an operand, only r0 to r7 can!", line, filename)
+                assembler_error("Unknown register " + token_value + ", there are only r0 to r7!", line, filename)
+            else:
+                # Not defined in this file, so it has to come from another one
+                if logging:
+                    assembler_log(mnemonic_name, " using external label ", token_value)
+                form = "const"
+                value = 0
+                if repeat is None:
+                    relocations.append((current_address + operand_offsets[operand_count], token_value, line))
+                else:
+                    line_relocations.append((operand_offsets[operand_count], token_value, line))
 
-                # Increment by instruction size
-                current_address += 19
-                
-                #Add instruction
-                ret_instructions.append(("instruction", new_instruction, 19))
-
-            elif token[1] in assembler_macros:
-                mnemonic_name = token[1]
-                # Get all the instruction tokens for this instruction
-                mnemonic_tokens = []
-                local_token_index = token_index + 1
-                while True:
-                    if tokens[local_token_index][0] == "newline":
-                        break
-                    mnemonic_tokens.append(tokens[local_token_index])
-                    local_token_index += 1
-                skip_count = len(mnemonic_tokens)
-
-                if mnemonic_name == "dq":
-                    handled_op = False
-
-                    for mnemonic_token in mnemonic_tokens:
-                        if mnemonic_token[0] != "space":
-                            if mnemonic_token[0] != "number":
-                                assembler_error("Expected number, got " + mnemonic_token[0] + "!", line, filename)
-                            if handled_op:
-                                assembler_error("Stray " + mnemonic_token[0] + " after " + mnemonic_name + "!", line, filename)
-                            # Is a number
-                            data_to_add = mnemonic_token[1]
-                            ret_instructions.append(("data", data_to_add, 8))
-                            current_address += 8 # Add the dq size to the current address
-                            handled_op = True
+            if in_bracket:
+                form = "[" + form + "]"
+                bracket_operands += 1
+
+            flags = forms[operand_count].get(form)
+            if flags is None:
+                assembler_error("Cannot use " + form + " " + str(token_value) + " as the " + operand_names[operand_count] + " of " + mnemonic_name + "!", line, filename)
 
+            new_instruction.instruction_flags |= flags
+            if operand_count == 0:
+                new_instruction.data1 = value
             else:
-                if token_index + 1 < len(tokens):
-                    if tokens[token_index + 1][0] == "label_end":
-                        # Its a label
-                        assembler_log("Found label " + token[1])
-                    else:
-                        assembler_error("Invalid instruction mnemonic " + token[1], line, filename)
+                new_instruction.data2 = value
+
+            if logging:
+                assembler_log(mnemonic_name, " using ", form, " ", token_value)
+            operand_count += 1
+
+        elif kind == TOKEN_PARAM_SEP:
+            # dq is the only macro with more than one operand
+            if in_bracket or operand_count == comma_count:
+                assembler_error("Stray comma after " + mnemonic_name + "!", line, filename)
+            if (new_instruction is None and mnemonic_name != "dq") or (new_instruction is not None and operand_count == len(forms)):
+                assembler_error("Stray comma after " + mnemonic_name + "!", line, filename)
+            comma_count += 1
+
+        elif kind == TOKEN_BRACKET_OPEN:
+            if new_instruction is None or operand_count == len(forms):
+                assembler_error("Stray open bracket!", line, filename)
+            if operand_count > comma_count:
+                assembler_error("Missing comma for operand " + str(operand_count + 1) + " of " + mnemonic_name + "!", line, filename)
+            in_bracket = True
+            bracket_operands = 0
+
+        elif kind == TOKEN_BRACKET_CLOSE:
+            if bracket_operands == 0:
+                assembler_error("Expected operand inside brackets!", line, filename)
+            in_bracket = False
+
+        else:
+            assembler_error("Stray " + token_kind_names[kind] + " after " + mnemonic_name + "!", line, filename)
+
+class liquidcpu_fixup_list:
+    # Label uses that were not known yet when streaming, kept as flat arrays
+    # (8 byte offset, 4 byte name index and 4 byte line each) so that even
+    # millions of them stay small. Label names are stored once.
+    def __init__(self):
+        self.names = []
+        self.name_indexes = {}
+        self.offsets = array("Q")
+        self.name_ids = array("I")
+        self.lines = array("I")
+
+    def append(self, relocation):
+        offset, name, line = relocation
+        name_id = self.name_indexes.get(name)
+        if name_id is None:
+            name_id = len(self.names)
+            self.name_indexes[name] = name_id
+            self.names.append(name)
+
+        self.offsets.append(offset)
+        self.name_ids.append(name_id)
+        self.lines.append(line)
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def check(self, labels, filename):
+        # Raises for the first fixup of a label that was never defined
+        undefined = set([name_id for name_id, name in enumerate(self.names) if name not in labels])
+        if not undefined:
+            return
+        for name_id, line in zip(self.name_ids, self.lines):
+            if name_id in undefined:
+                assembler_error("Undefined label " + self.names[name_id], line, filename)
+
+    def resolve(self, labels, filename):
+        # (offset, address) for every fixup, once all the labels are known
+        addresses = [labels.addresses.get(name) for name in self.names]
+        for offset, name_id, line in zip(self.offsets, self.name_ids, self.lines):
+            address = addresses[name_id]
+            if address is None:
+                assembler_error("Undefined label " + self.names[name_id], line, filename)
+            yield offset, address
+
+# Size of the chunks a stream yields
+stream_chunk_size = 64 * 1024
+
+class liquidcpu_stream:
+    # Assembles lines of source into chunks of output without holding more
+    # than a chunk of it. Labels named like registers have to be defined
+    # before they are used here.
+    #
+    # Iterating yields the chunks. Labels used before they are defined are
+    # written as 0 in them, so the chunks alone are not the finished output:
+    # once the iteration is done (which raises liquidcpu_assembler_error for
+    # labels that were never defined), patches() yields the (offset, address)
+    # of every one of those fields, and labels and fixups hold the rest.
+    # write_stream does all of this for a seekable file. A stream can only be
+    # iterated once.
+    def __init__(self, lines, filename="<stream>"):
+        self.lines = lines
+        self.filename = filename
+        self.labels = liquidcpu_symbol_table()
+        self.fixups = liquidcpu_fixup_list()
+        self.size = 0
+        self.started = False
+        self.done = False
+
+    def __iter__(self):
+        if self.started:
+            raise ValueError("a stream can only be iterated once")
+        self.started = True
+
+        items = []
+        size = 0
+        for item in encode_stream(tokenize_lines(self.lines, self.filename), self.labels, self.filename, self.fixups, True, False):
+            items.append(item)
+            size += item[2]
+            if size >= stream_chunk_size:
+                self.size += size
+                yield bytes(emit_buffer(items, size))
+                items = []
+                size = 0
+
+        if items:
+            self.size += size
+            yield bytes(emit_buffer(items, size))
+
+        self.fixups.check(self.labels, self.filename)
+        self.done = True
+        assembler_log("Streamed ", len(self.labels), " labels with ", len(self.fixups), " fixups")
+
+    def patches(self):
+        if not self.done:
+            raise ValueError("the stream has to be iterated to the end before patching")
+        return self.fixups.resolve(self.labels, self.filename)
+
+def assemble_stream(lines, filename="<stream>"):
+    # See liquidcpu_stream
+    return liquidcpu_stream(lines, filename)
+
+def write_stream(lines, fp, filename="<stream>"):
+    # Writes the streamed output to a seekable file, then goes back to patch
+    # the fixups
+    start = fp.tell()
+    stream = assemble_stream(lines, filename)
+    for chunk in stream:
+        fp.write(chunk)
+
+    end = fp.tell()
+    for offset, address in stream.patches():
+        fp.seek(start + offset)
+        fp.write(data_struct.pack(address))
+    fp.seek(end)
+    return end - start
+
+# Peephole optimizer, run on the encoded items of a file with -O. It assumes
+# code addresses only ever come from labels: jumps to fixed addresses turn
+# it off, and code that is read or written as data may break.
+
+opcode_nop  = instruction_opcodes["nop"]
+opcode_mov  = instruction_opcodes["mov"]
+opcode_hlt  = instruction_opcodes["hlt"]
+opcode_jmp  = instruction_opcodes["jmp"]
+opcode_inc  = instruction_opcodes["inc"]
+opcode_dec  = instruction_opcodes["dec"]
+opcode_push = instruction_opcodes["push"]
+opcode_call = instruction_opcodes["call"]
+opcode_ret  = instruction_opcodes["ret"]
+
+# Nothing after these runs unless it is jumped to
+terminator_opcodes = frozenset([opcode_hlt, opcode_jmp, opcode_ret])
+inc_dec_pairs = {opcode_inc: opcode_dec, opcode_dec: opcode_inc}
+
+def operand_label_table(instructions, relocations):
+    # Item index of every address, and the (name, line) of the label used by
+    # each operand of each item, from the relocations. Only works on items in
+    # the fixed layout.
+    address = 0
+    index_of = {}
+    for index, item in enumerate(instructions):
+        index_of[address] = index
+        address += item[2]
+    index_of[address] = len(instructions)
+
+    operand_labels = [None] * len(instructions)
+    for offset, name, line in relocations:
+        if offset - operand_offsets[0] in index_of:
+            index, slot = index_of[offset - operand_offsets[0]], 0
+        else:
+            index, slot = index_of[offset - operand_offsets[1]], 1
+        if operand_labels[index] is None:
+            operand_labels[index] = [None, None]
+        operand_labels[index][slot] = (name, line)
+
+    return index_of, operand_labels
+
+def optimize_instructions(instructions, labels, relocations, filename):
+    # Returns the new items and relocations, and how many instructions were
+    # removed. The label addresses are updated in place.
+    index_of, operand_labels = operand_label_table(instructions, relocations)
+
+    for index, item in enumerate(instructions):
+        if item[0] == "instruction" and item[1].instruction in (opcode_jmp, opcode_call):
+            if item[1].instruction_flags & INST_FLAG_DST_CONST and (operand_labels[index] is None or operand_labels[index][0] is None):
+                assembler_warning("not optimizing " + filename + ", it has a " + instruction_names[item[1].instruction] + " to a fixed address")
+                return instructions, relocations, 0
+
+    label_indexes = {name: index_of[address] for name, address in labels.addresses.items()}
+    live = [True] * len(instructions)
+
+    def next_live(index):
+        while index < len(instructions) and not live[index]:
+            index += 1
+        return index
+
+    def opcode_at(index):
+        if index < len(instructions) and instructions[index][0] == "instruction":
+            return instructions[index][1].instruction
+        return None
+
+    def direct_jump_target(index):
+        # Label of a jmp to a label in this file, or None
+        if opcode_at(index) != opcode_jmp or instructions[index][1].instruction_flags != INST_FLAG_DST_CONST:
+            return None
+        name = operand_labels[index][0][0]
+        if name not in label_indexes:
+            return None
+        return name
+
+    changed = True
+    while changed:
+        changed = False
+        # Where the labels point once what was removed so far is gone, a
+        # label on a removed nop points at the next item that's left. Within
+        # a pass a label can only move up to code that was already looked at.
+        targets = set([next_live(index) for index in label_indexes.values()])
+        for index in range(len(instructions)):
+            if not live[index] or instructions[index][0] != "instruction":
+                continue
+            instruction = instructions[index][1]
+            opcode = instruction.instruction
+
+            if opcode == opcode_nop:
+                live[index] = False
+                changed = True
+                continue
+
+            following = next_live(index + 1)
+
+            if opcode in (opcode_jmp, opcode_call) and instruction.instruction_flags == INST_FLAG_DST_CONST:
+                # Jump straight to the end of a chain of jmps
+                name, line = operand_labels[index][0]
+                seen = set()
+                while name in label_indexes and name not in seen:
+                    seen.add(name)
+                    target = direct_jump_target(next_live(label_indexes[name]))
+                    if target is None:
+                        break
+                    name = target
+                if name != operand_labels[index][0][0]:
+                    operand_labels[index][0] = (name, line)
+                    changed = True
+
+                # A jmp to the next instruction does nothing
+                if opcode == opcode_jmp and name in label_indexes and next_live(label_indexes[name]) == following:
+                    live[index] = False
+                    changed = True
+                    continue
+
+            if opcode == opcode_call and opcode_at(following) == opcode_ret:
+                # call X; ret returns to the same place as jmp X
+                instruction.instruction = opcode_jmp
+                opcode = opcode_jmp
+                changed = True
+
+            if opcode in inc_dec_pairs and opcode_at(following) == inc_dec_pairs[opcode] and following not in targets:
+                other = instructions[following][1]
+                if other.instruction_flags == instruction.instruction_flags and other.data1 == instruction.data1 and operand_labels[following] == operand_labels[index]:
+                    live[index] = False
+                    live[following] = False
+                    changed = True
+                    continue
+
+            if opcode in terminator_opcodes:
+                # Drop the code after it, up to the next label. Data stays.
+                while following < len(instructions) and following not in targets:
+                    if instructions[following][0] == "instruction":
+                        live[following] = False
+                        changed = True
+                    following = next_live(following + 1)
+
+    # Lay out what's left and move the labels along with it
+    new_instructions = []
+    new_addresses = []
+    address = 0
+    for index, item in enumerate(instructions):
+        new_addresses.append(address)
+        if live[index]:
+            new_instructions.append(item)
+            address += item[2]
+    new_addresses.append(address)
+
+    for name, index in label_indexes.items():
+        labels.addresses[name] = new_addresses[index]
+
+    new_relocations = []
+    for index, item in enumerate(instructions):
+        if not live[index] or operand_labels[index] is None:
+            continue
+        for slot in range(2):
+            if operand_labels[index][slot] is None:
+                continue
+            name, line = operand_labels[index][slot]
+            value = labels.addresses.get(name, 0)
+            if slot == 0:
+                item[1].data1 = value
+            else:
+                item[1].data2 = value
+            new_relocations.append((new_addresses[index] + operand_offsets[slot], name, line))
+
+    saved = sum([1 for item in instructions if item[0] == "instruction"]) - sum([1 for item in new_instructions if item[0] == "instruction"])
+    return new_instructions, new_relocations, saved
+
+# Image shrinking (--shrink), run on the items of every file at once, after
+# labels are found and before linking. The items from one label up to the
+# next are a region. A region is kept if it holds address 0, if a kept
+# region uses one of its labels, or if a kept region runs into it. Of the
+# kept regions that are a single dq only ever read through [label], and
+# never run as code, the ones with the same value share one copy. Like -O,
+# this assumes addresses only come from labels.
+
+def operand_is_load(instruction, slot):
+    # Whether the operand in slot only reads the memory it points at
+    flags = instruction.instruction_flags
+    if slot == 1:
+        return instruction.instruction == opcode_mov and flags & INST_FLAG_SRC_MEM_OP and not flags & INST_FLAG_SRC_REG
+    return instruction.instruction in (opcode_push, opcode_jmp, opcode_call) and flags & INST_FLAG_DST_MEM_OP and not flags & INST_FLAG_DST_REG
+
+def fixed_address_use(instruction, slot, image_end):
+    # Description of an operand that is an address inside the image written
+    # as a number, which moving things around would break
+    flags = instruction.instruction_flags
+    if slot == 0:
+        const, mem_op, reg, value = INST_FLAG_DST_CONST, INST_FLAG_DST_MEM_OP, INST_FLAG_DST_REG, instruction.data1
+    else:
+        const, mem_op, reg, value = INST_FLAG_SRC_CONST, INST_FLAG_SRC_MEM_OP, INST_FLAG_SRC_REG, instruction.data2
+    if slot == 0 and instruction.instruction in (opcode_jmp, opcode_call) and flags & const and not flags & mem_op:
+        return "a " + instruction_names[instruction.instruction] + " to a fixed address"
+    if flags & mem_op and not flags & reg and value < image_end:
+        return "a load or store at the fixed address " + hex(value)
+    return None
+
+def shrink_program(files, entry=None):
+    # files holds [filename, items, labels, relocations] for every file, in
+    # link order. The items and relocations are replaced and the labels
+    # updated in place. entry is the label a --sectioned file starts at, if
+    # not 0. Returns the bytes saved, and the regions dropped and constants
+    # pooled.
+    image_end = sum([image_size(items) for filename, items, labels, relocations in files])
+
+    # Regions in image order, as [file index, first item, end item, labels]
+    regions = []
+    local_regions = {}
+    global_regions = {}
+    tables = []
+    for file_index, (filename, items, labels, relocations) in enumerate(files):
+        index_of, operand_labels = operand_label_table(items, relocations)
+        tables.append(operand_labels)
+
+        for index, item in enumerate(items):
+            if item[0] != "instruction":
+                continue
+            for slot in range(2):
+                if operand_labels[index] is not None and operand_labels[index][slot] is not None:
+                    continue
+                use = fixed_address_use(item[1], slot, image_end)
+                if use is not None:
+                    assembler_warning("not shrinking, " + filename + " has " + use)
+                    return 0, 0, 0
+
+        starts = {}
+        for name, address in labels.addresses.items():
+            starts.setdefault(index_of[address], []).append(name)
+        bounds = sorted(set([0] + list(starts)))
+        for position, first in enumerate(bounds):
+            end = bounds[position + 1] if position + 1 < len(bounds) else len(items)
+            names = starts.get(first, [])
+            for name in names:
+                local_regions[(file_index, name)] = len(regions)
+                global_regions.setdefault(name, []).append(len(regions))
+            regions.append([file_index, first, end, names])
+
+    def resolve(file_index, name):
+        # Region a label used in a file points at, like link_objects finds it
+        if (file_index, name) in local_regions:
+            return local_regions[(file_index, name)]
+        if len(global_regions.get(name, ())) == 1:
+            return global_regions[name][0]
+        return None
+
+    def uses(region):
+        file_index, first, end, names = regions[region]
+        items = files[file_index][1]
+        operand_labels = tables[file_index]
+        for index in range(first, end):
+            if operand_labels[index] is None:
+                continue
+            for slot in range(2):
+                if operand_labels[index][slot] is not None:
+                    yield index, slot, items[index][1], operand_labels[index][slot][0]
+
+    # Everything reachable from address 0 and the entry. A region can be
+    # reached as code, from address 0 or the entry, a jump, a label used as a number or by running into
+    # it, or only as data, through [label]. Regions that run as code run
+    # into the next one unless they end with a jmp, ret or hlt, as data they
+    # only do if they end with some other instruction or are empty.
+    reached = [None] * len(regions)
+    pending = [(0, True)]
+    if entry in global_regions:
+        # The first file that defines it, like entry_address finds it
+        pending.append((global_regions[entry][0], True))
+    while pending:
+        region, as_code = pending.pop()
+        if reached[region] is not None and (reached[region] or not as_code):
+            continue
+        reached[region] = as_code
+        for index, slot, instruction, name in uses(region):
+            target = resolve(regions[region][0], name)
+            if target is not None:
+                mem_op = INST_FLAG_DST_MEM_OP if slot == 0 else INST_FLAG_SRC_MEM_OP
+                pending.append((target, not instruction.instruction_flags & mem_op))
+
+        file_index, first, end, names = regions[region]
+        last = files[file_index][1][end - 1] if end > first else None
+        if last is None:
+            runs_on = True
+        elif last[0] == "instruction":
+            runs_on = last[1].instruction not in terminator_opcodes
+        else:
+            runs_on = as_code
+        if runs_on and region + 1 < len(regions):
+            pending.append((region + 1, as_code))
+    live = [as_code is not None for as_code in reached]
+
+    # Which kept regions are only read, and the files their labels are used from
+    read_only = [True] * len(regions)
+    used_from = [set() for region in regions]
+    for region in range(len(regions)):
+        if not live[region]:
+            continue
+        for index, slot, instruction, name in uses(region):
+            target = resolve(regions[region][0], name)
+            if target is not None:
+                used_from[target].add(regions[region][0])
+                if not operand_is_load(instruction, slot):
+                    read_only[target] = False
+
+    # Pool the constants. A copy is only dropped if the label of the one
+    # kept finds it from every file that used the dropped one.
+    pooled = {}
+    kept_constants = {}
+    for region, (file_index, first, end, names) in enumerate(regions):
+        if reached[region] is not False or not read_only[region] or not names or end - first != 1:
+            continue
+        item = files[file_index][1][first]
+        if item[0] != "data" or not isinstance(item[1], int):
+            continue
+        kept = kept_constants.setdefault(item[1], region)
+        if kept != region and all([resolve(user, regions[kept][3][0]) == kept for user in used_from[region]]):
+            pooled[region] = kept
+
+    # Lay out what's left and move the labels along with it
+    for region, (file_index, first, end, names) in enumerate(regions):
+        if not live[region] or region in pooled:
+            labels = files[file_index][2]
+            for name in names:
+                del labels.addresses[name]
+                del labels.lines[name]
+
+    new_end = 0
+    for file_index, (filename, items, labels, relocations) in enumerate(files):
+        file_regions = [region for region in range(len(regions)) if regions[region][0] == file_index]
+        new_items = []
+        new_addresses = [0] * len(items)
+        address = 0
+        for region in file_regions:
+            file_index, first, end, names = regions[region]
+            if region in pooled or not live[region]:
+                continue
+            for name in names:
+                labels.addresses[name] = address
+            for index in range(first, end):
+                new_addresses[index] = address
+                new_items.append(items[index])
+                address += items[index][2]
+        new_end += address
+
+        # Uses of a pooled constant go to the label of the copy that is kept
+        new_relocations = []
+        for region in file_regions:
+            if region in pooled or not live[region]:
+                continue
+            for index, slot, instruction, name in uses(region):
+                line = tables[file_index][index][slot][1]
+                target = resolve(file_index, name)
+                if target in pooled:
+                    name = regions[pooled[target]][3][0]
+                value = labels.addresses.get(name, 0)
+                if slot == 0:
+                    instruction.data1 = value
                 else:
-                    assembler_error("Invalid instruction mnemonic " + token[1], line, filename)
-        elif token[0] == "newline":
-            line += 1
-            tokens_since_newline = False
-        token_index += 1
+                    instruction.data2 = value
+                new_relocations.append((new_addresses[index] + operand_offsets[slot], name, line))
+
+        files[file_index][1] = new_items
+        files[file_index][3] = new_relocations
+
+    return image_end - new_end, len(regions) - sum(live), len(pooled)
+
+# Compact encoding (--compact). Every instruction is its opcode, flags and
+# operand size byte, followed by only the operands its flags use, each 1, 2,
+# 4 or 8 bytes long. The operand size byte holds the size of the source in
+# the low nibble and of the destination in the high one, as operand_1 to
+# operand_8 of enum OPERAND_SIZES. dq is still 8 bytes.
+#
+# A file starts with a header: magic, format version, the number of data
+# runs and of address fields, and the image size. Then the data runs as
+# (offset, size), the offsets of every operand holding a label address, and
+# the image itself. The tables are only needed to decode it back to the
+# fixed layout, the CPU just loads the image.
+COMPACT_VERSION = 1
+
+compact_magic         = b"LQCE"
+compact_header_struct = Struct("<4sHHIII")
+compact_run_struct    = Struct("<II")
+compact_field_struct  = Struct("<I")
+compact_head_struct   = Struct("<BBB")
+
+# By size code, operand_1, operand_2, operand_4 and operand_8
+operand_size_structs = [Struct("<B"), Struct("<H"), Struct("<I"), Struct("<Q")]
+
+INST_FLAGS_DST = INST_FLAG_DST_MEM_OP | INST_FLAG_DST_CONST | INST_FLAG_DST_REG
+INST_FLAGS_SRC = INST_FLAG_SRC_MEM_OP | INST_FLAG_SRC_CONST | INST_FLAG_SRC_REG
+
+# Label addresses are always 2 bytes (size code 1, operand_2), as the linker
+# fills them in and everything has to fit in the CPU's memory anyway
+compact_address_size_code = 1
+compact_address_struct = operand_size_structs[compact_address_size_code]
+
+def constant_size(value):
+    if value < (1<<8):
+        return 0
+    elif value < (1<<16):
+        return 1
+    elif value < (1<<32):
+        return 2
+    return 3
+
+def compact_instructions(instructions, labels, relocations, filename):
+    # Returns the items laid out in the compact encoding, their relocations,
+    # and the (offset, size) of every run of data. The label addresses are
+    # updated in place.
+    index_of, operand_labels = operand_label_table(instructions, relocations)
+
+    # Like -O and --shrink, this assumes addresses only come from labels. The
+    # output has to be compact anyway, so numbers that point into the image
+    # are only warned about. Address 0 is the first instruction either way.
+    image_end = image_size(instructions)
+    for index, item in enumerate(instructions):
+        if item[0] != "instruction":
+            continue
+        use = None
+        for slot in range(2):
+            if operand_labels[index] is not None and operand_labels[index][slot] is not None:
+                continue
+            if slot == 0 and item[1].instruction in (opcode_jmp, opcode_call) and item[1].data1 == 0:
+                continue
+            use = use or fixed_address_use(item[1], slot, image_end)
+        if use is not None:
+            assembler_warning("--compact moves code, but " + filename + " has " + use)
+            break
+
+    new_instructions = []
+    new_addresses = []
+    address = 0
+    for index, item in enumerate(instructions):
+        new_addresses.append(address)
+        if item[0] == "instruction":
+            instruction = item[1]
+            sizes = [None, None]
+            for slot, used, reg_flag in ((0, INST_FLAGS_DST, INST_FLAG_DST_REG), (1, INST_FLAGS_SRC, INST_FLAG_SRC_REG)):
+                if not instruction.instruction_flags & used:
+                    continue
+                if operand_labels[index] is not None and operand_labels[index][slot] is not None:
+                    sizes[slot] = compact_address_size_code
+                elif instruction.instruction_flags & reg_flag:
+                    sizes[slot] = 0
+                else:
+                    sizes[slot] = constant_size(instruction.data1 if slot == 0 else instruction.data2)
+
+            instruction.operand_sizes = ((sizes[0] or 0) << 4) | (sizes[1] or 0)
+            size = compact_head_struct.size
+            for code in sizes:
+                if code is not None:
+                    size += operand_size_structs[code].size
+            item = ("instruction", instruction, size)
+        new_instructions.append(item)
+        address += item[2]
+    new_addresses.append(address)
+
+    for name, address in labels.addresses.items():
+        labels.addresses[name] = new_addresses[index_of[address]]
+
+    new_relocations = []
+    for index, item in enumerate(new_instructions):
+        if operand_labels[index] is None:
+            continue
+        instruction = item[1]
+        offset = new_addresses[index] + compact_head_struct.size
+        for slot in range(2):
+            if slot == 1 and instruction.instruction_flags & INST_FLAGS_DST:
+                offset += operand_size_structs[instruction.operand_sizes >> 4].size
+            if operand_labels[index][slot] is None:
+                continue
+            name, line = operand_labels[index][slot]
+            value = labels.addresses.get(name, 0)
+            if value >= (1 << (compact_address_struct.size * 8)):
+                assembler_error("Label " + name + " is at " + hex(value) + ", too far for a " + str(compact_address_struct.size) + " byte address", line, filename)
+            if slot == 0:
+                instruction.data1 = value
+            else:
+                instruction.data2 = value
+            new_relocations.append((offset, name, line))
 
-    return ret_instructions
+    data_runs = []
+    for index, item in enumerate(new_instructions):
+        if item[0] != "data":
+            continue
+        if data_runs and data_runs[-1][0] + data_runs[-1][1] == new_addresses[index]:
+            data_runs[-1][1] += item[2]
+        else:
+            data_runs.append([new_addresses[index], item[2]])
+
+    return new_instructions, new_relocations, [tuple(run) for run in data_runs]
+
+def emit_compact_buffer(instruction_data_list):
+    image = bytearray(image_size(instruction_data_list))
+    pack_head = compact_head_struct.pack_into
+    pack_data = data_struct.pack_into
+
+    offset = 0
+    for item in instruction_data_list:
+        if item[0] == "instruction":
+            i = item[1]
+            pack_head(image, offset, i.instruction, i.instruction_flags, i.operand_sizes)
+            field = offset + compact_head_struct.size
+            if i.instruction_flags & INST_FLAGS_DST:
+                operand_struct = operand_size_structs[i.operand_sizes >> 4]
+                operand_struct.pack_into(image, field, i.data1)
+                field += operand_struct.size
+            if i.instruction_flags & INST_FLAGS_SRC:
+                operand_size_structs[i.operand_sizes & 0xf].pack_into(image, field, i.data2)
+        elif item[0] == "data":
+            if type(item[1]) is int:
+                pack_data(image, offset, item[1])
+            elif item[1] is not None:
+                image[offset:offset + item[2]] = item[1]
+        offset += item[2]
+
+    return image
+
+def compact_header(objects):
+    # Header and tables for the linked objects, in order
+    data_runs = []
+    fields = []
+    base = 0
+    for obj in objects:
+        for offset, size in obj.data_runs:
+            data_runs.append(compact_run_struct.pack(base + offset, size))
+        for offset, name, line in obj.relocations:
+            fields.append(base + offset)
+        base += len(obj.image)
+
+    fields.sort()
+    return b"".join([compact_header_struct.pack(compact_magic, COMPACT_VERSION, 0, len(data_runs), len(fields), base)] + data_runs + [compact_field_struct.pack(field) for field in fields])
+
+def decode_source(source):
+    # Same newline handling as reading the file in text mode
+    if isinstance(source, str):
+        data = source
+    else:
+        data = source.decode()
+    if "\r" in data:
+        data = data.replace("\r\n", "\n").replace("\r", "\n")
+    return data
+
+class liquidcpu_object:
+    def __init__(self, filename, image, labels, relocations):
+        self.stats = None
+        self.instructions_saved = 0
+        self.data_runs = None # Only for --compact
+        self.segment_runs = None # Only for --sectioned
+        self.filename = filename
+        self.image = image
+        # Label name -> address, relative to the start of this object
+        self.labels = labels
+        # (offset of the 8 byte field, label name, source line) to patch when linking
+        self.relocations = relocations
+
+# Files at least this big are mapped instead of read, and images at least
+# this big are linked straight into a mapping of the output file
+mmap_threshold = 1024 * 1024
+
+def read_source(filename):
+    with open(filename, "rb") as fp:
+        if os.fstat(fp.fileno()).st_size < mmap_threshold:
+            return fp.read()
+        return mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+
+def encode_single_pass(tokens, filename, relocations):
+    # Encodes without find_labels. Labels are defined as they are reached,
+    # and uses of labels further down are left as 0 for link_objects, which
+    # patches every relocation anyway and reports the undefined ones. Like
+    # --stream, labels named like registers have to come before their uses.
+    labels = liquidcpu_symbol_table()
+    return list(encode_stream(tokens, labels, filename, relocations, True)), labels
+
+def tokenize_source(filename, source, stats=None):
+    if stats is None:
+        tokens = tokenize(source, filename)
+    else:
+        record = stats.start("tokenize", filename)
+        tokens = tokenize(source, filename)
+        stats.finish(record, tokens=len(tokens))
+    assembler_dbg(tokens)
+    return tokens
 
-def main():
+def parse_tokens(filename, tokens, stats=None, single_pass=False):
+    relocations = []
+    if stats is None:
+        if single_pass:
+            instructions, labels = encode_single_pass(tokens, filename, relocations)
+            return instructions, labels, relocations
+
+        labels = find_labels(tokens, filename)
+        return encode_tokens(tokens, labels, filename, relocations), labels, relocations
+
+    if single_pass:
+        record = stats.start("encode", filename)
+        instructions, labels = encode_single_pass(tokens, filename, relocations)
+        counts = {"labels": len(labels)}
+    else:
+        record = stats.start("find_labels", filename)
+        labels = find_labels(tokens, filename)
+        stats.finish(record, labels=len(labels))
+
+        record = stats.start("encode", filename)
+        instructions = encode_tokens(tokens, labels, filename, relocations)
+        counts = {}
+
+    data_items = [item[2] for item in instructions if item[0] == "data"]
+    stats.finish(record, instructions=len(instructions) - len(data_items), dq_bytes=sum(data_items), **counts)
+    return instructions, labels, relocations
+
+def parse_file(filename, source=None, stats=None, single_pass=False):
+    if source is None:
+        source = read_source(filename)
+    return parse_tokens(filename, tokenize_source(filename, source, stats), stats, single_pass)
+
+def assemble_source(filename, source, stats=None, optimize=False, compact=False, single_pass=False):
+    if source is None:
+        source = read_source(filename)
+    return assemble_tokens(filename, tokenize_source(filename, source, stats), stats, optimize, compact, single_pass)
+
+def assemble_tokens(filename, tokens, stats=None, optimize=False, compact=False, single_pass=False):
+    # Tokens are never changed, so they can be assembled again with other options
+    instructions, labels, relocations, saved = encode_file(filename, tokens, stats, optimize, single_pass)
+    return build_object(filename, instructions, labels, relocations, saved, stats, compact)
+
+def encode_file(filename, tokens, stats=None, optimize=False, single_pass=False):
+    instructions, labels, relocations = parse_tokens(filename, tokens, stats, single_pass)
+
+    saved = 0
+    if optimize:
+        if stats is not None:
+            record = stats.start("optimize", filename)
+        instructions, relocations, saved = optimize_instructions(instructions, labels, relocations, filename)
+        if stats is not None:
+            stats.finish(record, saved=saved)
+    return instructions, labels, relocations, saved
+
+def build_object(filename, instructions, labels, relocations, saved=0, stats=None, compact=False):
+    data_runs = None
+    emit = emit_buffer
+    if compact:
+        if stats is not None:
+            record = stats.start("compact", filename)
+        instructions, relocations, data_runs = compact_instructions(instructions, labels, relocations, filename)
+        emit = emit_compact_buffer
+        if stats is not None:
+            stats.finish(record, bytes=image_size(instructions))
+
+    # Where the data is, in case the object ends up in a --sectioned file
+    runs = None if compact else []
+    if stats is None:
+        image = emit(instructions, runs=runs) if runs is not None else emit(instructions)
+    else:
+        record = stats.start("emit", filename)
+        image = emit(instructions, runs=runs) if runs is not None else emit(instructions)
+        stats.finish(record, bytes=len(image))
+
+    obj = liquidcpu_object(filename, image, labels.addresses, relocations)
+    obj.instructions_saved = saved
+    obj.data_runs = data_runs
+    obj.segment_runs = runs
+    return obj
+
+def assemble_shrunk(filenames, stats=None, optimize=False, compact=False, single_pass=False, entry=None):
+    # --shrink needs the items of every file at once, so the files are
+    # assembled one after another here instead of by assemble_objects.
+    # Returns the objects and what shrink_program returned.
+    files = []
+    saved = []
+    for filename in filenames:
+        if stats is not None:
+            record = stats.start("read")
+        source = read_source(filename)
+        if stats is not None:
+            stats.finish(record, bytes=len(source))
+
+        tokens = tokenize_source(filename, source, stats)
+        if isinstance(source, mmap.mmap):
+            source.close()
+        instructions, labels, relocations, instructions_saved = encode_file(filename, tokens, stats, optimize, single_pass)
+        files.append([filename, instructions, labels, relocations])
+        saved.append(instructions_saved)
+
+    if stats is None:
+        shrunk = shrink_program(files, entry)
+    else:
+        record = stats.start("shrink")
+        shrunk = shrink_program(files, entry)
+        stats.finish(record, bytes=shrunk[0])
+
+    objects = [build_object(filename, instructions, labels, relocations, instructions_saved, stats, compact) for (filename, instructions, labels, relocations), instructions_saved in zip(files, saved)]
+    return objects, shrunk
+
+def assemble_source_with_stats(filename, source, trace_memory, optimize=False, compact=False, single_pass=False):
+    # For -j workers, the records go back to the parent with the object
+    stats = liquidcpu_stats(trace_memory)
+    obj = assemble_source(filename, source, stats, optimize, compact, single_pass)
+    obj.stats = stats.records
+    return obj
+
+def link_objects(objects, image=None, address_struct=data_struct):
+    # image is where to put the result, any writable buffer of the right size.
+    # address_struct is how label addresses are stored in it.
+    # Place the objects one after another and collect every label
+    bases = []
+    global_labels = {}
+    defined_in = {}
+    size = 0
+    for obj in objects:
+        bases.append(size)
+        for name, address in obj.labels.items():
+            if name in global_labels:
+                defined_in[name].append(obj.filename)
+            else:
+                global_labels[name] = size + address
+                defined_in[name] = [obj.filename]
+        size += len(obj.image)
+
+    if image is None:
+        image = bytearray(size)
+    pack_address = address_struct.pack_into
+    address_limit = 1 << (address_struct.size * 8)
+
+    for obj, base in zip(objects, bases):
+        image[base:base + len(obj.image)] = obj.image
+
+        for offset, name, line in obj.relocations:
+            if name in obj.labels:
+                # Labels in the same file win over labels from other files
+                address = base + obj.labels[name]
+            elif name not in global_labels:
+                assembler_error("Undefined label " + name, line, obj.filename)
+            elif len(defined_in[name]) > 1:
+                assembler_error("Label " + name + " is defined in more than one file: " + ", ".join(defined_in[name]), line, obj.filename)
+            else:
+                address = global_labels[name]
+            if address >= address_limit:
+                assembler_error("Label " + name + " is at " + hex(address) + ", too far for a " + str(address_struct.size) + " byte address", line, obj.filename)
+            pack_address(image, base + offset, address)
+
+    return memoryview(image)
+
+def link_compact(objects):
+    # The whole --compact file, header included
+    return compact_header(objects) + link_objects(objects, address_struct=compact_address_struct)
+
+def link_sectioned(objects, entry=0, sp=None):
+    # The whole --sectioned file. Objects from the cache don't know where
+    # their data is, for those only long runs of zeros are split off.
+    image = link_objects(objects)
+    runs = []
+    base = 0
+    for obj in objects:
+        if obj.segment_runs is None:
+            obj_runs = image_segments(obj.image)
+        else:
+            obj_runs = obj.segment_runs
+        runs.extend([(kind, base + offset, size) for kind, offset, size in obj_runs])
+        base += len(obj.image)
+    return pack_liqfile(image, image_segments(image, runs), entry, sp)
+
+def label_address(objects, name):
+    # Address of a label in the linked image, or None if no file defines it
+    base = 0
+    for obj in objects:
+        if name in obj.labels:
+            return base + obj.labels[name]
+        base += len(obj.image)
+    return None
+
+def entry_address(objects, entry):
+    # --entry is a label or a number
+    if entry is None:
+        return 0
+    address = label_address(objects, entry)
+    if address is None:
+        try:
+            address = int(entry, 0)
+        except ValueError:
+            assembler_error("Undefined label " + entry, 0, "--entry")
+    return address
+
+def link_to_file(objects, path, stats=None, compact=False, sectioned=None):
+    # sectioned is (entry, sp) to write a --sectioned file instead
+    # Links into a temporary file that replaces path once it is complete, so
+    # a link error leaves any old output alone. Big images are written
+    # straight into a mapping of the file, presized from the object sizes.
+    size = sum([len(obj.image) for obj in objects])
+    temp_path = path + "." + str(os.getpid()) + ".tmp"
+    if stats is not None:
+        record = stats.start("link")
+
+    try:
+        with open(temp_path, "w+b") as fp:
+            if compact or sectioned is not None:
+                image = link_compact(objects) if compact else link_sectioned(objects, *sectioned)
+                size = len(image)
+                if stats is not None:
+                    stats.finish(record, bytes=size)
+                    record = stats.start("write")
+                fp.write(image)
+            elif size >= mmap_threshold:
+                fp.truncate(size)
+                with mmap.mmap(fp.fileno(), size) as image:
+                    link_objects(objects, image)
+                    if stats is not None:
+                        stats.finish(record, bytes=size)
+                        record = stats.start("write")
+                    image.flush()
+            else:
+                image = link_objects(objects)
+                if stats is not None:
+                    stats.finish(record, bytes=size)
+                    record = stats.start("write")
+                fp.write(image)
+        os.replace(temp_path, path)
+    except BaseException:
+        try:
+            os.remove(temp_path)
+        except OSError:
+            pass
+        raise
+
+    if stats is not None:
+        stats.finish(record, bytes=size)
+    return size
+
+class liquidcpu_assembler:
+    # Assembles sources in memory, for use from other Python code. Nothing is
+    # shared between calls, so one object can be used from many threads at
+    # once. Errors raise liquidcpu_assembler_error.
+    # Pass a liquidcpu_stats to get the phases of a call reported to it, and
+    # a list to get the warnings of a call appended to it. Without a list
+    # they are raised with warnings.warn as liquidcpu_assembler_warning.
+    # verbose_level is used instead of the one set for the command line.
+    # With compact, the result is a whole --compact file, header included.
+    def __init__(self, optimize=False, compact=False, single_pass=False, verbose_level=0):
+        self.optimize = optimize
+        self.compact = compact
+        self.single_pass = single_pass
+        self.verbose_level = verbose_level
+
+    def assemble(self, source, filename="<source>", stats=None, warnings=None):
+        # source is text or bytes, the result is the image as bytes
+        return self.link([(filename, source)], stats, warnings)
+
+    def link(self, sources, stats=None, warnings=None):
+        # sources is a list of (filename, source), placed in that order
+        collected = []
+        previous = call_settings.__dict__.copy()
+        call_settings.verbose_level = self.verbose_level
+        call_settings.warnings = collected
+        try:
+            image = self.link_objects(sources, stats)
+        finally:
+            call_settings.__dict__.clear()
+            call_settings.__dict__.update(previous)
+            if warnings is not None:
+                warnings.extend(collected)
+            else:
+                for msg in collected:
+                    warn(msg, liquidcpu_assembler_warning)
+        return image
+
+    def link_objects(self, sources, stats):
+        objects = [assemble_source(filename, source, stats, self.optimize, self.compact, self.single_pass) for filename, source in sources]
+        link = link_compact if self.compact else link_objects
+        if stats is None:
+            return bytes(link(objects))
+
+        record = stats.start("link")
+        image = bytes(link(objects))
+        stats.finish(record, bytes=len(image))
+        return image
+
+    def assemble_file(self, filename, stats=None, warnings=None):
+        with open(filename, "rb") as fp:
+            return self.assemble(fp.read(), filename, stats, warnings)
+
+def set_verbose_level(level):
+    global verbose_level
+    verbose_level = level
+
+def assemble_files(filenames, jobs=1, cache=None, stats=None, optimize=False, compact=False, single_pass=False):
+    objects = assemble_objects(filenames, jobs, cache, stats, optimize, compact, single_pass)
+    link = link_compact if compact else link_objects
+    if stats is None:
+        return link(objects)
+
+    record = stats.start("link")
+    image = link(objects)
+    stats.finish(record, bytes=len(image))
+    return image
+
+def assemble_objects(filenames, jobs=1, cache=None, stats=None, optimize=False, compact=False, single_pass=False):
+    if stats is not None:
+        record = stats.start("read")
+    sources = [read_source(filename) for filename in filenames]
+    if stats is not None:
+        stats.finish(record, bytes=sum([len(source) for source in sources]))
+
+    # Cache lookups are only a hash and a read, so they stay in this process
+    objects = [None] * len(filenames)
+    keys = [None] * len(filenames)
+    if cache is not None:
+        for index, source in enumerate(sources):
+            keys[index] = cache.key(source)
+            cached = cache.lookup(keys[index])
+            if cached is not None:
+                assembler_log("Cache hit for ", filenames[index])
+                image, labels, relocations, instructions_saved = cached
+                objects[index] = liquidcpu_object(filenames[index], image, labels, relocations)
+                objects[index].instructions_saved = instructions_saved
+
+    missing = [index for index in range(len(filenames)) if objects[index] is None]
+    if jobs > 1 and len(missing) > 1:
+        # Mapped files can't be sent to the workers, they map them again
+        worker_sources = [None if isinstance(sources[index], mmap.mmap) else sources[index] for index in missing]
+        with ProcessPoolExecutor(max_workers=jobs, initializer=set_verbose_level, initargs=(verbose_level,)) as executor:
+            if stats is None:
+                results = executor.map(assemble_source, [filenames[index] for index in missing], worker_sources, [None] * len(missing), [optimize] * len(missing), [compact] * len(missing), [single_pass] * len(missing))
+            else:
+                results = executor.map(assemble_source_with_stats, [filenames[index] for index in missing], worker_sources, [stats.trace_memory] * len(missing), [optimize] * len(missing), [compact] * len(missing), [single_pass] * len(missing))
+            for index, obj in zip(missing, results):
+                objects[index] = obj
+                if obj.stats is not None:
+                    stats.merge(obj.stats)
+    else:
+        for index in missing:
+            objects[index] = assemble_source(filenames[index], sources[index], stats, optimize, compact, single_pass)
+
+    if cache is not None:
+        for index in missing:
+            obj = objects[index]
+            cache.store(keys[index], obj.image, obj.labels, obj.relocations, obj.instructions_saved)
+
+    for source in sources:
+        if isinstance(source, mmap.mmap):
+            source.close()
+
+    return objects
+
+# --split: a single big file is cut into chunks at line boundaries, and each
+# chunk is tokenized, encoded and emitted by a worker on its own, in single
+# pass mode. Labels from further down or from another chunk are left as 0,
+# then the merge puts the chunks one after another, defines the labels in
+# file order and patches every use of a label the file defines, which makes
+# the object the same as assembling the file in one go.
+
+# Smallest chunk worth sending to a worker
+split_chunk_size = 1024 * 1024
+
+def split_chunks(source, count):
+    # (start, end, first line) of each chunk, or None if the file should be
+    # assembled in one go
+    count = min(count, len(source) // split_chunk_size)
+    if count < 2 or source.find(b"\r") != -1:
+        # A lone \r ends a line too, so counting \n wouldn't give the right line numbers
+        return None
+
+    chunks = []
+    start = 0
+    line = 1
+    for index in range(1, count + 1):
+        end = len(source)
+        if index < count:
+            end = source.find(b"\n", len(source) * index // count)
+            if end == -1:
+                end = len(source)
+            else:
+                end += 1
+        if end <= start:
+            continue
+        chunks.append((start, end, line))
+        line += source[start:end].count(b"\n")
+        start = end
+        if start == len(source):
+            break
+    return chunks
+
+def split_worker_init(level):
+    # Workers inherit --stats memory tracing from a forked parent, but their
+    # memory isn't reported and tracing slows them down many times over
+    set_verbose_level(level)
+    if tracemalloc.is_tracing():
+        tracemalloc.stop()
+
+def encode_chunk(filename, start, end, first_line):
+    # Runs in a worker. Only the emitted image goes back, with the labels,
+    # label uses and data runs of the chunk, all relative to its start.
+    with open(filename, "rb") as fp:
+        fp.seek(start)
+        source = fp.read(end - start)
+    tokens = tokenize(source, filename, first_line)
+    del source
+
+    labels = liquidcpu_symbol_table()
+    relocations = liquidcpu_fixup_list()
+    instructions = list(encode_stream(tokens, labels, filename, relocations, True, True, first_line))
+    del tokens
+
+    runs = []
+    image = emit_buffer(instructions, runs=runs)
+    return image, labels, relocations, runs
+
+def merge_chunks(filename, results):
+    # One object out of the encoded chunks, or None if they can't be merged
+    # into the same thing as assembling the whole file
+    image = bytearray()
+    labels = liquidcpu_symbol_table()
+    relocations = []
+    runs = []
+    for chunk_image, chunk_labels, chunk_relocations, chunk_runs in results:
+        base = len(image)
+        image += chunk_image
+        for name, address in chunk_labels.addresses.items():
+            labels.define(name, base + address, chunk_labels.lines[name], filename)
+
+        names = chunk_relocations.names
+        relocations.extend(zip([base + offset for offset in chunk_relocations.offsets], map(names.__getitem__, chunk_relocations.name_ids), chunk_relocations.lines))
+
+        for kind, offset, size in chunk_runs:
+            if runs and runs[-1][0] == kind and runs[-1][1] + runs[-1][2] == base + offset:
+                runs[-1][2] += size
+            else:
+                runs.append([kind, base + offset, size])
+
+    # In one go, a label named like a register turns every use of that
+    # register in the file into the label, even in the chunks before it
+    addresses = labels.addresses
+    if any([name in addresses for name in gprs]):
+        return None
+
+    # Uses of labels from other files stay 0 for link_objects
+    pack_address = data_struct.pack_into
+    for offset, name, line in relocations:
+        address = addresses.get(name)
+        if address is not None:
+            pack_address(image, offset, address)
+
+    obj = liquidcpu_object(filename, image, addresses, relocations)
+    obj.segment_runs = runs
+    return obj
+
+def assemble_split(filenames, jobs, stats=None, single_pass=False):
+    # Files are assembled one after another, each one split up over the
+    # workers. Files too small to split are assembled here.
+    objects = []
+    with ProcessPoolExecutor(max_workers=jobs, initializer=split_worker_init, initargs=(verbose_level,)) as executor:
+        for filename in filenames:
+            if stats is not None:
+                record = stats.start("read")
+            source = read_source(filename)
+            if stats is not None:
+                stats.finish(record, bytes=len(source))
+
+            try:
+                obj = None
+                chunks = split_chunks(source, jobs)
+                if chunks is not None:
+                    if stats is not None:
+                        record = stats.start("split", filename)
+                    futures = [executor.submit(encode_chunk, filename, start, end, line) for start, end, line in chunks]
+                    try:
+                        results = [future.result() for future in futures]
+                    except liquidcpu_assembler_error:
+                        # Assembling in one go finds the errors in another
+                        # order (all the labels before any encoding), so the
+                        # file is assembled again to report the same one
+                        for future in futures:
+                            future.cancel()
+                        results = None
+                    if stats is not None:
+                        stats.finish(record, chunks=len(chunks), bytes=len(source))
+
+                    if results is not None:
+                        if stats is not None:
+                            record = stats.start("merge", filename)
+                        obj = merge_chunks(filename, results)
+                        del results
+                        if stats is not None:
+                            stats.finish(record, labels=len(obj.labels) if obj is not None else 0)
+                        if obj is None:
+                            assembler_log("Labels named like registers in ", filename, ", assembling it in one go")
+
+                if obj is None:
+                    obj = assemble_source(filename, source, stats, single_pass=single_pass)
+            finally:
+                if isinstance(source, mmap.mmap):
+                    source.close()
+            objects.append(obj)
+
+    return objects
+
+def main(argv=None, assemble=None):
+    # argv and assemble (which stands in for assemble_objects) are for
+    # lasm_daemon.py, which runs builds in a long running process
     global verbose_level
 
     parser = argparse.ArgumentParser(description='Assemble a LiquidCPU assembly program.')
     parser.add_argument('--output', '-o')
     parser.add_argument('--verbose', '-v', action='count')
+    parser.add_argument('--cache-dir', help='cache assembled files in this directory')
+    parser.add_argument('--cache-size', type=int, default=64, help='cache size limit in MiB (default 64)')
+    parser.add_argument('--jobs', '-j', type=int, default=1, help='assemble up to this many files in parallel')
+    parser.add_argument('-O', dest='optimize', action='store_true', help='remove nops, dead code and redundant jumps')
+    parser.add_argument('--single-pass', action='store_true', help='encode while finding labels, and fill in later labels when linking')
+    parser.add_argument('--compact', action='store_true', help='write the variable length encoding, with a header')
+    parser.add_argument('--sectioned', action='store_true', help='write a sectioned file (see liqfile.py) that leaves resq space out and loads it as zero-fill')
+    parser.add_argument('--entry', help='label or address to start at, for --sectioned (default 0)')
+    parser.add_argument('--sp', type=lambda text: int(text, 0), help='where the stack starts, for --sectioned (default 0x1000)')
+    parser.add_argument('--shrink', action='store_true', help='drop code and data nothing refers to, and keep one copy of identical read-only dq constants')
+    parser.add_argument('--split', action='store_true', help='split big files into chunks at line boundaries and tokenize and encode them on the -j workers')
+    parser.add_argument('--stream', action='store_true', help='assemble a single file line by line, for sources too big to fit in memory')
+    parser.add_argument('--stats', nargs='?', const='text', choices=['text', 'json'], help='print the time, peak memory and counts of every phase')
+    parser.add_argument('--stats-file', help='write the --stats output to this file instead')
+    parser.add_argument('--no-trace-memory', action='store_true', help='leave peak memory out of --stats, which makes the times more accurate')
     parser.add_argument('inputs', nargs='*')
-    result = parser.parse_args()
+    result = parser.parse_args(argv)
     
     if len(result.inputs) == 0:
         print("usage error!")
         parser.print_usage()
         quit()
     
-    if result.verbose:
-        verbose_level = result.verbose
+    verbose_level = result.verbose or 0
+
+    if result.stream and len(result.inputs) != 1:
+        print("usage error!")
+        print("--stream takes a single input file")
+        quit()
+
+    if result.stream and result.optimize:
+        print("usage error!")
+        print("-O can't be used with --stream")
+        quit()
+
+    if result.compact and (result.stream or result.cache_dir):
+        print("usage error!")
+        print("--compact can't be used with --stream or --cache-dir")
+        quit()
+
+    if result.sectioned and (result.stream or result.compact):
+        print("usage error!")
+        print("--sectioned can't be used with --stream or --compact")
+        quit()
+
+    if (result.entry is not None or result.sp is not None) and not result.sectioned:
+        print("usage error!")
+        print("--entry and --sp only work with --sectioned, flat files always start at 0")
+        quit()
+
+    if result.split and (result.optimize or result.compact or result.shrink or result.stream or result.cache_dir):
+        print("usage error!")
+        print("--split can't be used with -O, --compact, --shrink, --stream or --cache-dir")
+        quit()
+
+    if result.shrink and (result.stream or result.cache_dir):
+        print("usage error!")
+        print("--shrink can't be used with --stream or --cache-dir")
+        quit()
+
+    if result.shrink and result.entry is not None and result.entry[:1].isdigit():
+        # Labels can't start with a digit, and shrinking moves code around
+        print("usage error!")
+        print("--shrink moves code around, so --entry has to be a label with it")
+        quit()
+
+    # Streamed sources are never held in memory, so they can't be cached
+    cache = None
+    if result.cache_dir and not result.stream:
+        # Optimized and single pass output can be different (single pass
+        # reads labels named like registers as registers until they are
+        # defined), so they are cached separately
+        cache = liquidcpu_cache(result.cache_dir, result.cache_size * 1024 * 1024, str(ASSEMBLER_VERSION) + ("-O" if result.optimize else "") + ("-single-pass" if result.single_pass else ""))
+
+    stats = None
+    if result.stats or result.stats_file:
+        stats = liquidcpu_stats(not result.no_trace_memory)
 
     start = time.time()
 
-    instruction_data_list = []
-    for input_file in result.inputs:
-        output = parse_file(input_file)
-        for outputs in output:
-            instruction_data_list.append(outputs)
+    try:
+        if result.stream:
+            # Streaming runs every phase at once, so it is a single record
+            if stats is not None:
+                record = stats.start("stream", result.inputs[0])
+            # Read as bytes, so lines that aren't valid UTF-8 are reported with their line
+            with open(result.inputs[0], "rb") as source, open(result.output or "lasm.liq", "wb") as file:
+                size = write_stream(source, file, result.inputs[0])
+            if stats is not None:
+                stats.finish(record, bytes=size)
+        else:
+            if result.split:
+                objects = assemble_split(result.inputs, result.jobs, stats, result.single_pass)
+            elif result.shrink:
+                objects, shrunk = assemble_shrunk(result.inputs, stats, result.optimize, result.compact, result.single_pass, result.entry)
+            else:
+                objects = (assemble or assemble_objects)(result.inputs, result.jobs, cache, stats, result.optimize, result.compact, result.single_pass)
+            sectioned = None
+            if result.sectioned:
+                sectioned = (entry_address(objects, result.entry), result.sp)
+            link_to_file(objects, result.output or "lasm.liq", stats, result.compact, sectioned)
+    except liquidcpu_assembler_error as error:
+        print_assembler_error(error)
+        quit()
 
     end = time.time()
 
-    if result.output:
-        with open(result.output, "wb") as file:
-            for instruction in instruction_data_list:
-                if instruction[0] == "instruction":
-                    write_instruction(instruction[1], file)
-                elif instruction[0] == "data":
-                    write_data((instruction[1], instruction[2]), file)
-    else:
-        with open("lasm.liq", "wb") as file:
-            for instruction in instruction_data_list:
-                if instruction[0] == "instruction":
-                    write_instruction(instruction[1], file)
-                elif instruction[0] == "data":
-                    write_data((instruction[1], instruction[2]), file)
-    
     print("Assembled in " + str(end - start) + " seconds.")
 
-main()
\ No newline at end of file
+    if result.optimize and not result.stream:
+        print("Optimized away " + str(sum([obj.instructions_saved for obj in objects])) + " instructions.")
+
+    if result.shrink:
+        print("Shrunk the image by " + str(shrunk[0]) + " bytes, dropped " + str(shrunk[1]) + " unreachable regions and pooled " + str(shrunk[2]) + " constants.")
+
+    if stats is not None:
+        if result.stats == "json" or (result.stats is None and result.stats_file.endswith(".json")):
+            report = json.dumps({"seconds": end - start, "phases": stats.records, "totals": stats.totals()}, indent=2)
+        else:
+            report = format_stats(stats)
+
+        if result.stats_file:
+            with open(result.stats_file, "w") as fp:
+                fp.write(report + "\n")
+        else:
+            print(report)
+
+    if cache is not None:
+        cache.trim()
+        print("Cache: " + str(cache.hits) + " hits, " + str(cache.misses) + " misses.")
+
+if __name__ == "__main__":
+    main()
\ No newline at end of file
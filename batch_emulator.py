@@ -0,0 +1,410 @@
+import argparse
+import time
+
+import numpy as np
+
+from assembler import INST_FLAG_SRC_MEM_OP, INST_FLAG_DST_MEM_OP, INST_FLAG_SRC_CONST, INST_FLAG_DST_CONST, INST_FLAG_SRC_REG, INST_FLAG_DST_REG
+from assembler import get_opcode
+from emulator import MEMORY_SIZE, CPU_FLAG_HLT, REG_IP, REG_SP, REG_FLAG, INSTRUCTION_SIZE
+from emulator import fault_invl_opcode, fault_bad_reg, fault_mem_err, fault_bad_flg, fault_names
+from liqfile import load_memory, liquidcpu_liqfile_error
+
+# Runs the same LiquidCPU program on many CPUs ("lanes") at once. Registers
+# are stored as one uint64 array per register and memory as one row per
+# lane, and every step executes one instruction on all running lanes, with
+# the lanes split up by opcode so that lanes at different ips still work.
+# Follows emulator.py, which follows the C handlers.
+#
+# The loaded image is decoded once at every offset and shared by all lanes.
+# Each lane tracks the lowest and highest address it has written, and only
+# fetches from its own memory when ip falls inside that range.
+
+NO_FAULT = -1
+
+byte_offsets_8 = np.arange(8, dtype=np.intp)
+byte_offsets_instruction = np.arange(INSTRUCTION_SIZE, dtype=np.intp)
+
+opcode_nop  = get_opcode("nop")
+opcode_mov  = get_opcode("mov")
+opcode_hlt  = get_opcode("hlt")
+opcode_jmp  = get_opcode("jmp")
+opcode_inc  = get_opcode("inc")
+opcode_dec  = get_opcode("dec")
+opcode_push = get_opcode("push")
+opcode_pop  = get_opcode("pop")
+opcode_call = get_opcode("call")
+opcode_ret  = get_opcode("ret")
+
+class liquidcpu_batch:
+    def __init__(self, lanes, memory_size=MEMORY_SIZE):
+        self.lanes = lanes
+        self.memory_size = memory_size
+        self.memory = np.zeros((lanes, memory_size), dtype=np.uint8)
+        self.flat_memory = self.memory.reshape(-1)
+        self.lane_base = np.arange(lanes, dtype=np.intp) * memory_size
+
+        # Whole qword view of memory, only when every lane starts on a qword
+        self.flat_memory_64 = None
+        if memory_size % 8 == 0:
+            self.flat_memory_64 = self.flat_memory.view("<u8")
+            self.lane_base_64 = self.lane_base // 8
+
+        # Decoded image shared by the lanes, and the range each lane wrote to
+        self.code_start = 0
+        self.code_end = 0
+        self.code_opcodes = None
+        self.code_flags = None
+        self.code_data1 = None
+        self.code_data2 = None
+        self.write_low = np.full(lanes, memory_size, dtype=np.uint64)
+        self.write_high = np.zeros(lanes, dtype=np.uint64)
+
+        # r0-r7, ip, sp, flag, each of shape (lanes,)
+        self.regs = np.zeros((11, lanes), dtype=np.uint64)
+        self.regs[REG_SP] = 0x1000 # The stack starts at 0x1000, but should be changed by the user
+
+        self.clock_cycles = np.zeros(lanes, dtype=np.uint64)
+        self.fault = np.full(lanes, NO_FAULT, dtype=np.int8)
+        self.steps = 0
+        self.run_time = 0.0
+
+        self.handlers = {
+            opcode_nop:  self.nop_handler,
+            opcode_mov:  self.move_handler,
+            opcode_hlt:  self.hlt_handler,
+            opcode_jmp:  self.jmp_handler,
+            opcode_inc:  self.inc_handler,
+            opcode_dec:  self.dec_handler,
+            opcode_push: self.push_handler,
+            opcode_pop:  self.pop_handler,
+            opcode_call: self.call_handler,
+            opcode_ret:  self.ret_handler,
+        }
+
+    @property
+    def halted(self):
+        return (self.regs[REG_FLAG] & CPU_FLAG_HLT) != 0
+
+    @property
+    def running(self):
+        return ~self.halted & (self.fault == NO_FAULT)
+
+    @property
+    def instructions_per_second(self):
+        if self.run_time == 0:
+            return 0.0
+        return float(self.clock_cycles.sum()) / self.run_time
+
+    def load(self, image, address=0):
+        if address + len(image) > self.memory_size:
+            raise ValueError("image of " + str(len(image)) + " bytes does not fit in memory at " + hex(address))
+        image = np.frombuffer(bytes(image), dtype=np.uint8)
+        self.memory[:, address:address + len(image)] = image
+        self.write_low[:] = self.memory_size
+        self.write_high[:] = 0
+
+        if len(image) < INSTRUCTION_SIZE:
+            self.flush_decoded()
+            return
+
+        records = np.lib.stride_tricks.sliding_window_view(image, INSTRUCTION_SIZE)
+        self.code_start = address
+        self.code_end = address + len(image)
+        self.code_opcodes = records[:, 0].copy()
+        self.code_flags = records[:, 1].astype(np.uint64)
+        self.code_data1 = np.ascontiguousarray(records[:, 3:11]).view("<u8").reshape(len(records)).astype(np.uint64)
+        self.code_data2 = np.ascontiguousarray(records[:, 11:19]).view("<u8").reshape(len(records)).astype(np.uint64)
+
+    def load_file(self, data):
+        # A flat or --sectioned executable, every lane starts the same
+        memory, entry, sp = load_memory(data, self.memory_size)
+        self.load(memory)
+        self.regs[REG_IP] = entry
+        if sp is not None:
+            self.regs[REG_SP] = sp
+
+    def flush_decoded(self):
+        # Call after changing memory directly, so every lane fetches from its own memory
+        self.code_start = 0
+        self.code_end = 0
+
+    def set_register(self, index, values):
+        self.regs[index] = values
+
+    # Memory and register access for a subset of lanes. Each returns the
+    # values and a mask of lanes that fault instead.
+
+    def read_memory_64(self, lanes, addr):
+        bad = addr > self.memory_size - 8
+        start = np.where(bad, 0, addr).astype(np.intp)
+
+        # Aligned reads are a single uint64 gather, the rest go byte by byte
+        if self.flat_memory_64 is not None and not (start & 7).any():
+            values = self.flat_memory_64[self.lane_base_64[lanes] + (start >> 3)]
+        else:
+            data = self.flat_memory[(self.lane_base[lanes] + start)[:, None] + byte_offsets_8]
+            values = data.view("<u8").reshape(len(lanes))
+        return values.astype(np.uint64), bad
+
+    def write_memory_64(self, lanes, addr, values):
+        # addr must already be checked by check_memory_64
+        start = addr.astype(np.intp)
+        if self.flat_memory_64 is not None and not (start & 7).any():
+            self.flat_memory_64[self.lane_base_64[lanes] + (start >> 3)] = values
+        else:
+            self.flat_memory[(self.lane_base[lanes] + start)[:, None] + byte_offsets_8] = values.astype("<u8").view(np.uint8).reshape(len(lanes), 8)
+
+        self.write_low[lanes] = np.minimum(self.write_low[lanes], addr)
+        self.write_high[lanes] = np.maximum(self.write_high[lanes], addr + np.uint64(8))
+
+    def check_memory_64(self, addr):
+        return addr > self.memory_size - 8
+
+    def read_regs(self, lanes, index, limit):
+        bad = index >= limit
+        index = np.where(bad, 0, index).astype(np.intp)
+        return self.regs[index, lanes], bad
+
+    # Operand helpers, see the matching ones in emulator.py
+
+    def operand_address(self, lanes, flags, data, reg, faults):
+        # Address of a memory operand, through a GPR when the reg flag is set
+        addr = data.copy()
+        through_reg = np.nonzero(flags & reg)[0]
+        if len(through_reg):
+            values, bad = self.read_regs(lanes[through_reg], data[through_reg], 8)
+            addr[through_reg] = values
+            faults[through_reg[bad]] = fault_bad_reg
+        return addr
+
+    def read_operand(self, lanes, flags, data, mem_op, const, reg, visible, faults):
+        values = np.zeros(len(lanes), dtype=np.uint64)
+
+        is_mem = (flags & mem_op) != 0
+        is_const = ~is_mem & ((flags & const) != 0)
+        is_reg = ~is_mem & ~is_const & ((flags & reg) != 0)
+
+        mem = np.nonzero(is_mem)[0]
+        if len(mem):
+            mem_faults = faults[mem]
+            addr = self.operand_address(lanes[mem], flags[mem], data[mem], reg, mem_faults)
+            loaded, bad = self.read_memory_64(lanes[mem], addr)
+            values[mem] = loaded
+            mem_faults[bad & (mem_faults == NO_FAULT)] = fault_mem_err
+            faults[mem] = mem_faults
+
+        values[is_const] = data[is_const]
+
+        regs = np.nonzero(is_reg)[0]
+        if len(regs):
+            loaded, bad = self.read_regs(lanes[regs], data[regs], 10 if visible else 8)
+            values[regs] = loaded
+            faults[regs[bad]] = fault_bad_reg
+
+        return values, is_mem | is_const | is_reg
+
+    def write_dst(self, lanes, flags, data1, values, visible, faults):
+        # Only lanes that haven't faulted yet are written
+        is_mem = (flags & INST_FLAG_DST_MEM_OP) != 0
+        is_const = ~is_mem & ((flags & INST_FLAG_DST_CONST) != 0)
+        is_reg = ~is_mem & ~is_const & ((flags & INST_FLAG_DST_REG) != 0)
+
+        faults[is_const & (faults == NO_FAULT)] = fault_bad_flg
+
+        mem = np.nonzero(is_mem & (faults == NO_FAULT))[0]
+        if len(mem):
+            mem_faults = faults[mem]
+            addr = self.operand_address(lanes[mem], flags[mem], data1[mem], INST_FLAG_DST_REG, mem_faults)
+            mem_faults[self.check_memory_64(addr) & (mem_faults == NO_FAULT)] = fault_mem_err
+            faults[mem] = mem_faults
+            ok = mem_faults == NO_FAULT
+            self.write_memory_64(lanes[mem[ok]], addr[ok], values[mem[ok]])
+
+        regs = np.nonzero(is_reg & (faults == NO_FAULT))[0]
+        if len(regs):
+            limit = 10 if visible else 8
+            bad = data1[regs] >= limit
+            faults[regs[bad]] = fault_bad_reg
+            ok = regs[~bad]
+            self.regs[data1[ok].astype(np.intp), lanes[ok]] = values[ok]
+
+    def read_dst(self, lanes, flags, data1, faults):
+        # Value of an inc/dec target, which can't be a constant. Like
+        # emulator.read_dst, the constant flag is checked before the register
+        # flag, so a constant with a bad register is a flag fault.
+        is_const = ((flags & INST_FLAG_DST_MEM_OP) == 0) & ((flags & INST_FLAG_DST_CONST) != 0)
+        faults[is_const & (faults == NO_FAULT)] = fault_bad_flg
+        values, present = self.read_operand(lanes, flags, data1, INST_FLAG_DST_MEM_OP, INST_FLAG_DST_CONST, INST_FLAG_DST_REG, False, faults)
+        return values, present & ~is_const
+
+    def push(self, lanes, data, faults):
+        sp = self.regs[REG_SP, lanes]
+        faults[self.check_memory_64(sp) & (faults == NO_FAULT)] = fault_mem_err
+        ok = faults == NO_FAULT
+        self.write_memory_64(lanes[ok], sp[ok], data[ok])
+        self.regs[REG_SP, lanes[ok]] = sp[ok] + np.uint64(8)
+
+    def pop(self, lanes, faults):
+        sp = self.regs[REG_SP, lanes] - np.uint64(8)
+        self.regs[REG_SP, lanes] = sp
+        values, bad = self.read_memory_64(lanes, sp)
+        faults[bad & (faults == NO_FAULT)] = fault_mem_err
+        return values
+
+    # Opcode handlers, each gets the lanes running that opcode
+
+    def nop_handler(self, lanes, flags, data1, data2, faults):
+        pass
+
+    def move_handler(self, lanes, flags, data1, data2, faults):
+        values, present = self.read_operand(lanes, flags, data2, INST_FLAG_SRC_MEM_OP, INST_FLAG_SRC_CONST, INST_FLAG_SRC_REG, False, faults)
+        faults[~present & (faults == NO_FAULT)] = fault_bad_flg
+        self.write_dst(lanes, flags, data1, values, False, faults)
+
+    def hlt_handler(self, lanes, flags, data1, data2, faults):
+        self.regs[REG_FLAG, lanes] |= np.uint64(CPU_FLAG_HLT)
+
+    def jmp_handler(self, lanes, flags, data1, data2, faults):
+        values, present = self.read_operand(lanes, flags, data1, INST_FLAG_DST_MEM_OP, INST_FLAG_DST_CONST, INST_FLAG_DST_REG, False, faults)
+        jump = present & (faults == NO_FAULT)
+        self.regs[REG_IP, lanes[jump]] = values[jump]
+
+    def inc_handler(self, lanes, flags, data1, data2, faults):
+        values, present = self.read_dst(lanes, flags, data1, faults)
+        change = np.nonzero(present & (faults == NO_FAULT))[0]
+        change_faults = faults[change]
+        self.write_dst(lanes[change], flags[change], data1[change], values[change] + np.uint64(1), False, change_faults)
+        faults[change] = change_faults
+
+    def dec_handler(self, lanes, flags, data1, data2, faults):
+        values, present = self.read_dst(lanes, flags, data1, faults)
+        change = np.nonzero(present & (faults == NO_FAULT))[0]
+        change_faults = faults[change]
+        self.write_dst(lanes[change], flags[change], data1[change], values[change] - np.uint64(1), False, change_faults)
+        faults[change] = change_faults
+
+    def push_handler(self, lanes, flags, data1, data2, faults):
+        values, present = self.read_operand(lanes, flags, data1, INST_FLAG_DST_MEM_OP, INST_FLAG_DST_CONST, INST_FLAG_DST_REG, True, faults)
+        faults[~present & (faults == NO_FAULT)] = fault_bad_flg
+        self.push(lanes, values, faults)
+
+    def pop_handler(self, lanes, flags, data1, data2, faults):
+        values = self.pop(lanes, faults)
+        self.write_dst(lanes, flags, data1, values, True, faults)
+
+    def call_handler(self, lanes, flags, data1, data2, faults):
+        self.push(lanes, self.regs[REG_IP, lanes], faults)
+        pushed = np.nonzero(faults == NO_FAULT)[0]
+        jump_faults = faults[pushed]
+        self.jmp_handler(lanes[pushed], flags[pushed], data1[pushed], data2[pushed], jump_faults)
+        faults[pushed] = jump_faults
+
+    def ret_handler(self, lanes, flags, data1, data2, faults):
+        values = self.pop(lanes, faults)
+        ok = faults == NO_FAULT
+        self.regs[REG_IP, lanes[ok]] = values[ok]
+
+    # Execution
+
+    def step(self):
+        lanes = np.nonzero(self.running)[0]
+        if len(lanes) == 0:
+            return 0
+
+        # Fetch every lane's instruction, each lane has its own memory
+        ip = self.regs[REG_IP, lanes]
+        bad_fetch = ip > self.memory_size - INSTRUCTION_SIZE
+        if bad_fetch.any():
+            self.fault[lanes[bad_fetch]] = fault_mem_err
+            lanes = lanes[~bad_fetch]
+            ip = ip[~bad_fetch]
+            if len(lanes) == 0:
+                return 0
+
+        end = ip + np.uint64(INSTRUCTION_SIZE)
+        shared = (ip >= self.code_start) & (end <= self.code_end) & ((end <= self.write_low[lanes]) | (ip >= self.write_high[lanes]))
+        if shared.all():
+            index = (ip - np.uint64(self.code_start)).astype(np.intp)
+            opcodes = self.code_opcodes[index]
+            flags = self.code_flags[index]
+            data1 = self.code_data1[index]
+            data2 = self.code_data2[index]
+        else:
+            opcodes, flags, data1, data2 = self.fetch(lanes, ip, shared)
+
+        # Modify the IP before executing, so that jmp, etc. works
+        self.regs[REG_IP, lanes] = ip + np.uint64(INSTRUCTION_SIZE)
+
+        faults = np.full(len(lanes), NO_FAULT, dtype=np.int8)
+        for opcode in np.unique(opcodes):
+            group = np.nonzero(opcodes == opcode)[0]
+            handler = self.handlers.get(int(opcode))
+            if handler is None:
+                faults[group] = fault_invl_opcode
+                continue
+
+            group_faults = faults[group]
+            handler(lanes[group], flags[group], data1[group], data2[group], group_faults)
+            faults[group] = group_faults
+
+        faulted = faults != NO_FAULT
+        self.fault[lanes[faulted]] = faults[faulted]
+        self.clock_cycles[lanes[~faulted]] += np.uint64(1)
+        self.steps += 1
+        return len(lanes)
+
+    def fetch(self, lanes, ip, shared):
+        # Decode from each lane's own memory, except where the shared copy is still good
+        records = self.flat_memory[(self.lane_base[lanes] + ip.astype(np.intp))[:, None] + byte_offsets_instruction]
+        opcodes = records[:, 0].copy()
+        flags = records[:, 1].astype(np.uint64)
+        data1 = np.ascontiguousarray(records[:, 3:11]).view("<u8").reshape(len(lanes)).astype(np.uint64)
+        data2 = np.ascontiguousarray(records[:, 11:19]).view("<u8").reshape(len(lanes)).astype(np.uint64)
+        return opcodes, flags, data1, data2
+
+    def run(self, max_steps=None):
+        steps = 0
+        start = time.perf_counter()
+        try:
+            while max_steps is None or steps < max_steps:
+                if self.step() == 0:
+                    break
+                steps += 1
+        finally:
+            self.run_time += time.perf_counter() - start
+        return steps
+
+def main():
+    parser = argparse.ArgumentParser(description='Run a LiquidCPU executable on many CPUs at once.')
+    parser.add_argument('--lanes', '-n', type=int, default=1024, help='number of CPUs to run (default 1024)')
+    parser.add_argument('--max-steps', type=int, help='stop after this many steps')
+    parser.add_argument('--seed', type=int, help='start every lane with random r0-r7 from this seed')
+    parser.add_argument('filename')
+    result = parser.parse_args()
+
+    batch = liquidcpu_batch(result.lanes)
+    with open(result.filename, "rb") as fp:
+        try:
+            batch.load_file(fp.read())
+        except liquidcpu_liqfile_error as error:
+            print("[LiquidCPU] " + str(error))
+            quit()
+
+    if result.seed is not None:
+        rng = np.random.default_rng(result.seed)
+        batch.regs[:8] = rng.integers(0, 1 << 64, size=(8, result.lanes), dtype=np.uint64)
+
+    batch.run(result.max_steps)
+
+    halted = int(batch.halted.sum())
+    faulted = int((batch.fault != NO_FAULT).sum())
+    print("[LiquidCPU] " + str(halted) + " lanes halted, " + str(faulted) + " faulted, " + str(result.lanes - halted - faulted) + " still running.")
+    for fault_no in range(len(fault_names)):
+        count = int((batch.fault == fault_no).sum())
+        if count:
+            print("[LiquidCPU] " + str(count) + " lanes got fault " + str(fault_no) + " (" + fault_names[fault_no] + ")")
+    print("[LiquidCPU] steps: " + str(batch.steps) + ", clock_cycles: " + str(int(batch.clock_cycles.sum())))
+    print("[LiquidCPU] " + str(int(batch.instructions_per_second)) + " instructions per second.")
+
+if __name__ == "__main__":
+    main()
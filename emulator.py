@@ -0,0 +1,726 @@
+from struct import Struct
+import argparse
+import time
+
+from assembler import INST_FLAG_SRC_MEM_OP, INST_FLAG_DST_MEM_OP, INST_FLAG_SRC_CONST, INST_FLAG_DST_CONST, INST_FLAG_SRC_REG, INST_FLAG_DST_REG
+from assembler import instruction_names, instruction_struct, get_opcode, MEMORY_SIZE
+from liqfile import load_memory, liquidcpu_liqfile_error
+
+# Pure Python LiquidCPU, following src/cpu.c and src/microcode/opcode_handlers.c
+
+CPU_FLAG_HLT = (1<<0)
+
+# Indexes into liquidcpu_emulator.regs, same order as enum REGISTERS
+REG_IP   = 8
+REG_SP   = 9
+REG_FLAG = 10
+
+# enum FAULTS
+fault_invl_opcode = 0
+fault_bad_reg     = 1
+fault_mem_err     = 2
+fault_bad_flg     = 3
+fault_names       = ["invalid opcode", "bad register", "memory error", "bad flags"]
+
+INSTRUCTION_SIZE = instruction_struct.size
+REG_MASK = (1<<64) - 1
+
+qword_struct = Struct("<Q")
+
+opcode_nop  = get_opcode("nop")
+opcode_mov  = get_opcode("mov")
+opcode_hlt  = get_opcode("hlt")
+opcode_jmp  = get_opcode("jmp")
+opcode_inc  = get_opcode("inc")
+opcode_dec  = get_opcode("dec")
+opcode_push = get_opcode("push")
+opcode_pop  = get_opcode("pop")
+opcode_call = get_opcode("call")
+opcode_ret  = get_opcode("ret")
+
+class liquidcpu_fault(Exception):
+    def __init__(self, fault_no, ip, sp):
+        super().__init__("Unhandled fault " + str(fault_no) + " (" + fault_names[fault_no] + ") at IP = " + hex(ip) + " and SP = " + hex(sp))
+        self.fault_no = fault_no
+        self.ip = ip
+        self.sp = sp
+
+class liquidcpu_emulator:
+    def __init__(self, memory_size=MEMORY_SIZE):
+        self.memory_size = memory_size
+        self.memory = bytearray(memory_size)
+
+        # r0-r7, ip, sp, flag
+        self.regs = [0] * 11
+        self.regs[REG_SP] = 0x1000 # The stack starts at 0x1000, but should be changed by the user
+
+        self.clock_cycles = 0
+        self.run_time = 0.0
+
+        # Decoded instructions by address, and the range of code they cover
+        self.decoded = {}
+        self.code_low = memory_size
+        self.code_high = 0
+
+        self.handlers = {
+            "nop":  self.nop_handler,
+            "mov":  self.move_handler,
+            "hlt":  self.hlt_handler,
+            "jmp":  self.jmp_handler,
+            "inc":  self.inc_handler,
+            "dec":  self.dec_handler,
+            "push": self.push_handler,
+            "pop":  self.pop_handler,
+            "call": self.call_handler,
+            "ret":  self.ret_handler,
+        }
+        self.opcode_handlers = [self.handlers[name] for name in instruction_names]
+
+    @property
+    def ip(self):
+        return self.regs[REG_IP]
+
+    @property
+    def sp(self):
+        return self.regs[REG_SP]
+
+    @property
+    def flag(self):
+        return self.regs[REG_FLAG]
+
+    @property
+    def halted(self):
+        return bool(self.regs[REG_FLAG] & CPU_FLAG_HLT)
+
+    @property
+    def instructions_per_second(self):
+        if self.run_time == 0:
+            return 0.0
+        return self.clock_cycles / self.run_time
+
+    def load(self, image, address=0):
+        if address + len(image) > self.memory_size:
+            raise ValueError("image of " + str(len(image)) + " bytes does not fit in memory at " + hex(address))
+        self.memory[address:address + len(image)] = image
+        self.flush_decoded()
+
+    def load_file(self, data):
+        # A flat or --sectioned executable, as src/main.c loads them
+        memory, entry, sp = load_memory(data, self.memory_size)
+        self.load(memory)
+        self.regs[REG_IP] = entry
+        if sp is not None:
+            self.regs[REG_SP] = sp
+
+    def flush_decoded(self):
+        self.decoded.clear()
+        self.code_low = self.memory_size
+        self.code_high = 0
+
+    def fault(self, fault_no):
+        raise liquidcpu_fault(fault_no, self.regs[REG_IP], self.regs[REG_SP])
+
+    # Memory access
+
+    def read_memory_64(self, addr):
+        if addr + 8 > self.memory_size:
+            self.fault(fault_mem_err)
+        return qword_struct.unpack_from(self.memory, addr)[0]
+
+    def write_memory_64(self, addr, data):
+        if addr + 8 > self.memory_size:
+            self.fault(fault_mem_err)
+        qword_struct.pack_into(self.memory, addr, data)
+
+        # Drop any decoded instruction this write lands in
+        if addr < self.code_high and addr + 8 > self.code_low:
+            decoded = self.decoded
+            for code_addr in range(addr - INSTRUCTION_SIZE + 1, addr + 8):
+                decoded.pop(code_addr, None)
+
+    def get_gpr(self, register_info):
+        if register_info >= 8:
+            self.fault(fault_bad_reg)
+        return register_info
+
+    def get_visible_reg(self, register_info):
+        if register_info > REG_SP:
+            self.fault(fault_bad_reg)
+        return register_info
+
+    # Decoding
+
+    def decode(self, addr):
+        if addr + INSTRUCTION_SIZE > self.memory_size:
+            self.fault(fault_mem_err)
+
+        opcode, flags, operand_sizes, data1, data2 = instruction_struct.unpack_from(self.memory, addr)
+        if opcode < len(self.opcode_handlers):
+            handler = self.opcode_handlers[opcode]
+        else:
+            handler = self.bad_instruction_handler
+
+        entry = (handler, flags, data1, data2, opcode)
+        self.decoded[addr] = entry
+        if addr < self.code_low:
+            self.code_low = addr
+        if addr + INSTRUCTION_SIZE > self.code_high:
+            self.code_high = addr + INSTRUCTION_SIZE
+        return entry
+
+    # Execution
+
+    def step(self):
+        return self.run(1)
+
+    def run(self, max_cycles=None):
+        regs = self.regs
+        decoded = self.decoded
+        executed = 0
+        if max_cycles is None:
+            max_cycles = REG_MASK
+
+        start = time.perf_counter()
+        try:
+            while not regs[REG_FLAG] & CPU_FLAG_HLT and executed < max_cycles:
+
+                ip = regs[REG_IP]
+                entry = decoded.get(ip)
+                if entry is None:
+                    entry = self.decode(ip)
+
+                # Modify the IP before executing, so that jmp, etc. works
+                regs[REG_IP] = ip + INSTRUCTION_SIZE
+                entry[0](entry[1], entry[2], entry[3])
+                executed += 1
+        finally:
+            self.clock_cycles += executed
+            self.run_time += time.perf_counter() - start
+
+        return executed
+
+    # Operand helpers, shared by the handlers below. Like the C handlers, an
+    # operand with none of its flags set is skipped rather than faulting,
+    # except where C would use an uninitialized value.
+
+    def read_operand(self, flags, data, mem_op, const, reg, visible):
+        if flags & mem_op:
+            if flags & reg:
+                return self.read_memory_64(self.regs[self.get_gpr(data)])
+            return self.read_memory_64(data)
+        elif flags & const:
+            return data
+        elif flags & reg:
+            if visible:
+                return self.regs[self.get_visible_reg(data)]
+            return self.regs[self.get_gpr(data)]
+        return None
+
+    def write_dst(self, flags, data1, value, visible=False):
+        if flags & INST_FLAG_DST_MEM_OP:
+            if flags & INST_FLAG_DST_REG:
+                self.write_memory_64(self.regs[self.get_gpr(data1)], value)
+            else:
+                self.write_memory_64(data1, value)
+        elif flags & INST_FLAG_DST_CONST:
+            self.fault(fault_bad_flg)
+        elif flags & INST_FLAG_DST_REG:
+            if visible:
+                self.regs[self.get_visible_reg(data1)] = value
+            else:
+                self.regs[self.get_gpr(data1)] = value
+
+    def read_dst(self, flags, data1):
+        # Value of an inc/dec target, which can't be a constant
+        if flags & INST_FLAG_DST_MEM_OP:
+            if flags & INST_FLAG_DST_REG:
+                return self.read_memory_64(self.regs[self.get_gpr(data1)])
+            return self.read_memory_64(data1)
+        elif flags & INST_FLAG_DST_CONST:
+            self.fault(fault_bad_flg)
+        elif flags & INST_FLAG_DST_REG:
+            return self.regs[self.get_gpr(data1)]
+        return None
+
+    # Opcode handlers
+
+    def nop_handler(self, flags, data1, data2):
+        pass
+
+    def move_handler(self, flags, data1, data2):
+        value = self.read_operand(flags, data2, INST_FLAG_SRC_MEM_OP, INST_FLAG_SRC_CONST, INST_FLAG_SRC_REG, False)
+        if value is None:
+            self.fault(fault_bad_flg)
+        self.write_dst(flags, data1, value)
+
+    def hlt_handler(self, flags, data1, data2):
+        self.regs[REG_FLAG] |= CPU_FLAG_HLT
+
+    def jmp_handler(self, flags, data1, data2):
+        target = self.read_operand(flags, data1, INST_FLAG_DST_MEM_OP, INST_FLAG_DST_CONST, INST_FLAG_DST_REG, False)
+        if target is not None:
+            self.regs[REG_IP] = target
+
+    def inc_handler(self, flags, data1, data2):
+        value = self.read_dst(flags, data1)
+        if value is not None:
+            self.write_dst(flags, data1, (value + 1) & REG_MASK)
+
+    def dec_handler(self, flags, data1, data2):
+        value = self.read_dst(flags, data1)
+        if value is not None:
+            self.write_dst(flags, data1, (value - 1) & REG_MASK)
+
+    def push_handler(self, flags, data1, data2):
+        regs = self.regs
+        data = self.read_operand(flags, data1, INST_FLAG_DST_MEM_OP, INST_FLAG_DST_CONST, INST_FLAG_DST_REG, True)
+        if data is None:
+            self.fault(fault_bad_flg)
+        self.write_memory_64(regs[REG_SP], data)
+        regs[REG_SP] = (regs[REG_SP] + 8) & REG_MASK
+
+    def pop_handler(self, flags, data1, data2):
+        regs = self.regs
+        regs[REG_SP] = (regs[REG_SP] - 8) & REG_MASK
+        self.write_dst(flags, data1, self.read_memory_64(regs[REG_SP]), True)
+
+    def call_handler(self, flags, data1, data2):
+        self.push_handler(INST_FLAG_DST_REG, REG_IP, 0)
+        self.jmp_handler(flags, data1, data2)
+
+    def ret_handler(self, flags, data1, data2):
+        self.pop_handler(INST_FLAG_DST_REG, REG_IP, 0)
+
+    def bad_instruction_handler(self, flags, data1, data2):
+        self.fault(fault_invl_opcode)
+
+# Longest block translated at once, in instructions
+max_block_length = 256
+
+# Blocks are looked up by the bytes they cover in pages of 1 << this
+block_page_shift = 6
+
+class liquidcpu_block_fault(Exception):
+    # Raised from a translated block, with the instructions that ran before it
+    def __init__(self, executed, fault_no):
+        super().__init__(fault_names[fault_no])
+        self.executed = executed
+        self.fault_no = fault_no
+
+class liquidcpu_block_translator:
+    # Writes the Python source of one basic block: the instructions from
+    # start up to the first jmp, call, ret or hlt. block(budget) runs it,
+    # returns how many instructions it executed, and leaves regs[REG_IP] at
+    # where to go next. Registers live in locals while it runs and are
+    # written back at every exit. Every check the handlers do is either done
+    # here, when it only depends on the instruction, or written out inline,
+    # so faults happen at the same instruction with the same registers.
+    #
+    # A block that ends with a jmp back to its own start loops inside the
+    # function for as long as the budget allows.
+
+    def __init__(self, memory, memory_size, start):
+        self.memory = memory
+        self.memory_size = memory_size
+        self.start = start
+        self.end = start
+        self.length = 0
+        self.lines = []
+        self.used = set()
+        self.written = set()
+        self.writes_memory = False
+        self.loops = False
+        self.ended = False
+
+    # Source lines, where None is a register writeback and $done is how many
+    # instructions earlier passes of a loop ran
+
+    def emit(self, text, depth=0):
+        self.lines.append((depth, text))
+
+    def local(self, index):
+        self.used.add(index)
+        if index == REG_SP:
+            return "sp"
+        return "r" + str(index)
+
+    def assign(self, index, value):
+        self.emit(self.local(index) + " = " + value)
+        self.written.add(index)
+
+    def exit(self, executed, ip, depth=0):
+        self.emit(None, depth)
+        self.emit("regs[" + str(REG_IP) + "] = " + ip, depth)
+        self.emit("return $done" + str(executed), depth)
+
+    def fault(self, executed, ip, fault_no, depth=0):
+        self.emit(None, depth)
+        self.emit("fail($done" + str(executed) + ", " + str(ip) + ", " + str(fault_no) + ")", depth)
+        if depth == 0:
+            self.ended = True
+
+    # Memory, with address either a constant or the name of a register local
+
+    def check_address(self, address, executed, ip):
+        if isinstance(address, int):
+            if address + 8 > self.memory_size:
+                self.fault(executed, ip, fault_mem_err)
+            return str(address)
+        self.emit("a = " + address)
+        self.emit("if a > " + str(self.memory_size - 8) + ":")
+        self.fault(executed, ip, fault_mem_err, 1)
+        return "a"
+
+    def read_memory(self, address, executed, ip):
+        address = self.check_address(address, executed, ip)
+        if self.ended:
+            return None
+        self.emit("v = unpack(mem, " + address + ")[0]")
+        return "v"
+
+    def write_memory(self, address, value, executed, ip, checked=False):
+        if checked:
+            address = "a" if not isinstance(address, int) else str(address)
+        else:
+            address = self.check_address(address, executed, ip)
+            if self.ended:
+                return
+        self.emit("pack(mem, " + address + ", " + value + ")")
+        self.emit("if cm[" + address + "] or cm[" + address + " + 7]:")
+        self.emit("invalidate(" + address + ")", 1)
+        self.emit("stale = " + address + " < block_end and " + address + " + 8 > block_start", 1)
+        self.writes_memory = True
+
+    # Operands, like read_operand and write_dst
+
+    def operand(self, flags, data, mem_op, const, reg, visible, executed, ip):
+        if flags & mem_op:
+            if flags & reg:
+                if data >= 8:
+                    self.fault(executed, ip, fault_bad_reg)
+                    return None
+                return self.read_memory(self.local(data), executed, ip)
+            return self.read_memory(data, executed, ip)
+        elif flags & const:
+            return str(data)
+        elif flags & reg:
+            if data >= 8 and not (visible and data <= REG_SP):
+                self.fault(executed, ip, fault_bad_reg)
+                return None
+            if data == REG_IP:
+                return str(ip)
+            return self.local(data)
+        return None
+
+    def write_dst(self, flags, data, value, visible, executed, ip):
+        if flags & INST_FLAG_DST_MEM_OP:
+            if flags & INST_FLAG_DST_REG:
+                if data >= 8:
+                    self.fault(executed, ip, fault_bad_reg)
+                    return
+                self.write_memory(self.local(data), value, executed, ip)
+            else:
+                self.write_memory(data, value, executed, ip)
+        elif flags & INST_FLAG_DST_CONST:
+            self.fault(executed, ip, fault_bad_flg)
+        elif flags & INST_FLAG_DST_REG:
+            if data >= 8 and not (visible and data <= REG_SP):
+                self.fault(executed, ip, fault_bad_reg)
+            elif data == REG_IP:
+                # pop ip, which jumps
+                self.exit(executed + 1, value)
+                self.ended = True
+            else:
+                self.assign(data, value)
+
+    # Instructions
+
+    def instruction(self, opcode, flags, data1, data2, executed, ip):
+        if opcode == opcode_nop:
+            pass
+        elif opcode == opcode_mov:
+            value = self.operand(flags, data2, INST_FLAG_SRC_MEM_OP, INST_FLAG_SRC_CONST, INST_FLAG_SRC_REG, False, executed, ip)
+            if self.ended:
+                return
+            if value is None:
+                self.fault(executed, ip, fault_bad_flg)
+                return
+            self.write_dst(flags, data1, value, False, executed, ip)
+        elif opcode == opcode_hlt:
+            self.emit("regs[" + str(REG_FLAG) + "] |= " + str(CPU_FLAG_HLT))
+            self.exit(executed + 1, str(ip))
+            self.ended = True
+        elif opcode == opcode_jmp:
+            target = self.operand(flags, data1, INST_FLAG_DST_MEM_OP, INST_FLAG_DST_CONST, INST_FLAG_DST_REG, False, executed, ip)
+            if self.ended:
+                return
+            if not flags & INST_FLAG_DST_MEM_OP and flags & INST_FLAG_DST_CONST and data1 == self.start:
+                self.loops = True
+                self.emit("n += " + str(executed + 1))
+                self.emit("if n + " + str(executed + 1) + " > budget:")
+                self.emit(None, 1)
+                self.emit("regs[" + str(REG_IP) + "] = " + str(self.start), 1)
+                self.emit("return n", 1)
+            else:
+                self.exit(executed + 1, target or str(ip))
+            self.ended = True
+        elif opcode == opcode_inc or opcode == opcode_dec:
+            change = " + 1) & MASK" if opcode == opcode_inc else " - 1) & MASK"
+            if flags & INST_FLAG_DST_MEM_OP:
+                address = data1
+                if flags & INST_FLAG_DST_REG:
+                    if data1 >= 8:
+                        self.fault(executed, ip, fault_bad_reg)
+                        return
+                    address = self.local(data1)
+                value = self.read_memory(address, executed, ip)
+                if self.ended:
+                    return
+                self.write_memory(address, "(" + value + change, executed, ip, True)
+            elif flags & INST_FLAG_DST_CONST:
+                self.fault(executed, ip, fault_bad_flg)
+            elif flags & INST_FLAG_DST_REG:
+                if data1 >= 8:
+                    self.fault(executed, ip, fault_bad_reg)
+                    return
+                self.assign(data1, "(" + self.local(data1) + change)
+        elif opcode == opcode_push:
+            value = self.operand(flags, data1, INST_FLAG_DST_MEM_OP, INST_FLAG_DST_CONST, INST_FLAG_DST_REG, True, executed, ip)
+            if self.ended:
+                return
+            if value is None:
+                self.fault(executed, ip, fault_bad_flg)
+                return
+            self.write_memory(self.local(REG_SP), value, executed, ip)
+            self.assign(REG_SP, "(sp + 8) & MASK")
+        elif opcode == opcode_pop:
+            self.assign(REG_SP, "(sp - 8) & MASK")
+            value = self.read_memory(self.local(REG_SP), executed, ip)
+            if self.ended:
+                return
+            self.write_dst(flags, data1, value, True, executed, ip)
+        elif opcode == opcode_call:
+            self.write_memory(self.local(REG_SP), str(ip), executed, ip)
+            self.assign(REG_SP, "(sp + 8) & MASK")
+            target = self.operand(flags, data1, INST_FLAG_DST_MEM_OP, INST_FLAG_DST_CONST, INST_FLAG_DST_REG, False, executed, ip)
+            if self.ended:
+                return
+            self.exit(executed + 1, target or str(ip))
+            self.ended = True
+        elif opcode == opcode_ret:
+            self.assign(REG_SP, "(sp - 8) & MASK")
+            value = self.read_memory(self.local(REG_SP), executed, ip)
+            if self.ended:
+                return
+            self.exit(executed + 1, value)
+            self.ended = True
+        else:
+            self.fault(executed, ip, fault_invl_opcode)
+
+    def translate(self, max_length=max_block_length):
+        addr = self.start
+        executed = 0
+        while not self.ended:
+            if addr + INSTRUCTION_SIZE > self.memory_size:
+                # Fetching faults before the IP moves on
+                self.fault(executed, addr, fault_mem_err)
+                executed += 1
+                break
+            if executed == max_length:
+                self.exit(executed, str(addr))
+                break
+
+            opcode, flags, operand_sizes, data1, data2 = instruction_struct.unpack_from(self.memory, addr)
+            ip = addr + INSTRUCTION_SIZE
+            self.end = ip
+            self.writes_memory = False
+            self.instruction(opcode, flags, data1, data2, executed, ip)
+            executed += 1
+
+            # Leave once this block's own code was written to
+            if self.writes_memory and not self.ended:
+                self.emit("if stale:")
+                self.exit(executed, str(ip), 1)
+            addr = ip
+
+        # How many instructions the budget has to allow for
+        self.length = executed
+
+    def source(self):
+        writeback = ["regs[" + str(index) + "] = " + self.local(index) for index in sorted(self.written)]
+        lines = ["def block(budget):"]
+        lines += ["    " + self.local(index) + " = regs[" + str(index) + "]" for index in sorted(self.used)]
+        lines.append("    stale = False")
+        indent = "    "
+        done = ""
+        if self.loops:
+            lines.append("    n = 0")
+            lines.append("    while True:")
+            indent = "        "
+            done = "n + "
+
+        for depth, text in self.lines:
+            prefix = indent + "    " * depth
+            if text is None:
+                lines += [prefix + line for line in writeback]
+            else:
+                lines.append(prefix + text.replace("$done", done))
+        return "\n".join(lines) + "\n"
+
+class liquidcpu_block_emulator(liquidcpu_emulator):
+    # Runs translated basic blocks instead of dispatching every instruction,
+    # with the same results and clock_cycles as liquidcpu_emulator. Blocks
+    # are translated when first reached and dropped when memory they cover
+    # is written to.
+
+    def __init__(self, memory_size=MEMORY_SIZE):
+        super().__init__(memory_size)
+
+        # (function, length) by entry address, where each block ends, the
+        # blocks covering every page, and the bytes any block covers
+        self.blocks = {}
+        self.block_ends = {}
+        self.block_pages = {}
+        self.code_map = bytearray(memory_size)
+
+    def flush_decoded(self):
+        super().flush_decoded()
+        self.blocks.clear()
+        self.block_ends.clear()
+        self.block_pages.clear()
+        self.code_map[:] = bytes(self.memory_size)
+
+    def write_memory_64(self, addr, data):
+        super().write_memory_64(addr, data)
+        if self.code_map[addr] or self.code_map[addr + 7]:
+            self.invalidate(addr)
+
+    def block_fault(self, executed, ip, fault_no):
+        self.regs[REG_IP] = ip
+        raise liquidcpu_block_fault(executed, fault_no)
+
+    def translate(self, start):
+        translator = liquidcpu_block_translator(self.memory, self.memory_size, start)
+        translator.translate()
+        end = translator.end
+
+        namespace = {
+            "regs": self.regs,
+            "mem": self.memory,
+            "unpack": qword_struct.unpack_from,
+            "pack": qword_struct.pack_into,
+            "cm": self.code_map,
+            "invalidate": self.invalidate,
+            "fail": self.block_fault,
+            "MASK": REG_MASK,
+            "block_start": start,
+            "block_end": end,
+        }
+        exec(compile(translator.source(), "<block " + hex(start) + ">", "exec"), namespace)
+
+        block = (namespace["block"], translator.length)
+        self.blocks[start] = block
+        self.block_ends[start] = end
+        if end > start:
+            for page in range(start >> block_page_shift, ((end - 1) >> block_page_shift) + 1):
+                self.block_pages.setdefault(page, []).append(start)
+            self.code_map[start:end] = b"\1" * (end - start)
+        return block
+
+    def drop_block(self, start):
+        end = self.block_ends.pop(start)
+        del self.blocks[start]
+        for page in range(start >> block_page_shift, ((end - 1) >> block_page_shift) + 1):
+            self.block_pages[page].remove(start)
+
+    def invalidate(self, addr):
+        # Drop every block the qword at addr overlaps
+        pages = self.block_pages
+        block_ends = self.block_ends
+        for page in range(addr >> block_page_shift, ((addr + 7) >> block_page_shift) + 1):
+            for start in list(pages.get(page, ())):
+                if start < addr + 8 and block_ends[start] > addr:
+                    self.drop_block(start)
+
+        # So that bytes no block covers any more don't land here again
+        for byte in range(addr, addr + 8):
+            self.code_map[byte] = any([start <= byte < block_ends[start] for start in pages.get(byte >> block_page_shift, ())])
+
+    def run(self, max_cycles=None):
+        regs = self.regs
+        blocks = self.blocks
+        executed = 0
+        if max_cycles is None:
+            max_cycles = REG_MASK
+
+        start = time.perf_counter()
+        try:
+            while not regs[REG_FLAG] & CPU_FLAG_HLT and executed < max_cycles:
+                block = blocks.get(regs[REG_IP])
+                if block is None:
+                    block = self.translate(regs[REG_IP])
+
+                budget = max_cycles - executed
+                if block[1] <= budget:
+                    executed += block[0](budget)
+                    continue
+
+                # Not enough cycles left for the whole block, so finish one
+                # instruction at a time
+                ip = regs[REG_IP]
+                entry = self.decode(ip)
+                regs[REG_IP] = ip + INSTRUCTION_SIZE
+                entry[0](entry[1], entry[2], entry[3])
+                executed += 1
+        except liquidcpu_block_fault as fault:
+            executed += fault.executed
+            self.fault(fault.fault_no)
+        finally:
+            self.clock_cycles += executed
+            self.run_time += time.perf_counter() - start
+
+        return executed
+
+def print_registers(cpu):
+    print("[LiquidCPU] r0: " + hex(cpu.regs[0]) + "\n[LiquidCPU] r1: " + hex(cpu.regs[1]) + "\n[LiquidCPU] ip: " + hex(cpu.ip))
+    print("[LiquidCPU] clock_cycles: " + str(cpu.clock_cycles))
+
+def main():
+    parser = argparse.ArgumentParser(description='Run a LiquidCPU executable in Python.')
+    parser.add_argument('--max-cycles', type=int, help='stop after this many clock cycles')
+    parser.add_argument('--translate', action='store_true', help='translate basic blocks into Python functions instead of running one instruction at a time')
+    parser.add_argument('filename')
+    result = parser.parse_args()
+
+    cpu = liquidcpu_block_emulator() if result.translate else liquidcpu_emulator()
+    with open(result.filename, "rb") as fp:
+        try:
+            cpu.load_file(fp.read())
+        except liquidcpu_liqfile_error as error:
+            print("[LiquidCPU] " + str(error))
+            quit()
+
+    # Registers are printed every 100000000 cycles, like cpu_t does
+    report_interval = 100000000
+    try:
+        while not cpu.halted:
+            if result.max_cycles is not None and cpu.clock_cycles >= result.max_cycles:
+                break
+            cycles = report_interval - cpu.clock_cycles % report_interval
+            if result.max_cycles is not None:
+                cycles = min(cycles, result.max_cycles - cpu.clock_cycles)
+            cpu.run(cycles)
+            if cpu.clock_cycles % report_interval == 0:
+                print_registers(cpu)
+    except liquidcpu_fault as fault:
+        print("[LiquidCPU] Got fault: " + str(fault.fault_no))
+        print("[LiquidCPU] " + str(fault))
+        quit()
+
+    if cpu.halted:
+        print("[LiquidCPU] Halted.")
+    print_registers(cpu)
+    print("[LiquidCPU] " + str(int(cpu.instructions_per_second)) + " instructions per second.")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,341 @@
+import argparse
+import json
+
+import assembler
+from assembler import INST_FLAG_DST_MEM_OP, INST_FLAG_DST_CONST, INST_FLAG_DST_REG, instruction_struct, compact_magic
+from liqfile import is_liqfile
+from emulator import MEMORY_SIZE, REG_IP, REG_SP, INSTRUCTION_SIZE
+from emulator import opcode_nop, opcode_mov, opcode_hlt, opcode_jmp, opcode_inc, opcode_dec, opcode_push, opcode_pop, opcode_call, opcode_ret
+
+# Finds out how deep the stack of a program can get without running it.
+#
+# Every function (address 0 and every call to a constant) is walked from
+# its entry. LiquidCPU has no conditional jumps, so each function has
+# exactly one path: straight on, through jmps to constants, until a ret or
+# hlt, a jmp through a register or memory, or a jmp back onto the path,
+# which loops forever. Calls continue after the call once the callee
+# returns. Along the path push and call add 8 bytes to the stack and pop
+# and ret take them off again, so the worst case depth of a function is the
+# deepest point of its own path, with the depth of every callee added at
+# its call.
+#
+# Functions that call themselves, directly or not, have no worst case, and
+# neither do loops that push more than they pop.
+
+# Where cpu_t starts the stack, it grows up from here
+default_sp = 0x1000
+
+# How a path can end
+end_ret      = "ret"
+end_hlt      = "hlt"
+end_loop     = "loop"
+end_indirect = "indirect jmp"
+end_pop_ip   = "pop ip"
+end_invalid  = "invalid opcode"
+end_image    = "end of image"
+
+other_opcodes = set([opcode_nop, opcode_mov, opcode_inc, opcode_dec])
+
+class liquidcpu_function:
+    def __init__(self, entry, name):
+        self.entry = entry
+        self.name = name
+
+        # The path, the stack offset from the entry before each of its
+        # instructions, and the calls on it as (index, callee address)
+        self.path = []
+        self.offsets = []
+        self.calls = []
+        self.end = None
+        self.loop_start = None
+
+        # Deepest offset of the pushes on the path, not counting calls
+        self.own_depth = 0
+        self.stack_unknown = False
+        self.notes = []
+
+        # Filled in over the call graph, None if there is no bound
+        self.depth = None
+        self.instructions = None
+        self.chain = []
+        self.recursive = False
+
+    def blocks(self):
+        # The path as runs of consecutive instructions, for the CFG
+        runs = []
+        for addr in self.path:
+            if runs and runs[-1][1] == addr:
+                runs[-1][1] = addr + INSTRUCTION_SIZE
+            else:
+                runs.append([addr, addr + INSTRUCTION_SIZE])
+        return runs
+
+class liquidcpu_analysis:
+    def __init__(self, image, labels=None, sp=default_sp, memory_size=MEMORY_SIZE):
+        self.image = image
+        self.sp = sp
+        self.memory_size = memory_size
+
+        # Name of every labeled address, the first label wins
+        self.names = {}
+        for name, address in (labels or {}).items():
+            self.names.setdefault(address, name)
+
+        self.functions = {}
+        self.indirect_calls = 0
+        self.find_functions()
+        self.find_depths()
+
+    def name(self, address):
+        return self.names.get(address, hex(address))
+
+    def find_functions(self):
+        pending = [0]
+        while pending:
+            entry = pending.pop()
+            if entry in self.functions:
+                continue
+            function = self.walk(entry)
+            self.functions[entry] = function
+            for index, callee in function.calls:
+                if callee is not None and callee not in self.functions:
+                    pending.append(callee)
+
+    def walk(self, entry):
+        function = liquidcpu_function(entry, self.name(entry))
+        seen = {}
+        addr = entry
+        offset = 0
+
+        while True:
+            if addr in seen:
+                function.end = end_loop
+                function.loop_start = addr
+                change = offset - function.offsets[seen[addr]]
+                if change > 0:
+                    function.stack_unknown = True
+                    function.notes.append("loop at " + self.name(addr) + " grows the stack by " + str(change) + " bytes every time")
+                elif change < 0:
+                    function.notes.append("loop at " + self.name(addr) + " pops " + str(-change) + " bytes more than it pushes every time")
+                break
+            if addr + INSTRUCTION_SIZE > len(self.image):
+                function.end = end_image
+                break
+
+            opcode, flags, operand_sizes, data1, data2 = instruction_struct.unpack_from(self.image, addr)
+            seen[addr] = len(function.path)
+            function.path.append(addr)
+            function.offsets.append(offset)
+            next_addr = addr + INSTRUCTION_SIZE
+            jumps_to_constant = not flags & INST_FLAG_DST_MEM_OP and flags & INST_FLAG_DST_CONST
+
+            if opcode in other_opcodes:
+                pass
+            elif opcode == opcode_hlt:
+                function.end = end_hlt
+                break
+            elif opcode == opcode_push:
+                offset += 8
+                function.own_depth = max(function.own_depth, offset)
+            elif opcode == opcode_pop:
+                offset -= 8
+                if offset == -8:
+                    function.notes.append("pops past its entry at " + hex(addr))
+                if flags & INST_FLAG_DST_REG and not flags & INST_FLAG_DST_MEM_OP:
+                    if data1 == REG_IP:
+                        function.end = end_pop_ip
+                        break
+                    if data1 == REG_SP:
+                        function.stack_unknown = True
+                        function.notes.append("pop sp at " + hex(addr))
+            elif opcode == opcode_call:
+                if jumps_to_constant:
+                    function.calls.append((len(function.path) - 1, data1))
+                elif flags & (INST_FLAG_DST_MEM_OP | INST_FLAG_DST_REG):
+                    function.calls.append((len(function.path) - 1, None))
+                    function.notes.append("call through a register or memory at " + hex(addr))
+                    self.indirect_calls += 1
+            elif opcode == opcode_ret:
+                if offset > 0:
+                    function.notes.append("ret at " + hex(addr) + " with " + str(offset) + " bytes still pushed")
+                function.end = end_ret
+                break
+            elif opcode == opcode_jmp:
+                if jumps_to_constant:
+                    next_addr = data1
+                elif flags & (INST_FLAG_DST_MEM_OP | INST_FLAG_DST_REG):
+                    function.end = end_indirect
+                    break
+            else:
+                function.end = end_invalid
+                break
+
+            addr = next_addr
+
+        return function
+
+    def find_depths(self):
+        # Post order walk of the call graph from every function, callees
+        # first. Reaching a function that is still being walked is a cycle,
+        # and everything on the walk from there on is recursive.
+        done = set()
+        for root in self.functions:
+            if root in done:
+                continue
+            walking = [root]
+            on_walk = {root: 0}
+            callees = [iter(self.callees(root))]
+            while walking:
+                callee = next(callees[-1], None)
+                if callee is None:
+                    entry = walking.pop()
+                    callees.pop()
+                    del on_walk[entry]
+                    self.finish(self.functions[entry])
+                    done.add(entry)
+                elif callee in on_walk:
+                    for entry in walking[on_walk[callee]:]:
+                        self.functions[entry].recursive = True
+                elif callee not in done:
+                    on_walk[callee] = len(walking)
+                    walking.append(callee)
+                    callees.append(iter(self.callees(callee)))
+
+    def callees(self, entry):
+        return [callee for index, callee in self.functions[entry].calls if callee is not None]
+
+    def finish(self, function):
+        # Depth, inclusive instruction count and deepest call chain, once
+        # every callee is finished
+        if function.recursive:
+            return
+
+        depth = None if function.stack_unknown else function.own_depth
+        instructions = len(function.path)
+        chain = []
+        for index, callee in function.calls:
+            if callee is None:
+                # At least the return address
+                if depth is not None:
+                    depth = max(depth, function.offsets[index] + 8)
+                continue
+            called = self.functions[callee]
+            if called.instructions is None:
+                instructions = None
+            elif instructions is not None:
+                instructions += called.instructions
+            if called.depth is None:
+                depth = None
+            elif depth is not None and function.offsets[index] + 8 + called.depth > depth:
+                depth = function.offsets[index] + 8 + called.depth
+                chain = [callee] + called.chain
+
+        function.depth = depth
+        function.instructions = instructions
+        function.chain = chain
+
+    # Reports
+
+    def warnings(self):
+        entry = self.functions[0]
+        warnings = []
+        if entry.depth is None:
+            warnings.append("the stack has no bound from address 0")
+        else:
+            if self.sp + entry.depth > self.memory_size:
+                warnings.append("the stack can reach " + hex(self.sp + entry.depth) + ", past the end of memory at " + hex(self.memory_size))
+            if entry.depth and self.sp < len(self.image):
+                warnings.append("the stack from " + hex(self.sp) + " can overwrite the image up to " + hex(min(len(self.image), self.sp + entry.depth)))
+        for function in self.functions.values():
+            if function.recursive:
+                warnings.append(function.name + " is recursive")
+        if self.indirect_calls:
+            warnings.append("calls through registers or memory aren't followed (" + str(self.indirect_calls) + ")")
+        return warnings
+
+    def to_json(self):
+        functions = []
+        for entry in sorted(self.functions):
+            function = self.functions[entry]
+            functions.append({
+                "name": function.name,
+                "address": entry,
+                "end": function.end,
+                "loop_start": function.loop_start,
+                "path_instructions": len(function.path),
+                "instructions": function.instructions,
+                "stack": function.depth,
+                "own_stack": None if function.stack_unknown else function.own_depth,
+                "recursive": function.recursive,
+                "calls": sorted(set([self.name(callee) for callee in self.callees(entry)])),
+                "deepest_chain": [self.name(callee) for callee in function.chain],
+                "blocks": function.blocks(),
+                "notes": function.notes,
+            })
+        return {"sp": self.sp, "image_size": len(self.image), "functions": functions, "warnings": self.warnings()}
+
+    def format(self):
+        def unbounded(value):
+            return "unbounded" if value is None else str(value)
+
+        lines = [("function", "address", "stack", "instructions", "ends at", "calls")]
+        for entry in sorted(self.functions):
+            function = self.functions[entry]
+            lines.append((function.name, hex(entry), unbounded(function.depth), unbounded(function.instructions), function.end, ", ".join(sorted(set([self.name(callee) for callee in self.callees(entry)])))))
+        widths = [max([len(line[column]) for line in lines]) for column in range(len(lines[0]) - 1)]
+        out = ["  ".join([text.ljust(width) for text, width in zip(line, widths)] + [line[-1]]).rstrip() for line in lines]
+
+        entry = self.functions[0]
+        if entry.depth is not None:
+            out.append("")
+            out.append("Deepest call chain: " + " -> ".join([entry.name] + [self.name(callee) for callee in entry.chain]) + " (" + str(entry.depth) + " bytes)")
+        for function in [self.functions[entry] for entry in sorted(self.functions)]:
+            for note in function.notes:
+                out.append(function.name + ": " + note)
+        for warning in self.warnings():
+            out.append("Warning: " + warning)
+        return "\n".join(out)
+
+def assemble_for_analysis(filenames):
+    # Image and labels of sources, linked like assembler.py does
+    objects = assembler.assemble_objects(filenames)
+    labels = {}
+    base = 0
+    for obj in objects:
+        for name, address in obj.labels.items():
+            labels.setdefault(name, base + address)
+        base += len(obj.image)
+    return bytes(assembler.link_objects(objects)), labels
+
+def main():
+    parser = argparse.ArgumentParser(description='Find the worst case stack depth and call graph of a LiquidCPU program without running it.')
+    parser.add_argument('--sp', type=lambda text: int(text, 0), default=default_sp, help='where the stack starts (default 0x1000)')
+    parser.add_argument('--json', action='store_true', help='print the call graph, paths and depths as JSON')
+    parser.add_argument('inputs', nargs='+', help='a .liq image, or the sources of one program')
+    result = parser.parse_args()
+
+    if len(result.inputs) == 1 and result.inputs[0].endswith(".liq"):
+        with open(result.inputs[0], "rb") as fp:
+            image = fp.read()
+        labels = None
+        if image[:len(compact_magic)] == compact_magic:
+            print(result.inputs[0] + ": compact file, decode it with lasm_compact.py first")
+            quit(1)
+        if is_liqfile(image):
+            print(result.inputs[0] + ": sectioned file, flatten it with liqfile.py --flat first")
+            quit(1)
+    else:
+        try:
+            image, labels = assemble_for_analysis(result.inputs)
+        except assembler.liquidcpu_assembler_error as error:
+            assembler.print_assembler_error(error)
+            quit(1)
+
+    analysis = liquidcpu_analysis(image, labels, result.sp)
+    if result.json:
+        print(json.dumps(analysis.to_json(), indent=2))
+    else:
+        print(analysis.format())
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,234 @@
+import argparse
+import gc
+import json
+import platform
+import random
+import time
+
+import assembler
+
+# Benchmarks every phase of the assembler on generated programs.
+#
+# Each case is a set of generator parameters. The program for a case is the
+# same on every run (it only depends on the parameters and the seed), so
+# results from different versions of the assembler can be compared phase by
+# phase with --compare.
+
+# Relative weight of each kind of line, when not given with --mix
+default_mix = {
+    "mov":  10,
+    "jmp":  1,
+    "call": 1,
+    "ret":  1,
+    "push": 1,
+    "pop":  1,
+    "inc":  1,
+    "dec":  1,
+    "nop":  1,
+    "hlt":  0,
+    "dq":   1,
+}
+
+benchmark_cases = {
+    "small":        {"lines": 2000,   "label_every": 10, "bracket_ratio": 0.2},
+    "large":        {"lines": 100000, "label_every": 10, "bracket_ratio": 0.2},
+    "dense_labels": {"lines": 50000,  "label_every": 1,  "bracket_ratio": 0.2},
+    "brackets":     {"lines": 50000,  "label_every": 10, "bracket_ratio": 0.9},
+    "branches":     {"lines": 50000,  "label_every": 4,  "bracket_ratio": 0.1, "mix": {"mov": 2, "jmp": 4, "call": 4, "ret": 2}},
+    "data":         {"lines": 50000,  "label_every": 20, "bracket_ratio": 0.2, "mix": {"mov": 2, "dq": 10}},
+}
+
+phase_names = ["tokenize", "find_labels", "encode_tokens", "emit", "single_pass"]
+
+def generate_program(lines, label_every=10, mix=None, bracket_ratio=0.2, seed=1):
+    # A valid program of about `lines` instruction lines, with a label every
+    # label_every lines. Operands pick a register, a constant or a label, and
+    # bracket_ratio of them are memory operands.
+    rng = random.Random(seed)
+    weights = dict(default_mix)
+    if mix is not None:
+        weights.update(mix)
+    kinds = [name for name in weights if weights[name] > 0]
+    kind_weights = [weights[name] for name in kinds]
+
+    label_count = max(1, (lines + label_every - 1) // label_every)
+    label_names = ["label_" + str(index) for index in range(label_count)]
+
+    def register():
+        return assembler.gprs[rng.randrange(len(assembler.gprs))]
+
+    def operand(writable):
+        if rng.random() < bracket_ratio:
+            choice = rng.random()
+            if choice < 0.4:
+                return "[" + register() + "]"
+            elif choice < 0.8:
+                return "[" + rng.choice(label_names) + "]"
+            return "[" + str(rng.randrange(0x4000)) + "]"
+        elif writable:
+            return register()
+
+        choice = rng.random()
+        if choice < 0.5:
+            return register()
+        elif choice < 0.8:
+            return str(rng.randrange(1 << 32))
+        return rng.choice(label_names)
+
+    out = []
+    for index, kind in enumerate(rng.choices(kinds, kind_weights, k=lines)):
+        if index % label_every == 0:
+            out.append(label_names[index // label_every] + ":")
+
+        if kind == "mov":
+            out.append("    mov " + operand(True) + ", " + operand(False))
+        elif kind == "jmp" or kind == "call":
+            out.append("    " + kind + " " + rng.choice(label_names))
+        elif kind == "push":
+            out.append("    push " + operand(False))
+        elif kind in ("pop", "inc", "dec"):
+            out.append("    " + kind + " " + operand(True))
+        elif kind == "dq":
+            out.append("    dq " + str(rng.randrange(1 << 64)))
+        else:
+            out.append("    " + kind)
+
+    return "\n".join(out) + "\n"
+
+def time_phase(function, repeat):
+    # Best of repeat runs, and the result of the last one
+    best = None
+    for _ in range(repeat):
+        gc.collect()
+        start = time.perf_counter()
+        result = function()
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best, result
+
+def run_case(name, params, repeat, seed):
+    source = generate_program(seed=seed, **params)
+    filename = name + ".lasm"
+
+    times = {}
+    times["tokenize"], tokens = time_phase(lambda: assembler.tokenize(source, filename), repeat)
+    times["find_labels"], labels = time_phase(lambda: assembler.find_labels(tokens, filename), repeat)
+    times["encode_tokens"], instructions = time_phase(lambda: assembler.encode_tokens(tokens, labels, filename, []), repeat)
+    times["emit"], image = time_phase(lambda: assembler.emit_buffer(instructions), repeat)
+
+    # --single-pass does the work of find_labels and encode_tokens at once
+    times["single_pass"], result = time_phase(lambda: assembler.encode_single_pass(tokens, filename, []), repeat)
+
+    return {
+        "params": params,
+        "lines": source.count("\n"),
+        "tokens": len(tokens),
+        "labels": len(labels),
+        "bytes": len(image),
+        "phases": times,
+        "total": sum(times.values()) - times["single_pass"],
+    }
+
+def compare_results(baseline, results, threshold, min_delta):
+    # Returns the regressions, as (case, phase, old, new)
+    regressions = []
+    for name, case in results["cases"].items():
+        old_case = baseline["cases"].get(name)
+        if old_case is None:
+            print(name + ": not in the baseline, skipped")
+            continue
+        if old_case["params"] != case["params"]:
+            print(name + ": generated with different parameters, skipped")
+            continue
+
+        for phase in phase_names + ["total"]:
+            if phase == "total":
+                old, new = old_case["total"], case["total"]
+            else:
+                old, new = old_case["phases"].get(phase), case["phases"].get(phase)
+            if old is None or new is None:
+                continue
+
+            change = (new - old) / old * 100 if old > 0 else 0.0
+            regressed = change > threshold and new - old > min_delta
+            print("{:<14} {:<14} {:>10.4f}s {:>10.4f}s {:>+8.1f}%{}".format(name, phase, old, new, change, "  REGRESSION" if regressed else ""))
+            if regressed:
+                regressions.append((name, phase, old, new))
+
+    return regressions
+
+def parse_mix(text):
+    mix = {}
+    for item in text.split(","):
+        name, _, weight = item.partition("=")
+        if name not in default_mix:
+            raise argparse.ArgumentTypeError("unknown line kind " + name)
+        mix[name] = float(weight)
+    return mix
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the LiquidCPU assembler phase by phase.')
+    parser.add_argument('--output', '-o', help='write the results to this JSON file')
+    parser.add_argument('--compare', '-c', help='compare against results saved with -o, and fail on regressions')
+    parser.add_argument('--threshold', type=float, default=10.0, help='percent slowdown of a phase that counts as a regression (default 10)')
+    parser.add_argument('--min-delta', type=float, default=0.001, help='ignore slowdowns smaller than this many seconds (default 0.001)')
+    parser.add_argument('--repeat', '-r', type=int, default=5, help='runs per phase, the best one is kept (default 5)')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--case', action='append', choices=sorted(benchmark_cases), help='only run this case, can be given more than once')
+    parser.add_argument('--lines', type=int, help='run a custom case with this many lines instead')
+    parser.add_argument('--label-every', type=int, default=10, help='custom case: lines per label')
+    parser.add_argument('--bracket-ratio', type=float, default=0.2, help='custom case: share of memory operands')
+    parser.add_argument('--mix', type=parse_mix, help='custom case: line kind weights, like mov=10,jmp=2,dq=1')
+    parser.add_argument('--write-source', help='write the generated program of the custom case to this file and stop')
+    result = parser.parse_args()
+
+    if result.lines is not None:
+        params = {"lines": result.lines, "label_every": result.label_every, "bracket_ratio": result.bracket_ratio}
+        if result.mix is not None:
+            params["mix"] = result.mix
+        cases = {"custom": params}
+    else:
+        cases = {name: benchmark_cases[name] for name in (result.case or benchmark_cases)}
+
+    if result.write_source:
+        if result.lines is None:
+            print("usage error!")
+            print("--write-source needs --lines")
+            quit(2)
+        with open(result.write_source, "w") as fp:
+            fp.write(generate_program(seed=result.seed, **cases["custom"]))
+        return
+
+    results = {
+        "assembler_version": assembler.ASSEMBLER_VERSION,
+        "python": platform.python_version(),
+        "repeat": result.repeat,
+        "seed": result.seed,
+        "cases": {},
+    }
+
+    for name, params in cases.items():
+        case = run_case(name, params, result.repeat, result.seed)
+        results["cases"][name] = case
+        print("{:<14} {:>8} lines  ".format(name, case["lines"]) + "  ".join(phase + " " + "{:.4f}s".format(case["phases"][phase]) for phase in phase_names))
+
+    if result.output:
+        with open(result.output, "w") as fp:
+            json.dump(results, fp, indent=2)
+
+    if result.compare:
+        with open(result.compare) as fp:
+            baseline = json.load(fp)
+        if baseline.get("seed") != result.seed:
+            print("Warning: the baseline was generated with seed " + str(baseline.get("seed")))
+
+        print()
+        regressions = compare_results(baseline, results, result.threshold, result.min_delta)
+        if regressions:
+            print(str(len(regressions)) + " phase(s) regressed by more than " + str(result.threshold) + "%.")
+            quit(1)
+        print("No regressions.")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,144 @@
+from struct import Struct, error as struct_error
+import hashlib
+import os
+
+# On-disk cache of per-file assembly results.
+#
+# Every entry is a single file named after the hash of the source and the
+# assembler version, laid out as:
+#   header:      magic, name count, label count, relocation count, image size,
+#                instructions removed by -O
+#   names:       length and utf-8 bytes of every label name used, once each
+#   labels:      name index, address
+#   relocations: offset, source line, name index
+#   image:       the encoded output of the file
+# Entries are touched on every hit, so evicting the oldest mtime first is LRU.
+
+cache_magic       = b"LQC3"
+header_struct     = Struct("<4sIIIII")
+name_struct       = Struct("<H")
+label_struct      = Struct("<IQ")
+relocation_struct = Struct("<QII")
+
+class liquidcpu_cache:
+    def __init__(self, directory, max_size, version):
+        self.directory = directory
+        self.max_size = max_size
+        self.version = str(version).encode()
+        self.hits = 0
+        self.misses = 0
+
+        os.makedirs(directory, exist_ok=True)
+
+    def key(self, source):
+        digest = hashlib.sha256(self.version + b"\0")
+        digest.update(source)
+        return digest.hexdigest()
+
+    def lookup(self, key):
+        path = os.path.join(self.directory, key)
+        try:
+            with open(path, "rb") as fp:
+                entry = fp.read()
+        except OSError:
+            self.misses += 1
+            return None
+
+        result = self.decode_entry(entry)
+        if result is None:
+            # Damaged entry, drop it and assemble again
+            self.remove(path)
+            self.misses += 1
+            return None
+
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+
+        self.hits += 1
+        return result
+
+    def store(self, key, image, labels, relocations, instructions_saved=0):
+        names = {}
+        for name in labels:
+            names.setdefault(name, len(names))
+        for offset, name, line in relocations:
+            names.setdefault(name, len(names))
+
+        parts = [header_struct.pack(cache_magic, len(names), len(labels), len(relocations), len(image), instructions_saved)]
+        for name in names:
+            encoded_name = name.encode()
+            parts.append(name_struct.pack(len(encoded_name)))
+            parts.append(encoded_name)
+        for name, address in labels.items():
+            parts.append(label_struct.pack(names[name], address))
+        for offset, name, line in relocations:
+            parts.append(relocation_struct.pack(offset, line, names[name]))
+        parts.append(image)
+
+        # Write to a temporary name first so readers never see half an entry
+        path = os.path.join(self.directory, key)
+        temp_path = path + "." + str(os.getpid()) + ".tmp"
+        try:
+            with open(temp_path, "wb") as fp:
+                fp.write(b"".join(parts))
+            os.replace(temp_path, path)
+        except OSError:
+            self.remove(temp_path)
+
+    def decode_entry(self, entry):
+        try:
+            magic, name_count, label_count, relocation_count, size, instructions_saved = header_struct.unpack_from(entry, 0)
+            if magic != cache_magic:
+                return None
+
+            offset = header_struct.size
+            names = []
+            for _ in range(name_count):
+                name_length, = name_struct.unpack_from(entry, offset)
+                offset += name_struct.size
+                names.append(entry[offset:offset + name_length].decode())
+                offset += name_length
+
+            labels = {}
+            for _ in range(label_count):
+                name_index, address = label_struct.unpack_from(entry, offset)
+                labels[names[name_index]] = address
+                offset += label_struct.size
+
+            relocations = []
+            for _ in range(relocation_count):
+                field_offset, line, name_index = relocation_struct.unpack_from(entry, offset)
+                relocations.append((field_offset, names[name_index], line))
+                offset += relocation_struct.size
+        except (struct_error, UnicodeDecodeError, IndexError):
+            return None
+
+        if len(entry) - offset != size:
+            return None
+
+        return entry[offset:], labels, relocations, instructions_saved
+
+    def trim(self):
+        # Evict the least recently used entries until the cache fits
+        entries = []
+        total_size = 0
+        for entry in os.scandir(self.directory):
+            if entry.is_file() and not entry.name.endswith(".tmp"):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+                total_size += stat.st_size
+
+        entries.sort()
+        for mtime, size, path in entries:
+            if total_size <= self.max_size:
+                break
+            self.remove(path)
+            total_size -= size
+
+    def remove(self, path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
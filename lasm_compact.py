@@ -0,0 +1,125 @@
+import argparse
+
+from assembler import compact_magic, compact_header_struct, compact_run_struct, compact_field_struct, compact_head_struct
+from assembler import operand_size_structs, instruction_struct, data_struct, INST_FLAGS_DST, INST_FLAGS_SRC
+from assembler import COMPACT_VERSION
+
+# Reads files written with lasm --compact, and turns them back into the
+# fixed layout. The result is the same as assembling the source without
+# --compact.
+
+class liquidcpu_compact_error(Exception):
+    pass
+
+def read_compact(data):
+    # Returns the image, the data runs and the address fields of a compact file
+    if len(data) < compact_header_struct.size:
+        raise liquidcpu_compact_error("file is too short for a header")
+    magic, version, reserved, run_count, field_count, size = compact_header_struct.unpack_from(data, 0)
+    if magic != compact_magic:
+        raise liquidcpu_compact_error("not a compact LiquidCPU file")
+    if version != COMPACT_VERSION:
+        raise liquidcpu_compact_error("unsupported compact format version " + str(version))
+
+    offset = compact_header_struct.size
+    data_runs = [run for run in compact_run_struct.iter_unpack(data[offset:offset + run_count * compact_run_struct.size])]
+    offset += run_count * compact_run_struct.size
+    fields = [field for field, in compact_field_struct.iter_unpack(data[offset:offset + field_count * compact_field_struct.size])]
+    offset += field_count * compact_field_struct.size
+
+    if len(data) - offset != size:
+        raise liquidcpu_compact_error("image is " + str(len(data) - offset) + " bytes, the header says " + str(size))
+    return memoryview(data)[offset:], data_runs, fields
+
+def decode_compact(data):
+    image, data_runs, fields = read_compact(data)
+
+    # Every record in the fixed layout, and where each one starts in both
+    records = []
+    fixed_address = {}
+    fixed_field = {}
+    address = 0
+    fixed = 0
+    runs = iter(data_runs + [(len(image), 0)])
+    run_start, run_size = next(runs)
+
+    while address < len(image):
+        fixed_address[address] = fixed
+        if address == run_start:
+            for offset in range(address, address + run_size, data_struct.size):
+                fixed_address[offset] = fixed
+                records.append(("data", data_struct.unpack_from(image, offset)[0]))
+                fixed += data_struct.size
+            address += run_size
+            run_start, run_size = next(runs)
+            continue
+
+        if address + compact_head_struct.size > min(run_start, len(image)):
+            raise liquidcpu_compact_error("instruction at " + hex(address) + " runs past the end of the code")
+        opcode, flags, operand_sizes = compact_head_struct.unpack_from(image, address)
+        operands = [0, 0]
+        field = address + compact_head_struct.size
+        for slot, used, size_code in ((0, INST_FLAGS_DST, operand_sizes >> 4), (1, INST_FLAGS_SRC, operand_sizes & 0xf)):
+            if not flags & used:
+                continue
+            if size_code >= len(operand_size_structs) or field + operand_size_structs[size_code].size > min(run_start, len(image)):
+                raise liquidcpu_compact_error("bad operand in the instruction at " + hex(address))
+            operands[slot] = operand_size_structs[size_code].unpack_from(image, field)[0]
+            fixed_field[field] = (len(records), slot)
+            field += operand_size_structs[size_code].size
+
+        records.append(("instruction", [opcode, flags, operands[0], operands[1]]))
+        fixed += instruction_struct.size
+        address = field
+    fixed_address[address] = fixed
+
+    # Label addresses move with what they point at
+    for field in fields:
+        if field not in fixed_field:
+            raise liquidcpu_compact_error("address field at " + hex(field) + " is not an operand")
+        index, slot = fixed_field[field]
+        value = records[index][1][2 + slot]
+        if value not in fixed_address:
+            raise liquidcpu_compact_error("address " + hex(value) + " used at " + hex(field) + " is not the start of an instruction")
+        records[index][1][2 + slot] = fixed_address[value]
+
+    # The fixed layout leaves the operand sizes 0
+    out = bytearray(fixed)
+    offset = 0
+    for kind, record in records:
+        if kind == "instruction":
+            instruction_struct.pack_into(out, offset, record[0], record[1], 0, record[2], record[3])
+            offset += instruction_struct.size
+        else:
+            data_struct.pack_into(out, offset, record)
+            offset += data_struct.size
+    return bytes(out)
+
+def main():
+    parser = argparse.ArgumentParser(description='Decode a compact LiquidCPU executable into the fixed layout.')
+    parser.add_argument('--output', '-o', help='where to write the fixed layout (default lasm.liq)')
+    parser.add_argument('--info', action='store_true', help='only print what is in the header')
+    parser.add_argument('filename')
+    result = parser.parse_args()
+
+    with open(result.filename, "rb") as fp:
+        data = fp.read()
+
+    try:
+        if result.info:
+            image, data_runs, fields = read_compact(data)
+            print("Compact format version " + str(COMPACT_VERSION) + ", " + str(len(image)) + " byte image")
+            print(str(len(data_runs)) + " data runs, " + str(sum([size for offset, size in data_runs])) + " bytes of data")
+            print(str(len(fields)) + " label addresses")
+            return
+        out = decode_compact(data)
+    except liquidcpu_compact_error as error:
+        print("lasm_compact: " + str(error))
+        quit(1)
+
+    with open(result.output or "lasm.liq", "wb") as fp:
+        fp.write(out)
+    print("Decoded " + str(len(data)) + " bytes into " + str(len(out)) + ".")
+
+if __name__ == "__main__":
+    main()
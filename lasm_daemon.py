@@ -0,0 +1,307 @@
+from collections import OrderedDict
+from struct import Struct
+import contextlib
+import hashlib
+import io
+import json
+import os
+import socket
+import sys
+import time
+import traceback
+
+# Keeps the assembler running in the background, so builds skip starting
+# Python and tokenizing files that didn't change.
+#
+#   python lasm_daemon.py serve            start the daemon
+#   python lasm_daemon.py -o out.liq a.lasm  assemble, same arguments as assembler.py
+#   python lasm_daemon.py status / stop
+#
+# The client only sends its arguments and working directory over a Unix
+# domain socket and prints what comes back, and runs assembler.py itself if
+# no daemon is running. The daemon runs assembler.main() with those
+# arguments, but keeps the tokens and assembled object of every file in
+# memory and reuses them for as long as the file's mtime and size stay the
+# same. Requests are handled one at a time.
+#
+# The client doesn't import the assembler, so it starts as fast as Python
+# does. Every message is a 4 byte length and that much JSON.
+
+length_struct = Struct("<I")
+
+# A file changed less than this long before it was read could change again
+# without its mtime changing, so until then its contents are checked too
+racy_seconds = 2
+
+def default_socket_path():
+    return os.environ.get("LASM_DAEMON_SOCKET") or os.path.join("/tmp", "lasm-daemon-" + str(os.getuid()) + ".sock")
+
+def send_message(conn, message):
+    data = json.dumps(message).encode()
+    conn.sendall(length_struct.pack(len(data)) + data)
+
+def receive_exactly(conn, size):
+    parts = []
+    while size > 0:
+        part = conn.recv(min(size, 1 << 20))
+        if not part:
+            raise ConnectionError("connection closed")
+        parts.append(part)
+        size -= len(part)
+    return b"".join(parts)
+
+def receive_message(conn):
+    size, = length_struct.unpack(receive_exactly(conn, length_struct.size))
+    return json.loads(receive_exactly(conn, size))
+
+class liquidcpu_file_entry:
+    def __init__(self, stat, tokens, digest):
+        self.mtime = stat.st_mtime_ns
+        self.size = stat.st_size
+        self.tokens = tokens
+        # Assembled objects by (optimize, compact, single_pass)
+        self.objects = {}
+        # Only kept while the mtime can't be trusted yet
+        self.digest = digest
+
+class liquidcpu_daemon:
+    def __init__(self, socket_path, max_files=256):
+        import assembler
+        self.assembler = assembler
+
+        self.socket_path = socket_path
+        self.max_files = max_files
+        self.files = OrderedDict()
+        self.requests = 0
+        self.hits = 0
+        self.misses = 0
+        self.running = False
+
+    # File state
+
+    def lookup(self, path, stat):
+        entry = self.files.get(path)
+        if entry is None:
+            return None
+        if entry.mtime != stat.st_mtime_ns or entry.size != stat.st_size:
+            del self.files[path]
+            return None
+
+        if entry.digest is not None:
+            with open(path, "rb") as fp:
+                if hashlib.sha256(fp.read()).digest() != entry.digest:
+                    del self.files[path]
+                    return None
+            if time.time_ns() - entry.mtime > racy_seconds * 1000000000:
+                entry.digest = None
+
+        self.files.move_to_end(path)
+        return entry
+
+    def remember(self, path, entry):
+        self.files[path] = entry
+        self.files.move_to_end(path)
+        while len(self.files) > self.max_files:
+            self.files.popitem(last=False)
+
+    def read_file(self, filename, stats):
+        # (stat, tokens, digest) of a file, the stat is taken first so a
+        # change while reading shows up as a different mtime next time
+        assembler = self.assembler
+        stat = os.stat(filename)
+        if stats is not None:
+            record = stats.start("read")
+        source = assembler.read_source(filename)
+        if stats is not None:
+            stats.finish(record, bytes=len(source))
+
+        try:
+            digest = None
+            if time.time_ns() - stat.st_mtime_ns <= racy_seconds * 1000000000:
+                digest = hashlib.sha256(source).digest()
+            tokens = assembler.tokenize_source(filename, source, stats)
+        finally:
+            if not isinstance(source, bytes):
+                source.close()
+        return stat, tokens, digest
+
+    def assemble(self, filenames, jobs=1, cache=None, stats=None, optimize=False, compact=False, single_pass=False):
+        # Stands in for assembler.assemble_objects in main()
+        assembler = self.assembler
+        options = (optimize, compact, single_pass)
+        objects = [None] * len(filenames)
+        cold = []
+
+        for index, filename in enumerate(filenames):
+            path = os.path.abspath(filename)
+            entry = self.lookup(path, os.stat(path))
+            if entry is None:
+                cold.append(index)
+                continue
+
+            obj = entry.objects.get(options)
+            if obj is None and entry.tokens is None:
+                del self.files[path]
+                cold.append(index)
+                continue
+            if obj is None:
+                obj = assembler.assemble_tokens(filename, entry.tokens, stats, *options)
+                entry.objects[options] = obj
+            else:
+                self.hits += 1
+            objects[index] = obj
+
+        self.misses += len(cold)
+        if cold and (cache is not None or (jobs > 1 and len(cold) > 1)):
+            # The on-disk cache and -j work as in a normal run, there are
+            # just no tokens to keep then. Files that changed too recently
+            # aren't kept, there is no digest to check them with.
+            cold_stats = [os.stat(filenames[index]) for index in cold]
+            results = assembler.assemble_objects([filenames[index] for index in cold], jobs, cache, stats, *options)
+            for index, stat, obj in zip(cold, cold_stats, results):
+                objects[index] = obj
+                if time.time_ns() - stat.st_mtime_ns > racy_seconds * 1000000000:
+                    entry = liquidcpu_file_entry(stat, None, None)
+                    entry.objects[options] = obj
+                    self.remember(os.path.abspath(filenames[index]), entry)
+        else:
+            for index in cold:
+                stat, tokens, digest = self.read_file(filenames[index], stats)
+                entry = liquidcpu_file_entry(stat, tokens, digest)
+                entry.objects[options] = assembler.assemble_tokens(filenames[index], tokens, stats, *options)
+                objects[index] = entry.objects[options]
+                self.remember(os.path.abspath(filenames[index]), entry)
+
+        return objects
+
+    # Requests
+
+    def run_build(self, argv, cwd):
+        # Runs assembler.main() like the command line would, and returns its
+        # output and exit status
+        stdout = io.StringIO()
+        stderr = io.StringIO()
+        status = 0
+        try:
+            os.chdir(cwd)
+            with contextlib.redirect_stdout(stdout), contextlib.redirect_stderr(stderr):
+                try:
+                    self.assembler.main(argv, self.assemble)
+                except SystemExit as exit:
+                    if isinstance(exit.code, int):
+                        status = exit.code
+                    elif exit.code is not None:
+                        print(exit.code, file=sys.stderr)
+                        status = 1
+                except Exception:
+                    traceback.print_exc()
+                    status = 1
+        except OSError as error:
+            stderr.write("lasm_daemon: " + str(error) + "\n")
+            status = 1
+        return {"stdout": stdout.getvalue(), "stderr": stderr.getvalue(), "status": status}
+
+    def handle(self, conn):
+        request = receive_message(conn)
+        command = request.get("command", "build")
+        if command == "build":
+            self.requests += 1
+            response = self.run_build(request["argv"], request["cwd"])
+        elif command == "status":
+            response = {"stdout": "lasm daemon " + str(os.getpid()) + ": " + str(self.requests) + " builds, " + str(len(self.files)) + " files held, " + str(self.hits) + " hits, " + str(self.misses) + " misses\n", "stderr": "", "status": 0}
+        elif command == "stop":
+            self.running = False
+            response = {"stdout": "lasm daemon stopped\n", "stderr": "", "status": 0}
+        else:
+            response = {"stdout": "", "stderr": "lasm_daemon: unknown command " + str(command) + "\n", "status": 2}
+        send_message(conn, response)
+
+    def serve(self):
+        if os.path.exists(self.socket_path):
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(self.socket_path)
+                print("lasm_daemon: already running on " + self.socket_path)
+                return 1
+            except OSError:
+                # Left over from a daemon that didn't exit cleanly
+                os.remove(self.socket_path)
+            finally:
+                probe.close()
+
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        # Only this user can connect, as builds run with the daemon's rights
+        old_umask = os.umask(0o177)
+        try:
+            server.bind(self.socket_path)
+        finally:
+            os.umask(old_umask)
+        server.listen(16)
+        print("lasm_daemon: listening on " + self.socket_path)
+        sys.stdout.flush()
+
+        self.running = True
+        try:
+            while self.running:
+                conn, address = server.accept()
+                with conn:
+                    try:
+                        self.handle(conn)
+                    except (ConnectionError, ValueError, KeyError):
+                        pass
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.close()
+            try:
+                os.remove(self.socket_path)
+            except OSError:
+                pass
+        return 0
+
+def send_request(socket_path, request):
+    conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        conn.connect(socket_path)
+        send_message(conn, request)
+        return receive_message(conn)
+    finally:
+        conn.close()
+
+def main():
+    argv = sys.argv[1:]
+    socket_path = default_socket_path()
+    if len(argv) >= 2 and argv[0] == "--socket":
+        socket_path = argv[1]
+        argv = argv[2:]
+
+    if argv and argv[0] == "serve":
+        import argparse
+        parser = argparse.ArgumentParser(prog="lasm_daemon.py serve", description='Run the LiquidCPU assembler as a daemon.')
+        parser.add_argument('--max-files', type=int, default=256, help='how many files to keep in memory (default 256)')
+        result = parser.parse_args(argv[1:])
+        quit(liquidcpu_daemon(socket_path, result.max_files).serve())
+
+    if argv and argv[0] in ("status", "stop"):
+        request = {"command": argv[0]}
+    else:
+        request = {"command": "build", "argv": argv, "cwd": os.getcwd()}
+
+    try:
+        response = send_request(socket_path, request)
+    except (FileNotFoundError, ConnectionRefusedError):
+        if request["command"] != "build":
+            print("lasm_daemon: no daemon on " + socket_path)
+            quit(1)
+        # No daemon, so assemble here like assembler.py would
+        import assembler
+        assembler.main(argv)
+        return
+
+    sys.stdout.write(response["stdout"])
+    sys.stderr.write(response["stderr"])
+    sys.stdout.flush()
+    sys.exit(response["status"])
+
+if __name__ == "__main__":
+    main()
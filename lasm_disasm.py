@@ -0,0 +1,319 @@
+import argparse
+import json
+import mmap
+
+import numpy as np
+
+from assembler import INST_FLAG_SRC_MEM_OP, INST_FLAG_DST_MEM_OP, INST_FLAG_SRC_CONST, INST_FLAG_DST_CONST, INST_FLAG_SRC_REG, INST_FLAG_DST_REG
+from assembler import instruction_names, instruction_forms, gprs, get_opcode, compact_magic
+from liqfile import is_liqfile
+from emulator import INSTRUCTION_SIZE
+
+# Disassembles .liq images. Records are decoded in bulk with a NumPy dtype
+# matching instruction_t, never one at a time.
+#
+# Code and data look the same in an image, so code is found by following
+# execution from address 0: every record runs into the next one until a
+# hlt, jmp or ret, and jmp/call to a constant start more code. Everything
+# else is data, shown as dq. Code only reached through a register or memory
+# operand can't be found this way and shows up as data too.
+
+record_dtype = np.dtype([("opcode", "u1"), ("flags", "u1"), ("operand_sizes", "u1"), ("data1", "<u8"), ("data2", "<u8")])
+
+opcode_jmp  = get_opcode("jmp")
+opcode_call = get_opcode("call")
+terminator_opcodes = np.array([get_opcode("hlt"), opcode_jmp, get_opcode("ret")], dtype=np.uint8)
+
+record_offsets = np.arange(INSTRUCTION_SIZE, dtype=np.intp)
+
+# Registers by index, push and pop can also use ip and sp
+register_names = gprs + ["ip", "sp", "flag"]
+
+dst_flag_bits = INST_FLAG_DST_MEM_OP | INST_FLAG_DST_CONST | INST_FLAG_DST_REG
+src_flag_bits = INST_FLAG_SRC_MEM_OP | INST_FLAG_SRC_CONST | INST_FLAG_SRC_REG
+
+def operand_form(flags, mem_op, const, reg):
+    # Same forms as the assembler, None for no operand and "?" for flags it never writes
+    bits = flags & (mem_op | const | reg)
+    if bits == 0:
+        return None
+    elif bits == reg:
+        return "reg"
+    elif bits == reg | mem_op:
+        return "[reg]"
+    elif bits == const:
+        return "const"
+    elif bits == mem_op:
+        return "[const]"
+    return "?"
+
+# Form of each operand for every value of the flags byte
+dst_forms = [operand_form(flags, INST_FLAG_DST_MEM_OP, INST_FLAG_DST_CONST, INST_FLAG_DST_REG) for flags in range(256)]
+src_forms = [operand_form(flags, INST_FLAG_SRC_MEM_OP, INST_FLAG_SRC_CONST, INST_FLAG_SRC_REG) for flags in range(256)]
+
+def mnemonic(opcode):
+    if opcode < len(instruction_names):
+        return instruction_names[opcode]
+    return "op_" + hex(opcode)
+
+def instruction_form(opcode, flags):
+    # Like "mov reg, [const]", with a trailing "?" if the assembler can't produce it
+    forms = [form for form in (dst_forms[flags], src_forms[flags]) if form is not None]
+    text = mnemonic(opcode)
+    if forms:
+        text += " " + ", ".join(forms)
+
+    name = mnemonic(opcode)
+    allowed = instruction_forms.get(name)
+    if allowed is None or len(forms) != len(allowed) or any([form not in operand for form, operand in zip(forms, allowed)]):
+        text += " ?"
+    return text
+
+def open_image(filename):
+    # Maps the file, small or empty files are just read
+    with open(filename, "rb") as fp:
+        try:
+            return mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            return fp.read()
+
+def gather_records(image_bytes, starts):
+    # Records at any list of addresses, as one structured array
+    if len(starts) == 0:
+        return np.zeros(0, dtype=record_dtype)
+    raw = image_bytes[starts[:, None] + record_offsets]
+    return np.ascontiguousarray(raw).view(record_dtype).reshape(-1)
+
+class liquidcpu_disassembly:
+    def __init__(self, image):
+        self.image = image
+        self.image_bytes = np.frombuffer(image, dtype=np.uint8)
+        self.size = len(self.image_bytes)
+
+        # Address of every reachable record, in order, and those records
+        self.starts = None
+        self.records = None
+        # Constant jmp/call targets, and how many jmp/call go through a register or memory
+        self.targets = set()
+        self.indirect = 0
+        # Targets outside the image, or where a whole record doesn't fit
+        self.bad_targets = set()
+
+        self.residues = None
+        self.find_code()
+
+    def residue(self, offset):
+        # Every record at offset, offset + 19, ... as a view of the image, and
+        # for each of them the index of the first record from there on that
+        # ends a run. Code after a dq is 8 bytes off, so there is one of these
+        # for each offset below 19 that code is found at.
+        if offset not in self.residues:
+            records = np.frombuffer(self.image, dtype=record_dtype, count=(self.size - offset) // INSTRUCTION_SIZE, offset=offset)
+            opcodes = records["opcode"]
+            stops = np.isin(opcodes, terminator_opcodes) | (opcodes >= len(instruction_names))
+            positions = np.where(stops, np.arange(len(records)), len(records))
+            next_stop = np.minimum.accumulate(positions[::-1])[::-1]
+
+            # Index and operand of every jmp/call, and which go to a constant
+            branches = np.flatnonzero((opcodes == opcode_jmp) | (opcodes == opcode_call))
+            branch_records = records[branches]
+            direct = (branch_records["flags"] & dst_flag_bits) == INST_FLAG_DST_CONST
+            self.residues[offset] = (records, next_stop, branches, branch_records["data1"], direct)
+        return self.residues[offset]
+
+    def find_code(self):
+        size = self.size
+        is_start = np.zeros(size, dtype=bool)
+        pending = [0] if size >= INSTRUCTION_SIZE else []
+        self.residues = {}
+
+        while pending:
+            address = pending.pop()
+            if address + INSTRUCTION_SIZE > size or is_start[address]:
+                continue
+
+            offset = address % INSTRUCTION_SIZE
+            records, next_stop, branches, targets, direct = self.residue(offset)
+            walked = is_start[offset::INSTRUCTION_SIZE]
+
+            # The run goes up to and including a terminator, and stops before
+            # a bad opcode or a record that was already walked
+            first = address // INSTRUCTION_SIZE
+            end = int(next_stop[first])
+            if end < len(records) and records["opcode"][end] < len(instruction_names):
+                end += 1
+            known = np.flatnonzero(walked[first:end])
+            if len(known):
+                end = first + int(known[0])
+
+            walked[first:end] = True
+            low, high = np.searchsorted(branches, first), np.searchsorted(branches, end)
+            self.indirect += int(high - low - np.count_nonzero(direct[low:high]))
+            self.add_targets(targets[low:high][direct[low:high]], pending)
+
+        self.residues = None
+        self.starts = np.flatnonzero(is_start)
+        self.records = gather_records(self.image_bytes, self.starts)
+
+    def add_targets(self, targets, pending):
+        for target in targets.tolist():
+            if target + INSTRUCTION_SIZE > self.size:
+                self.bad_targets.add(target)
+            elif target not in self.targets:
+                self.targets.add(target)
+                pending.append(target)
+
+    def code_mask(self):
+        covered = np.zeros(self.size, dtype=bool)
+        if len(self.starts):
+            covered[(self.starts[:, None] + record_offsets).reshape(-1)] = True
+        return covered
+
+    def data_runs(self):
+        # (start, end) of every stretch of bytes outside the reachable code
+        outside = np.concatenate(([False], ~self.code_mask(), [False]))
+        edges = np.flatnonzero(outside[1:] != outside[:-1])
+        return list(zip(edges[0::2].tolist(), edges[1::2].tolist()))
+
+    def code_bytes(self):
+        return int(np.count_nonzero(self.code_mask()))
+
+def format_operand(opcode, form, value, targets):
+    if form == "reg" or form == "[reg]":
+        name = register_names[value] if value < len(register_names) else "reg_" + str(value)
+        return name if form == "reg" else "[" + name + "]"
+    elif form == "const":
+        if (opcode == opcode_jmp or opcode == opcode_call) and value in targets:
+            return "loc_" + format(value, "04x")
+        return str(value)
+    elif form == "[const]":
+        return "[" + hex(value) + "]"
+    return "?"
+
+def disassembly_lines(dis):
+    # The listing, with code and data in address order
+    records = dis.records.tolist()
+    code = iter(zip(dis.starts.tolist(), records))
+    data = iter(dis.data_runs())
+    next_code = next(code, None)
+    next_data = next(data, None)
+
+    while next_code is not None or next_data is not None:
+        if next_data is None or (next_code is not None and next_code[0] < next_data[0]):
+            address, (opcode, flags, operand_sizes, data1, data2) = next_code
+            if address in dis.targets or address == 0:
+                yield "loc_" + format(address, "04x") + ":"
+            operands = []
+            for form, value in ((dst_forms[flags], data1), (src_forms[flags], data2)):
+                if form is not None:
+                    operands.append(format_operand(opcode, form, value, dis.targets))
+            text = mnemonic(opcode)
+            if operands:
+                text += " " + ", ".join(operands)
+            if instruction_form(opcode, flags).endswith("?"):
+                text += "    ; flags " + hex(flags)
+            yield "    " + format(address, "04x") + "  " + text
+            next_code = next(code, None)
+        else:
+            start, end = next_data
+            qwords = (end - start) // 8
+            values = np.frombuffer(dis.image, dtype="<u8", count=qwords, offset=start).tolist() if qwords else []
+            for index, value in enumerate(values):
+                yield "    " + format(start + index * 8, "04x") + "  dq " + str(value)
+            if (end - start) % 8:
+                rest = dis.image_bytes[start + qwords * 8:end].tolist()
+                yield "    " + format(start + qwords * 8, "04x") + "  db " + ", ".join([str(byte) for byte in rest])
+            next_data = next(data, None)
+
+class liquidcpu_disasm_stats:
+    # Opcode and operand form counts over any number of images
+    def __init__(self):
+        self.images = 0
+        self.total_bytes = 0
+        self.code_bytes = 0
+        self.indirect = 0
+        self.opcodes = {}
+        self.forms = {}
+
+    def add(self, dis):
+        self.images += 1
+        self.total_bytes += dis.size
+        self.code_bytes += dis.code_bytes()
+        self.indirect += dis.indirect
+
+        keys = dis.records["opcode"].astype(np.uint16) << 8 | dis.records["flags"]
+        values, counts = np.unique(keys, return_counts=True)
+        for key, count in zip(values.tolist(), counts.tolist()):
+            opcode, flags = key >> 8, key & 0xff
+            name = mnemonic(opcode)
+            self.opcodes[name] = self.opcodes.get(name, 0) + count
+            form = instruction_form(opcode, flags)
+            self.forms[form] = self.forms.get(form, 0) + count
+
+    def to_json(self):
+        return {
+            "images": self.images,
+            "bytes": self.total_bytes,
+            "code_bytes": self.code_bytes,
+            "data_bytes": self.total_bytes - self.code_bytes,
+            "indirect_branches": self.indirect,
+            "opcodes": self.opcodes,
+            "forms": self.forms,
+        }
+
+    def format(self):
+        instructions = sum(self.opcodes.values())
+        lines = [
+            str(self.images) + " image(s), " + str(self.total_bytes) + " bytes: " + str(self.code_bytes) + " of reachable code in " + str(instructions) + " instructions, " + str(self.total_bytes - self.code_bytes) + " of data",
+            str(self.indirect) + " jmp/call through a register or memory",
+        ]
+        for title, counts in (("opcode", self.opcodes), ("form", self.forms)):
+            lines.append("")
+            lines.append("{:<24} {:>12} {:>8}".format(title, "count", "share"))
+            for name, count in sorted(counts.items(), key=lambda item: (-item[1], item[0])):
+                lines.append("{:<24} {:>12} {:>7.2f}% {}".format(name, count, count * 100.0 / instructions, "#" * int(count * 40 / instructions)))
+        return "\n".join(lines)
+
+def main():
+    parser = argparse.ArgumentParser(description='Disassemble LiquidCPU executables.')
+    parser.add_argument('--stats', action='store_true', help='print opcode and operand form counts over all the files instead')
+    parser.add_argument('--json', action='store_true', help='print --stats as JSON')
+    parser.add_argument('filenames', nargs='+')
+    result = parser.parse_args()
+
+    stats = liquidcpu_disasm_stats()
+    for filename in result.filenames:
+        image = open_image(filename)
+        dis = None
+        try:
+            if image[:len(compact_magic)] == compact_magic:
+                print(filename + ": compact file, decode it with lasm_compact.py first")
+                continue
+            if is_liqfile(image):
+                print(filename + ": sectioned file, flatten it with liqfile.py --flat first")
+                continue
+
+            dis = liquidcpu_disassembly(image)
+            if result.stats:
+                stats.add(dis)
+                continue
+
+            if len(result.filenames) > 1:
+                print(filename + ":")
+            for line in disassembly_lines(dis):
+                print(line)
+            if dis.bad_targets:
+                print("; jumps outside the image: " + ", ".join([hex(target) for target in sorted(dis.bad_targets)]))
+        finally:
+            # Drop the views of the mapping before closing it
+            dis = None
+            if isinstance(image, mmap.mmap):
+                image.close()
+
+    if result.stats and result.json:
+        print(json.dumps(stats.to_json(), indent=2))
+    elif result.stats:
+        print(stats.format())
+
+if __name__ == "__main__":
+    main()
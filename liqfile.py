@@ -0,0 +1,193 @@
+from struct import Struct
+import argparse
+import re
+
+# Sectioned LiquidCPU executables (lasm --sectioned). The flat format is the
+# image itself, loaded at address 0. A sectioned file instead starts with
+#   header:   magic, format version, segment count, flags, entry ip, sp
+#   segments: kind, load address, size, file offset
+# and is followed by the bytes of every code and data segment, each at an
+# offset that is a multiple of 8. Zero-fill (bss) segments take no space in
+# the file, memory starts out zeroed. sp is only used when LIQFILE_FLAG_SP
+# is set, otherwise the stack starts where the CPU always starts it.
+#
+# Everything is little endian and fixed size, so a loader can map the file
+# and copy every segment straight out of the mapping.
+LIQFILE_VERSION = 1
+
+liqfile_magic  = b"LQSE"
+header_struct  = Struct("<4sHHIQQ")
+segment_struct = Struct("<IIII")
+
+LIQFILE_FLAG_SP = (1<<0)
+
+SEGMENT_CODE = 0
+SEGMENT_DATA = 1
+SEGMENT_BSS  = 2
+segment_kind_names = ["code", "data", "bss"]
+
+# Runs shorter than this stay part of the segment before them, a segment
+# table entry isn't worth it for a few bytes
+min_segment_size = 64
+
+segment_alignment = 8
+
+zero_run_regex = re.compile(b"\\0{" + str(min_segment_size).encode() + b",}")
+
+class liquidcpu_liqfile_error(Exception):
+    pass
+
+def is_liqfile(data):
+    return data[:len(liqfile_magic)] == liqfile_magic
+
+def image_segments(image, runs=None):
+    # Splits a flat image into [kind, address, size] segments. runs are
+    # (kind, offset, size) for the parts of the image that are known to be
+    # data or zero-fill, everything else is code. Without runs, only long
+    # enough runs of zero bytes are found, as bss.
+    if runs is None:
+        runs = [(SEGMENT_BSS, match.start(), match.end() - match.start()) for match in zero_run_regex.finditer(image)]
+
+    # Code and data both come from the file, so short runs of either are
+    # merged into their neighbours. Zero-fill only merges with zero-fill,
+    # except for short runs, which aren't worth a segment of their own.
+    segments = []
+    def add(kind, address, size):
+        if size == 0:
+            return
+        if segments:
+            last = segments[-1]
+            stored = last[0] != SEGMENT_BSS and kind != SEGMENT_BSS
+            if last[0] == kind or (stored and min(last[2], size) < min_segment_size) or (kind == SEGMENT_BSS and last[0] != SEGMENT_BSS and size < min_segment_size):
+                if stored and last[2] < min_segment_size <= size:
+                    last[0] = kind
+                last[2] += size
+                return
+        segments.append([kind, address, size])
+
+    offset = 0
+    for kind, start, size in sorted(runs, key=lambda run: run[1]):
+        add(SEGMENT_CODE, offset, start - offset)
+        add(kind, start, size)
+        offset = start + size
+    add(SEGMENT_CODE, offset, len(image) - offset)
+    return segments
+
+def pack_liqfile(image, segments, entry=0, sp=None):
+    # The whole file, for segments of image as image_segments returns them
+    flags = 0
+    if sp is not None:
+        flags |= LIQFILE_FLAG_SP
+
+    offset = header_struct.size + segment_struct.size * len(segments)
+    table = []
+    contents = []
+    for kind, address, size in segments:
+        if kind == SEGMENT_BSS:
+            table.append(segment_struct.pack(kind, address, size, 0))
+            continue
+        padding = -offset % segment_alignment
+        contents.append(b"\0" * padding)
+        offset += padding
+        table.append(segment_struct.pack(kind, address, size, offset))
+        contents.append(image[address:address + size])
+        offset += size
+
+    header = header_struct.pack(liqfile_magic, LIQFILE_VERSION, len(segments), flags, entry, sp or 0)
+    return b"".join([header] + table + [bytes(content) for content in contents])
+
+def read_liqfile(data):
+    # Returns the entry, sp (None if not set) and [kind, address, size,
+    # contents] of every segment, where contents is None for bss
+    if len(data) < header_struct.size:
+        raise liquidcpu_liqfile_error("file is too short for a header")
+    magic, version, segment_count, flags, entry, sp = header_struct.unpack_from(data, 0)
+    if magic != liqfile_magic:
+        raise liquidcpu_liqfile_error("not a sectioned LiquidCPU file")
+    if version != LIQFILE_VERSION:
+        raise liquidcpu_liqfile_error("unsupported sectioned format version " + str(version))
+    if header_struct.size + segment_count * segment_struct.size > len(data):
+        raise liquidcpu_liqfile_error("segment table runs past the end of the file")
+
+    segments = []
+    for kind, address, size, file_offset in segment_struct.iter_unpack(data[header_struct.size:header_struct.size + segment_count * segment_struct.size]):
+        if kind >= len(segment_kind_names):
+            raise liquidcpu_liqfile_error("unknown segment kind " + str(kind))
+        contents = None
+        if kind != SEGMENT_BSS:
+            if file_offset + size > len(data):
+                raise liquidcpu_liqfile_error(segment_kind_names[kind] + " segment at " + hex(address) + " runs past the end of the file")
+            contents = memoryview(data)[file_offset:file_offset + size]
+        segments.append([kind, address, size, contents])
+
+    return entry, (sp if flags & LIQFILE_FLAG_SP else None), segments
+
+def load_memory(data, memory_size):
+    # Memory as the CPU starts with it, for flat or sectioned files, and the
+    # entry and sp to start with (None to keep the default)
+    memory = bytearray(memory_size)
+    if not is_liqfile(data):
+        if len(data) > memory_size:
+            raise liquidcpu_liqfile_error("image of " + str(len(data)) + " bytes does not fit in memory")
+        memory[:len(data)] = data
+        return memory, 0, None
+
+    entry, sp, segments = read_liqfile(data)
+    for kind, address, size, contents in segments:
+        if address + size > memory_size:
+            raise liquidcpu_liqfile_error(segment_kind_names[kind] + " segment at " + hex(address) + " does not fit in memory")
+        if contents is not None:
+            memory[address:address + size] = contents
+    return memory, entry, sp
+
+def flatten(data):
+    # The flat image of a sectioned file, up to the end of its last segment
+    entry, sp, segments = read_liqfile(data)
+    size = max([address + size for kind, address, size, contents in segments] + [0])
+    image = bytearray(size)
+    for kind, address, size, contents in segments:
+        if contents is not None:
+            image[address:address + size] = contents
+    return bytes(image), entry, sp
+
+def main():
+    parser = argparse.ArgumentParser(description='Show, flatten or section LiquidCPU executables.')
+    parser.add_argument('--output', '-o', help='write the converted file here')
+    parser.add_argument('--flat', action='store_true', help='convert a sectioned file to the flat format')
+    parser.add_argument('--sectioned', action='store_true', help='convert a flat file to the sectioned format, with long runs of zeros as bss')
+    parser.add_argument('filename')
+    result = parser.parse_args()
+
+    with open(result.filename, "rb") as fp:
+        data = fp.read()
+
+    try:
+        if result.flat:
+            image, entry, sp = flatten(data)
+            if entry != 0 or sp is not None:
+                print("Warning: the flat format always starts at ip 0 with the default sp")
+            out = image
+        elif result.sectioned:
+            if is_liqfile(data):
+                print(result.filename + " is already sectioned")
+                quit(1)
+            out = pack_liqfile(data, image_segments(data))
+        else:
+            if not is_liqfile(data):
+                print(result.filename + ": flat image, " + str(len(data)) + " bytes")
+                return
+            entry, sp, segments = read_liqfile(data)
+            print("Sectioned format version " + str(LIQFILE_VERSION) + ", entry " + hex(entry) + ", sp " + (hex(sp) if sp is not None else "default"))
+            for kind, address, size, contents in segments:
+                print("  " + segment_kind_names[kind].ljust(5) + " " + hex(address) + " - " + hex(address + size) + "  " + str(size) + " bytes")
+            return
+    except liquidcpu_liqfile_error as error:
+        print("liqfile: " + str(error))
+        quit(1)
+
+    with open(result.output or "lasm.liq", "wb") as fp:
+        fp.write(out)
+    print("Wrote " + str(len(out)) + " bytes, from " + str(len(data)) + ".")
+
+if __name__ == "__main__":
+    main()
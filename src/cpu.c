@@ -68,17 +68,67 @@ uint64_t get_operand_size(uint8_t operand_size) {
     }
 }
 
+uint64_t read_compact_operand(cpu_t *cpu, uint64_t addr, uint8_t operand_size) {
+    switch (operand_size) {
+        case operand_1:
+            return read_memory_8(cpu, addr);
+        case operand_2:
+            return read_memory_16(cpu, addr);
+        case operand_4:
+            return read_memory_32(cpu, addr);
+        case operand_8:
+            return read_memory_64(cpu, addr);
+        default:
+            fault(cpu, fault_bad_flg);
+            return 0;
+    }
+}
+
+/* Compact encoding: opcode, flags and operand sizes, then only the operands
+ * the flags use, each as big as its operand size says. Returns the length. */
+uint64_t fetch_compact_instruction(cpu_t *cpu, instruction_t *instruction) {
+    uint64_t addr = cpu->ip;
+    uint8_t operand_sizes;
+
+    instruction->instruction = read_memory_8(cpu, addr);
+    instruction->instruction_flags = read_memory_8(cpu, addr + 1);
+    operand_sizes = read_memory_8(cpu, addr + 2);
+    instruction->operand_size_src = operand_sizes & 0xf;
+    instruction->operand_size_dst = operand_sizes >> 4;
+    instruction->data1 = 0;
+    instruction->data2 = 0;
+    addr += 3;
+
+    if (instruction->instruction_flags & (INST_FLAG_DST_MEM_OP | INST_FLAG_DST_CONST | INST_FLAG_DST_REG)) {
+        instruction->data1 = read_compact_operand(cpu, addr, instruction->operand_size_dst);
+        addr += get_operand_size(instruction->operand_size_dst);
+    }
+    if (instruction->instruction_flags & (INST_FLAG_SRC_MEM_OP | INST_FLAG_SRC_CONST | INST_FLAG_SRC_REG)) {
+        instruction->data2 = read_compact_operand(cpu, addr, instruction->operand_size_src);
+        addr += get_operand_size(instruction->operand_size_src);
+    }
+
+    return addr - cpu->ip;
+}
+
 void execute_instruction(cpu_t *cpu) {
     instruction_t *instruction = (instruction_t *) &cpu->memory[cpu->ip];
+    instruction_t compact_instruction;
 
     if (!(cpu->flag & CPU_FLAG_HLT)) {
-        /* Memory check */
-        if (!is_valid_addr(cpu, cpu->ip + sizeof(instruction_t) - 1)) {
-            fault(cpu, fault_mem_err); // Memory access check
-        }
+        if (cpu->compact) {
+            uint64_t length = fetch_compact_instruction(cpu, &compact_instruction);
+            instruction = &compact_instruction;
+            cpu->ip += length; // Modify the IP before executing, so that jmp, etc. works
+        } else {
+            /* Memory check */
+            if (!is_valid_addr(cpu, cpu->ip + sizeof(instruction_t) - 1)) {
+                fault(cpu, fault_mem_err); // Memory access check
+            }
 
-        //printf("[LiquidCPU] Got instruction 0x%lx at ip: 0x%lx\n", instruction->instruction, cpu->ip);
-        cpu->ip += sizeof(instruction_t); // Modify the IP before executing, so that jmp, etc. works
+            //printf("[LiquidCPU] Got instruction 0x%lx at ip: 0x%lx\n", instruction->instruction, cpu->ip);
+            cpu->ip += sizeof(instruction_t); // Modify the IP before executing, so that jmp, etc. works
+        }
 
         switch (instruction->instruction) {
             case instruction_nop:
@@ -151,6 +201,9 @@ void setup_cpu(cpu_t *cpu) {
     /* Clear clock count */
     cpu->clock_cycles = 0;
 
+    /* Fixed size instructions, unless the loader finds a compact header */
+    cpu->compact = 0;
+
     /* Set up CPU's memory area */
     setup_cpu_mem(cpu);
 }
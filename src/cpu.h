@@ -29,6 +29,9 @@ typedef struct {
 
     /* Clock cycles */
     uint64_t clock_cycles;
+
+    /* Set if memory holds the compact (variable length) encoding */
+    uint8_t compact;
 } cpu_t;
 
 void setup_cpu(cpu_t *cpu);
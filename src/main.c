@@ -2,6 +2,95 @@
 #include <stdio.h>
 #include <stdlib.h>
 #include <string.h>
+#include <sys/mman.h>
+
+/* Header of a file written with lasm --compact, see assembler.py */
+#define COMPACT_MAGIC "LQCE"
+#define COMPACT_VERSION 1
+
+typedef struct {
+    char magic[4];
+    uint16_t version;
+    uint16_t reserved;
+    uint32_t data_run_count;
+    uint32_t address_field_count;
+    uint32_t image_size;
+} __attribute__((packed)) compact_header_t;
+
+/* Header and segment table of a file written with lasm --sectioned, see liqfile.py */
+#define SECTIONED_MAGIC "LQSE"
+#define SECTIONED_VERSION 1
+#define SECTIONED_FLAG_SP (1<<0)
+
+enum SEGMENT_KINDS {
+    SEGMENT_CODE = 0,
+    SEGMENT_DATA = 1,
+    SEGMENT_BSS = 2,
+};
+
+typedef struct {
+    char magic[4];
+    uint16_t version;
+    uint16_t segment_count;
+    uint32_t flags;
+    uint64_t entry;
+    uint64_t sp;
+} __attribute__((packed)) sectioned_header_t;
+
+typedef struct {
+    uint32_t kind;
+    uint32_t address;
+    uint32_t size;
+    uint32_t file_offset;
+} __attribute__((packed)) segment_t;
+
+/* Maps the file and copies every code and data segment to its address.
+   Memory starts out zeroed, so bss segments only need to fit. */
+void load_sectioned(cpu_t *cpu, FILE *liquid_exec, char *filename, int64_t fsize) {
+    uint8_t *file = mmap(NULL, fsize, PROT_READ, MAP_PRIVATE, fileno(liquid_exec), 0);
+    if (file == MAP_FAILED) {
+        printf("[Liquid Main] Couldn't map %s\n", filename);
+        exit(1);
+    }
+
+    sectioned_header_t *header = (sectioned_header_t *)file;
+    if (header->version != SECTIONED_VERSION) {
+        printf("[Liquid Main] %s uses sectioned format version %u, only %u is supported\n", filename, header->version, SECTIONED_VERSION);
+        exit(1);
+    }
+    if (sizeof(*header) + (int64_t)header->segment_count * sizeof(segment_t) > (uint64_t)fsize) {
+        printf("[Liquid Main] %s has a bad segment table\n", filename);
+        exit(1);
+    }
+
+    segment_t *segments = (segment_t *)(file + sizeof(*header));
+    for (uint32_t i = 0; i < header->segment_count; i++) {
+        segment_t *segment = &segments[i];
+        if (segment->kind > SEGMENT_BSS) {
+            printf("[Liquid Main] %s has a segment of unknown kind %u\n", filename, segment->kind);
+            exit(1);
+        }
+        if ((uint64_t)segment->address + segment->size > cpu->memory_size) {
+            printf("[Liquid Main] Segment at 0x%x of %s doesn't fit in CPU memory (%lu bytes)\n", segment->address, filename, cpu->memory_size);
+            exit(1);
+        }
+        if (segment->kind == SEGMENT_BSS) {
+            continue;
+        }
+        if ((uint64_t)segment->file_offset + segment->size > (uint64_t)fsize) {
+            printf("[Liquid Main] Segment at 0x%x runs past the end of %s\n", segment->address, filename);
+            exit(1);
+        }
+        memcpy(cpu->memory + segment->address, file + segment->file_offset, segment->size);
+    }
+
+    cpu->ip = header->entry;
+    if (header->flags & SECTIONED_FLAG_SP) {
+        cpu->sp = header->sp;
+    }
+    printf("[Liquid Main] Sectioned executable, %u segments, entry 0x%lx.\n", header->segment_count, cpu->ip);
+    munmap(file, fsize);
+}
 
 void execute_binary_liquid_cpu(char *filename) {
     cpu_t my_cpu;
@@ -9,29 +98,66 @@ void execute_binary_liquid_cpu(char *filename) {
 
     printf("[Liquid Main] Set up CPU state..\n");
 
-    /* Load the binary into memory */
-    FILE *size_get = fopen(filename, "r");
-    if (!size_get) {
+    /* Load the binary straight into CPU memory */
+    FILE *liquid_exec = fopen(filename, "rb");
+    if (!liquid_exec) {
         printf("[Liquid Main] Couldn't open %s\n", filename);
         exit(1);
     }
-    fseek(size_get, 0, SEEK_END);
-    int64_t fsize = ftell(size_get);
-    fclose(size_get);
+    fseek(liquid_exec, 0, SEEK_END);
+    int64_t fsize = ftell(liquid_exec);
+    fseek(liquid_exec, 0, SEEK_SET);
 
     printf("[Liquid Main] Got executable size %ld.\n", fsize);
 
-    FILE *liquid_exec = fopen(filename, "rb");
+    /* Compact files have a header and tables in front of the image */
+    compact_header_t header;
+    int got_header = fsize >= (int64_t)sizeof(header) && fread(&header, sizeof(header), 1, liquid_exec) == 1;
 
-    uint8_t *exec = malloc(fsize);
-    fread(exec, 1, fsize, liquid_exec);
-    fclose(liquid_exec);
+    /* Sectioned files are loaded segment by segment instead */
+    if (got_header && fsize >= (int64_t)sizeof(sectioned_header_t) && !memcmp(header.magic, SECTIONED_MAGIC, 4)) {
+        load_sectioned(&my_cpu, liquid_exec, filename, fsize);
+        fclose(liquid_exec);
+
+        printf("[Liquid Main] Binary is in CPU memory.\n");
+        cpu_code_loop(&my_cpu);
+        return;
+    }
+
+    if (got_header && !memcmp(header.magic, COMPACT_MAGIC, 4)) {
+        if (header.version != COMPACT_VERSION) {
+            printf("[Liquid Main] %s uses compact format version %u, only %u is supported\n", filename, header.version, COMPACT_VERSION);
+            fclose(liquid_exec);
+            exit(1);
+        }
 
-    printf("[Liquid Main] Loaded binary.\n");
+        int64_t image_offset = sizeof(header) + (int64_t)header.data_run_count * 8 + (int64_t)header.address_field_count * 4;
+        if (image_offset + header.image_size != fsize) {
+            printf("[Liquid Main] %s has a bad compact header\n", filename);
+            fclose(liquid_exec);
+            exit(1);
+        }
 
-    /* Copy to CPU memory area */
-    memcpy(my_cpu.memory, exec, fsize);
-    free(exec);
+        printf("[Liquid Main] Compact executable, image size %u.\n", header.image_size);
+        my_cpu.compact = 1;
+        fsize = header.image_size;
+        fseek(liquid_exec, image_offset, SEEK_SET);
+    } else {
+        fseek(liquid_exec, 0, SEEK_SET);
+    }
+
+    if (fsize < 0 || (uint64_t)fsize > my_cpu.memory_size) {
+        printf("[Liquid Main] %s doesn't fit in CPU memory (%lu bytes)\n", filename, my_cpu.memory_size);
+        fclose(liquid_exec);
+        exit(1);
+    }
+
+    if (fread(my_cpu.memory, 1, fsize, liquid_exec) != (size_t)fsize) {
+        printf("[Liquid Main] Couldn't read %s\n", filename);
+        fclose(liquid_exec);
+        exit(1);
+    }
+    fclose(liquid_exec);
 
     printf("[Liquid Main] Binary is in CPU memory.\n");
 
@@ -287,7 +287,7 @@ void dec_handler(cpu_t *cpu, instruction_t *instruction) {
             // We got the address
             write_memory_64(cpu, addr, read_memory_64(cpu, addr) - 1);
         } else {
-            write_memory_64(cpu, instruction->data1, read_memory_64(cpu, instruction->data1) + 1);
+            write_memory_64(cpu, instruction->data1, read_memory_64(cpu, instruction->data1) - 1);
         }
     } else if (instruction->instruction_flags & INST_FLAG_DST_CONST) {
         printf("[LiquidCPU] Bad const. bruh\n");
@@ -15,6 +15,12 @@ void pop_handler(cpu_t *cpu, instruction_t *instruction);
 void call_handler(cpu_t *cpu, instruction_t *instruction);
 void ret_handler(cpu_t *cpu, instruction_t *instruction);
 
+/* Memory */
+uint64_t read_memory_64(cpu_t *cpu, uint64_t addr);
+uint32_t read_memory_32(cpu_t *cpu, uint64_t addr);
+uint16_t read_memory_16(cpu_t *cpu, uint64_t addr);
+uint8_t read_memory_8(cpu_t *cpu, uint64_t addr);
+
 /* Fault stuff */
 void fault(cpu_t *cpu, uint64_t fault_no);
 
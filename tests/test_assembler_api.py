@@ -0,0 +1,54 @@
+import os
+import sys
+import warnings
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import assembler
+
+fixed_jump = "jmp 0\nnop\nhlt\n"
+
+def test_warnings_go_to_the_list():
+    collected = []
+    assembler.liquidcpu_assembler(optimize=True).assemble(fixed_jump, "a.lasm", warnings=collected)
+    assert collected == ["not optimizing a.lasm, it has a jmp to a fixed address"]
+
+def test_warnings_without_a_list(capsys):
+    with warnings.catch_warnings(record=True) as caught:
+        warnings.simplefilter("always")
+        assembler.liquidcpu_assembler(optimize=True).assemble(fixed_jump)
+    assert [warning.category for warning in caught] == [assembler.liquidcpu_assembler_warning]
+    assert capsys.readouterr().out == ""
+
+def test_verbose_level_is_per_assembler(capsys):
+    assembler.liquidcpu_assembler(verbose_level=1).assemble("nop\n")
+    assert "[Info]" in capsys.readouterr().out
+    assembler.liquidcpu_assembler().assemble("nop\n")
+    assert capsys.readouterr().out == ""
+    assert assembler.verbose_level == 0
+
+def test_one_stats_measures_memory_at_a_time():
+    first = assembler.liquidcpu_stats()
+    second = assembler.liquidcpu_stats()
+    outer = first.start("outer")
+    inner = second.start("inner")
+    second.finish(inner)
+    first.finish(outer)
+    assert "peak_memory" in first.records[0]
+    assert "peak_memory" not in second.records[0]
+
+    record = second.start("after")
+    second.finish(record)
+    assert "peak_memory" in second.records[1]
+
+def assemble_error(source):
+    try:
+        assembler.liquidcpu_assembler().assemble(source)
+    except assembler.liquidcpu_assembler_error as error:
+        return error.msg
+    return None
+
+def test_registers_that_cant_be_used():
+    assert assemble_error("mov r8, 1\n") == "Unknown register r8, there are only r0 to r7!"
+    assert assemble_error("push ip\n") == "Register ip can't be used as an operand, only r0 to r7 can!"
+    assert assemble_error("r8: dq 1\nmov r0, [r8]\nhlt\n") is None
@@ -0,0 +1,37 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import assembler
+import emulator
+
+# Programs that -O has to leave doing the same thing. Every one halts, and
+# the registers other than ip have to end up the same either way.
+programs = [
+    # The label of a removed nop still has to reach the inc after it
+    "call f\nhlt\njmp f\nf: nop\ninc r0\nret\n",
+    # inc r7 is dead code, but the dec after a labeled nop is reached by call
+    "call L6\nhlt\ninc r7\nnop\nL6: nop\ndec r7\nret\n",
+    "mov r0, 5\njmp a\na: jmp b\nb: inc r0\nhlt\n",
+    "mov r1, 1\ninc r1\ndec r1\ncall g\nhlt\ng: inc r1\nret\n",
+    "call g\nhlt\ng: nop\nx: inc r2\ncall h\nret\nh: nop\nnop\ndec r3\nret\n",
+    "jmp end\ninc r0\nnop\nend: nop\ninc r4\nhlt\n",
+]
+
+def final_state(source, optimize):
+    image = assembler.liquidcpu_assembler(optimize=optimize).assemble(source)
+    cpu = emulator.liquidcpu_emulator()
+    cpu.load(image)
+    fault = None
+    try:
+        cpu.run(10000)
+    except emulator.liquidcpu_fault as error:
+        fault = error.fault_no
+    return cpu.regs[:emulator.REG_IP] + cpu.regs[emulator.REG_IP + 1:], cpu.halted, fault
+
+def test_optimize_keeps_final_state():
+    for source in programs:
+        plain = final_state(source, False)
+        assert plain[1] and plain[2] is None, source
+        assert final_state(source, True) == plain, source